@@ -7,4 +7,16 @@ It is heavily-based on the 'python-xbee' library by Paul Malmsten.
 """
 
 from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_bus import EventPublisher
+from pyblehci.ble_bus import EventSubscriber
+from pyblehci.ble_init import InitManager
+from pyblehci.ble_link import LinkManager
+from pyblehci.ble_pack import PacketReader
+from pyblehci.ble_pack import PacketWriter
 from pyblehci.ble_parser import BLEParser
+from pyblehci.ble_proxy import BLEProxy
+from pyblehci.ble_scan import ScanScheduler
+from pyblehci.ble_timers import TimerWheel
+from pyblehci.ble_transactions import ATTTransactions
+from pyblehci.ble_transport import TCPTransport
+from pyblehci.ble_transport import UnixTransport
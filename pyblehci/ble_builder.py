@@ -10,6 +10,10 @@
 """
 
 import collections
+import threading
+
+from pyblehci import ble_codecs
+from pyblehci import ble_queue
 
 
 class BLEBuilder(object):
@@ -32,6 +36,7 @@ class BLEBuilder(object):
         "fe05": 'GATT_DeviceDiscoveryCancel',
         "fe09": 'GATT_EstablishLinkRequest',
         "fe0a": 'GATT_TerminateLinkRequest',
+        "fe11": 'GAP_UpdateLinkParamReq',
         "fe30": 'GAP_SetParam',
         "fe31": 'GAP_GetParam',
     }
@@ -39,65 +44,170 @@ class BLEBuilder(object):
     # structure of command packets
     hci_cmds = {
         "fd8a": [
-            {'name': 'conn_handle', 'len': 2, 'default': '\x00\x00'},
-            {'name': 'handle', 'len': 2, 'default': None}],
+            {'name': 'conn_handle', 'len': 2, 'type': 'uint',
+             'default': '\x00\x00'},
+            {'name': 'handle', 'len': 2, 'type': 'uint', 'default': None}],
         "fd8e": [
-            {'name': 'conn_handle', 'len': 2, 'default': '\x00\x00'},
+            {'name': 'conn_handle', 'len': 2, 'type': 'uint',
+             'default': '\x00\x00'},
             {'name': 'handles', 'len': None, 'default': None}],
         "fd92": [
-            {'name': 'conn_handle', 'len': 2, 'default': '\x00\x00'},
-            {'name': 'handle', 'len': 2, 'default': None},
+            {'name': 'conn_handle', 'len': 2, 'type': 'uint',
+             'default': '\x00\x00'},
+            {'name': 'handle', 'len': 2, 'type': 'uint', 'default': None},
             {'name': 'value', 'len': None, 'default': None}],
         "fd96": [
-            {'name': 'handle', 'len': 2, 'default': '\x00\x00'},
-            {'name': 'offset', 'len': 1, 'default': None},
+            {'name': 'handle', 'len': 2, 'type': 'uint',
+             'default': '\x00\x00'},
+            {'name': 'offset', 'len': 1, 'type': 'uint', 'default': None},
             {'name': 'value', 'len': None, 'default': None}],
         "fdb2": [
-            {'name': 'start_handle', 'len': 2, 'default': '\x00\x00'},
-            {'name': 'end_handle', 'len': 2, 'default': '\xff\xff'}],
+            {'name': 'start_handle', 'len': 2, 'type': 'uint',
+             'default': '\x00\x00'},
+            {'name': 'end_handle', 'len': 2, 'type': 'uint',
+             'default': '\xff\xff'}],
         "fdb4": [
-            {'name': 'conn_handle', 'len': 2, 'default': '\x00\x00'},
-            {'name': 'start_handle', 'len': 2, 'default': '\x01\x00'},
-            {'name': 'end_handle', 'len': 2, 'default': '\xff\xff'},
-            {'name': 'read_type', 'len': 2, 'default': None}],
+            {'name': 'conn_handle', 'len': 2, 'type': 'uint',
+             'default': '\x00\x00'},
+            {'name': 'start_handle', 'len': 2, 'type': 'uint',
+             'default': '\x01\x00'},
+            {'name': 'end_handle', 'len': 2, 'type': 'uint',
+             'default': '\xff\xff'},
+            {'name': 'read_type', 'len': 2, 'type': 'uuid', 'default': None}],
         "fe00": [
-            {'name': 'profile_role', 'len': 1, 'default': '\x08'},
-            {'name': 'max_scan_rsps', 'len': 1, 'default': '\x05'},
+            {'name': 'profile_role', 'len': 1, 'type': 'uint',
+             'default': '\x08'},
+            {'name': 'max_scan_rsps', 'len': 1, 'type': 'uint',
+             'default': '\x05'},
             {'name': 'irk', 'len': 16, 'default':
                 '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'},
             {'name': 'csrk', 'len': 16, 'default':
                 '\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'},
-            {'name': 'sign_counter', 'len': 4, 'default': '\x01\x00\x00\x00'}],
+            {'name': 'sign_counter', 'len': 4, 'type': 'uint',
+             'default': '\x01\x00\x00\x00'}],
         "fe03": [
-            {'name': 'addr_type', 'len': 1, 'default': None},
-            {'name': 'addr', 'len': 6, 'default': None}],
+            {'name': 'addr_type', 'len': 1, 'type': 'uint', 'default': None},
+            {'name': 'addr', 'len': 6, 'type': 'addr', 'default': None}],
         "fe04": [
-            {'name': 'mode', 'len': 1, 'default': None},
-            {'name': 'active_scan', 'len': 1, 'default': '\x01'},
-            {'name': 'white_list', 'len': 1, 'default': '\x00'}],
+            {'name': 'mode', 'len': 1, 'type': 'uint', 'default': None},
+            {'name': 'active_scan', 'len': 1, 'type': 'uint',
+             'default': '\x01'},
+            {'name': 'white_list', 'len': 1, 'type': 'uint',
+             'default': '\x00'}],
         "fe05": [],
         "fe09": [
-            {'name': 'high_duty_cycle', 'len': 1, 'default': '\x00'},
-            {'name': 'white_list', 'len': 1, 'default': '\x00'},
-            {'name': 'addr_type_peer', 'len': 1, 'default': '\x00'},
-            {'name': 'peer_addr', 'len': 6, 'default': None}],
+            {'name': 'high_duty_cycle', 'len': 1, 'type': 'uint',
+             'default': '\x00'},
+            {'name': 'white_list', 'len': 1, 'type': 'uint',
+             'default': '\x00'},
+            {'name': 'addr_type_peer', 'len': 1, 'type': 'uint',
+             'default': '\x00'},
+            {'name': 'peer_addr', 'len': 6, 'type': 'addr', 'default': None}],
         "fe0a": [
-            {'name': 'conn_handle', 'len': 2, 'default': '\x00\x00'}],
+            {'name': 'conn_handle', 'len': 2, 'type': 'uint',
+             'default': '\x00\x00'}],
+        "fe11": [
+            {'name': 'conn_handle', 'len': 2, 'type': 'uint',
+             'default': '\x00\x00'},
+            {'name': 'interval_min', 'len': 2, 'type': 'uint',
+             'default': None},
+            {'name': 'interval_max', 'len': 2, 'type': 'uint',
+             'default': None},
+            {'name': 'conn_latency', 'len': 2, 'type': 'uint',
+             'default': '\x00\x00'},
+            {'name': 'conn_timeout', 'len': 2, 'type': 'uint',
+             'default': None}],
         "fe30": [
-            {'name': 'param_id', 'len': 1, 'default': None},
-            {'name': 'param_value', 'len': 2, 'default': None}],
+            {'name': 'param_id', 'len': 1, 'type': 'uint', 'default': None},
+            {'name': 'param_value', 'len': 2, 'type': 'uint',
+             'default': None}],
         "fe31": [
-            {'name': 'param_id', 'len': 1, 'default': None}],
+            {'name': 'param_id', 'len': 1, 'type': 'uint', 'default': None}],
+    }
+
+    # parameter ids for GAP_SetParam and GAP_GetParam
+    gap_params = {
+        'TGAP_GEN_DISC_ADV_MIN': 0x00,
+        'TGAP_LIM_ADV_TIMEOUT': 0x01,
+        'TGAP_GEN_DISC_SCAN': 0x02,
+        'TGAP_LIM_DISC_SCAN': 0x03,
+        'TGAP_CONN_EST_ADV_TIMEOUT': 0x04,
+        'TGAP_CONN_PARAM_TIMEOUT': 0x05,
+        'TGAP_LIM_DISC_ADV_INT_MIN': 0x06,
+        'TGAP_LIM_DISC_ADV_INT_MAX': 0x07,
+        'TGAP_GEN_DISC_ADV_INT_MIN': 0x08,
+        'TGAP_GEN_DISC_ADV_INT_MAX': 0x09,
+        'TGAP_CONN_ADV_INT_MIN': 0x0a,
+        'TGAP_CONN_ADV_INT_MAX': 0x0b,
+        'TGAP_CONN_SCAN_INT': 0x0c,
+        'TGAP_CONN_SCAN_WIND': 0x0d,
+        'TGAP_CONN_HIGH_SCAN_INT': 0x0e,
+        'TGAP_CONN_HIGH_SCAN_WIND': 0x0f,
+        'TGAP_GEN_DISC_SCAN_INT': 0x10,
+        'TGAP_GEN_DISC_SCAN_WIND': 0x11,
+        'TGAP_LIM_DISC_SCAN_INT': 0x12,
+        'TGAP_LIM_DISC_SCAN_WIND': 0x13,
+        'TGAP_CONN_EST_ADV': 0x14,
+        'TGAP_CONN_EST_INT_MIN': 0x15,
+        'TGAP_CONN_EST_INT_MAX': 0x16,
+        'TGAP_CONN_EST_SCAN_INT': 0x17,
+        'TGAP_CONN_EST_SCAN_WIND': 0x18,
+        'TGAP_CONN_EST_SUPERV_TIMEOUT': 0x19,
+        'TGAP_CONN_EST_LATENCY': 0x1a,
     }
 
-    def __init__(self, ser=None):
+    # default priority class of each command when queued. Commands not
+    # listed are sent with PRIORITY_NORMAL.
+    priorities = {
+        "fd92": ble_queue.PRIORITY_BULK,
+        "fd96": ble_queue.PRIORITY_BULK,
+        "fe00": ble_queue.PRIORITY_CONTROL,
+        "fe03": ble_queue.PRIORITY_CONTROL,
+        "fe04": ble_queue.PRIORITY_CONTROL,
+        "fe05": ble_queue.PRIORITY_CONTROL,
+        "fe09": ble_queue.PRIORITY_CONTROL,
+        "fe0a": ble_queue.PRIORITY_CONTROL,
+        "fe11": ble_queue.PRIORITY_CONTROL,
+        "fe30": ble_queue.PRIORITY_CONTROL,
+        "fe31": ble_queue.PRIORITY_CONTROL,
+    }
+
+    # reverse lookup of opcodes, allowing commands to be given by name
+    opcode_names = dict((name, code) for code, name in opcodes.items())
+
+    def __init__(self, ser=None, queued=False, weights=None, rates=None,
+                 on_error=None):
         """
         Initialises the class
 
         @param ser: The file like serial port to use
         @type ser: serial.Serial
+
+        @param queued: Whether commands should be written by a send queue,
+            in order of priority, rather than directly
+        @type queued: bool
+
+        @param weights: The share of the port given to each priority
+            class other than PRIORITY_CONTROL, when queued
+        @type weights: dict
+
+        @param rates: The rate limit of each priority class, as a tuple of
+            (packets per second, burst size), when queued
+        @type rates: dict
+
+        @param on_error: The method to call with the packets and the error
+            raised when a queued write fails. If not given, the error is
+            raised by the next command sent.
+        @type on_error: <function>
         """
         self.serial_port = ser
+        # serialises writes from multiple threads or subscribers
+        self._write_lock = threading.Lock()
+        self.send_queue = None
+        if queued:
+            self.send_queue = ble_queue.SendQueue(
+                self._write, weights=weights, rates=rates,
+                write_many=self._write_many, on_error=on_error)
 
     def _build_command(self, cmd, **kwargs):
         """
@@ -123,7 +233,12 @@ class BLEBuilder(object):
         KeyError: "The data provided for 'param_id' was not 1 bytes long"
 
         Each field will be written out in the order they are defined in
-        the command definition.
+        the command definition. Typed fields also accept native values,
+        such as integers or canonical address strings, and the command
+        may be given by name.
+
+        >>> _build_command("GAP_GetParam", param_id=0x15)[0]
+        '\\x01\\x31\\xfe\\x01\\x15'
 
         @param cmd: The command to be written
         @type cmd: hex
@@ -134,16 +249,19 @@ class BLEBuilder(object):
         @return: A tuple containing the hex command string and a parsed
             version of the string stored in a dictionary.
         """
-        packet_type = "\x01"
-        op_code = cmd.decode('hex')[::-1]  # command code was human-readable
-        data_len = "\x00"  # insert dummy value for length
+        cmd = self.opcode_names.get(cmd, cmd)
 
         # check for matching command codes in dictionary and store the matching
-        # packet format
+        # packet format, before treating the command as a hex code
         try:
             packet_structure = self.hci_cmds[cmd]
-        except AttributeError:
-            raise NotImplementedError("Command spec could not be found")
+        except (AttributeError, KeyError, TypeError):
+            raise NotImplementedError(
+                "Command spec could not be found for %r" % (cmd,))
+
+        packet_type = "\x01"
+        op_code = cmd.decode('hex')[::-1]  # command code was human-readable
+        data_len = "\x00"  # insert dummy value for length
 
         packet_type_parsed = "Command"
         op_code_parsed = self.opcodes[cmd]
@@ -183,6 +301,9 @@ class BLEBuilder(object):
                 # no specific length, hence ignore it
                 else:
                     field_data = None
+            # convert native values to their byte representation
+            else:
+                field_data = ble_codecs.encode_field(field, field_data)
 
             # ensure that the correct number of elements will be written
             if field_len and len(field_data) != field_len:
@@ -209,7 +330,72 @@ class BLEBuilder(object):
 
         return (packet, built_packet)
 
-    def send(self, cmd, **kwargs):
+    def _split_command(self, data):
+        """
+        Takes a command packet, such as one written by a host tool, and
+        parses it. This is the inverse of '_build_command'.
+
+        >>> _split_command("\x01\x31\xfe\x01\x15")
+        ('\x01\x31\xfe\x01\x15', OrderedDict([
+        ('type', ('\x01', 'Command')),
+        ('op_code', ('\x31\xfe', 'GAP_GetParam')),
+        ('data_len', ('\x01', '01')),
+        ('param_id', ('\x15', '15'))])
+        )
+
+        @param data: The byte string to split and parse
+        @type data: hex
+
+        @return: An ordered dictionary (data order is important)
+            containing binary tuples, in which the first piece of data
+            corresponds to the raw byte string value and the second
+            piece corresponds to its parsed "meaning"
+        """
+        packet_type = data[0]
+        op_code = data[1:3]
+        data_len = data[3]
+
+        if packet_type != "\x01":
+            raise ValueError("Not a command packet; got packet type %s"
+                             % packet_type.encode('hex'))
+
+        cmd = op_code[::-1].encode('hex')
+        try:
+            packet_structure = self.hci_cmds[cmd]
+        except KeyError:
+            raise KeyError("Unrecognized command packet with op code %s"
+                           % cmd)
+
+        parsed_packet = collections.OrderedDict()
+        parsed_packet['type'] = (packet_type, "Command")
+        parsed_packet['op_code'] = (op_code, self.opcodes[cmd])
+        parsed_packet['data_len'] = (data_len, data_len.encode('hex'))
+
+        # parse the packet in the order specified, with a field of no
+        # specific length taking any leftover bytes
+        index = 4
+        for field in packet_structure:
+            if field['len'] is not None:
+                field_data = data[index:(index + field['len'])]
+            else:
+                field_data = data[index:]
+            if not field_data:
+                break
+            if field['len'] is not None and len(field_data) != field['len']:
+                raise ValueError("The data provided for '%s' was not %d "
+                                 "bytes long" % (field['name'], field['len']))
+            parsed_packet[field['name']] = (
+                field_data, field_data.encode('hex'))
+            index += len(field_data)
+
+        if index != len(data):
+            raise ValueError("Command packet was not the expected length;"
+                             " expected: %d, got: %d bytes"
+                             % (index, len(data)))
+
+        return (data, parsed_packet)
+
+    def send(self, cmd, priority=None, **kwargs):
         """
         Constructs and write a HCI command to the serial port for this
         BLE device.
@@ -231,11 +417,22 @@ in _build_command % (field_name, field_len))
         KeyError: "The data provided for 'param_id' was not 1 bytes long"
 
         Each field will be written out in the order they are defined in
-        the command definition.
+        the command definition. As with '_build_command', commands may
+        be given by name and typed fields accept native values.
+
+        >>> send("GAP_GetParam", param_id=0x15)
+        01:31:FE:01:15  #<-- also writes this to serial port
+
+        If the builder is queued, the command is written according to its
+        priority class, which defaults to that given in 'priorities'.
 
         @param cmd: The command to be written
         @type cmd: hex
 
+        @param priority: The priority class, overriding the default for
+            the command
+        @type priority: int
+
         @param kwargs: Any additional parameters
         @type kwargs: hex
 
@@ -243,6 +440,63 @@ in _build_command % (field_name, field_len))
         version of the string stored in a dictionary.
         """
         packet, built_packet = self._build_command(cmd, **kwargs)
-        self.serial_port.write(packet)
+        self.send_packet(packet, priority)
 
         return (packet, built_packet)
+
+    def send_packet(self, packet, priority=None):
+        """
+        Writes an already built HCI command to the serial port for this
+        BLE device. Writes are serialised, hence commands from several
+        threads are never interleaved.
+
+        >>> send_packet("\x01\x31\xfe\x01\x15")
+        01:31:FE:01:15  #<-- writes this to serial port
+
+        @param packet: The command packet to be written
+        @type packet: hex
+
+        @param priority: The priority class, if queued. Defaults to that
+            given in 'priorities' for the packet's command.
+        @type priority: int
+        """
+        if self.send_queue is None:
+            self._write(packet)
+            return
+
+        if priority is None:
+            cmd = packet[1:3][::-1].encode('hex')
+            priority = self.priorities.get(cmd, ble_queue.PRIORITY_NORMAL)
+        self.send_queue.put(packet, priority)
+
+    def _write(self, packet):
+        """
+        Writes a packet to the serial port.
+
+        @param packet: The packet to be written
+        @type packet: hex
+        """
+        with self._write_lock:
+            self.serial_port.write(packet)
+
+    def _write_many(self, packets):
+        """
+        Writes several packets to the serial port at once, with a single
+        vectored write if the port supports one.
+
+        @param packets: The packets to be written, in order
+        @type packets: list
+        """
+        with self._write_lock:
+            writev = getattr(self.serial_port, 'writev', None)
+            if writev is not None:
+                writev(packets)
+            else:
+                self.serial_port.write(''.join(packets))
+
+    def close(self):
+        """
+        Writes any queued commands and stops the send queue, if any.
+        """
+        if self.send_queue is not None:
+            self.send_queue.close()
@@ -0,0 +1,421 @@
+"""
+@fn ble_bus.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about A local event bus, allowing the single process that owns a BLE
+    device to share its event stream with other processes over a Unix
+    domain socket.
+
+    The publisher forwards each raw event packet, unchanged, to every
+    subscriber. As HCI packets carry their own length, no additional
+    framing is needed. Subscribers filter on the event subcode before
+    parsing and may send raw command packets back, which the publisher
+    writes to the device through a single BLEBuilder.
+"""
+
+import errno
+import os
+import select
+import socket
+import threading
+
+from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_parser import BLEParser
+
+# socket errors indicating a non-blocking call should simply be retried
+_retry_errors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class _Client(object):
+    """
+    The publisher's state for a single connected subscriber.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        # event packets not yet accepted by the socket
+        self.outgoing = ''
+        # bytes received that do not yet form a whole command packet
+        self.incoming = ''
+
+    def next_command(self):
+        """
+        Removes a complete command packet from the receive buffer.
+
+        @return: A command packet, or None if none has been buffered
+        """
+        # length byte is stored as the fourth byte in a command packet
+        if len(self.incoming) < 4:
+            return None
+        if self.incoming[0] != '\x01':
+            raise ValueError("Subscriber sent a non-command packet")
+        length = 4 + ord(self.incoming[3])
+        if len(self.incoming) < length:
+            return None
+
+        packet = self.incoming[:length]
+        self.incoming = self.incoming[length:]
+        return packet
+
+
+class EventPublisher(threading.Thread):
+    """
+    Publishes every packet read by a BLEParser to any number of local
+    subscribers, and writes commands received from subscribers to the
+    device in round-robin order.
+    """
+
+    def __init__(self, path, parser, builder=None, max_backlog=1 << 20,
+                 on_error=None):
+        """
+        Initialises the class, binds the socket and starts the thread
+
+        @param path: The filesystem path of the Unix domain socket
+        @type path: string
+
+        @param parser: The parser reading events from the device
+        @type parser: BLEParser
+
+        @param builder: The builder used to write commands received from
+            subscribers. If not given, subscriber commands are discarded.
+        @type builder: BLEBuilder
+
+        @param max_backlog: The number of bytes that may be queued for a
+            slow subscriber before it is disconnected
+        @type max_backlog: int
+
+        @param on_error: The method to call with a subscriber's command
+            and the error raised when it could not be written. Such
+            commands are otherwise dropped silently.
+        @type on_error: <function>
+        """
+        super(EventPublisher, self).__init__()
+        self.daemon = True
+        self.path = path
+        self.parser = parser
+        self.builder = builder
+        self.max_backlog = max_backlog
+        self.on_error = on_error
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._thread_continue = True
+        self._wakeup = os.pipe()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(16)
+        self._server.setblocking(False)
+
+        parser.add_listener(self.publish)
+        self.start()
+
+    def __len__(self):
+        return len(self._clients)
+
+    def _wake(self):
+        os.write(self._wakeup[1], 'x')
+
+    def _drop(self, client):
+        """
+        Disconnects a subscriber. Must be called with the lock held.
+
+        @param client: The subscriber to disconnect
+        @type client: _Client
+        """
+        self._clients.pop(client.sock, None)
+        client.sock.close()
+
+    def publish(self, response):
+        """
+        Forwards a packet to every subscriber. This is registered as a
+        listener on the parser. Packets are written directly if the
+        subscriber's socket will accept them, and otherwise queued for
+        the publisher thread.
+
+        @param response: The (data, parsed packet) tuple from the parser
+        @type response: tuple
+        """
+        data = response[0]
+        wake = False
+        with self._lock:
+            for client in list(self._clients.values()):
+                if not client.outgoing:
+                    try:
+                        sent = client.sock.send(data)
+                    except socket.error as exc:
+                        if exc.args[0] not in _retry_errors:
+                            self._drop(client)
+                            continue
+                        sent = 0
+                    if sent == len(data):
+                        continue
+                    data_left = data[sent:]
+                else:
+                    data_left = data
+
+                if len(client.outgoing) + len(data_left) > self.max_backlog:
+                    self._drop(client)
+                    continue
+                client.outgoing += data_left
+                wake = True
+        if wake:
+            self._wake()
+
+    def run(self):
+        """
+        Overrides threading.Thread.run(). Accepts subscribers, flushes
+        queued packets and relays subscriber commands.
+        """
+        while self._thread_continue:
+            with self._lock:
+                readers = [self._server, self._wakeup[0]] + [
+                    client.sock for client in self._clients.values()]
+                writers = [client.sock for client in self._clients.values()
+                           if client.outgoing]
+
+            try:
+                readable, writable, _ = select.select(readers, writers, [])
+            except (select.error, socket.error, ValueError):
+                # a subscriber was dropped by 'publish' while we waited
+                continue
+
+            with self._lock:
+                if self._wakeup[0] in readable:
+                    os.read(self._wakeup[0], 512)
+                if self._server in readable:
+                    self._accept()
+                for sock in writable:
+                    self._flush(sock)
+                for sock in readable:
+                    if sock not in (self._server, self._wakeup[0]):
+                        self._receive(sock)
+                commands = self._arbitrate()
+
+            if self.builder:
+                for command in commands:
+                    self._send(command)
+
+    def _send(self, command):
+        """
+        Writes a subscriber's command to the device. A command that cannot
+        be written is dropped, rather than ending the thread and with it
+        every subscription.
+
+        @param command: The command packet
+        @type command: hex
+        """
+        try:
+            self.builder.send_packet(command)
+        except (IOError, OSError, RuntimeError, ValueError) as e:
+            if self.on_error:
+                self.on_error(command, e)
+
+    def _accept(self):
+        """
+        Accepts a new subscriber. Must be called with the lock held.
+        """
+        try:
+            sock = self._server.accept()[0]
+        except socket.error:
+            return
+        sock.setblocking(False)
+        self._clients[sock] = _Client(sock)
+
+    def _flush(self, sock):
+        """
+        Writes queued packets to a subscriber. Must be called with the
+        lock held.
+
+        @param sock: The subscriber's socket
+        @type sock: socket.socket
+        """
+        client = self._clients.get(sock)
+        if not client:
+            return
+        try:
+            sent = sock.send(client.outgoing)
+        except socket.error as exc:
+            if exc.args[0] not in _retry_errors:
+                self._drop(client)
+            return
+        client.outgoing = client.outgoing[sent:]
+
+    def _receive(self, sock):
+        """
+        Reads commands from a subscriber. Must be called with the lock
+        held.
+
+        @param sock: The subscriber's socket
+        @type sock: socket.socket
+        """
+        client = self._clients.get(sock)
+        if not client:
+            return
+        try:
+            data = sock.recv(4096)
+        except socket.error as exc:
+            if exc.args[0] not in _retry_errors:
+                self._drop(client)
+            return
+        if not data:
+            self._drop(client)
+            return
+        client.incoming += data
+
+    def _arbitrate(self):
+        """
+        Takes buffered commands from each subscriber in turn, so a busy
+        subscriber cannot starve the others. Must be called with the
+        lock held.
+
+        @return: A list of command packets in the order to be written
+        """
+        commands = []
+        clients = list(self._clients.values())
+        while clients:
+            for client in list(clients):
+                try:
+                    command = client.next_command()
+                except ValueError:
+                    self._drop(client)
+                    command = None
+                if command is None:
+                    clients.remove(client)
+                else:
+                    commands.append(command)
+        return commands
+
+    def close(self):
+        """
+        Stops publishing, disconnects all subscribers and removes the
+        socket.
+        """
+        self.parser.remove_listener(self.publish)
+        self._thread_continue = False
+        self._wake()
+        if threading.current_thread() is not self:
+            self.join()
+        with self._lock:
+            for client in list(self._clients.values()):
+                self._drop(client)
+        self._server.close()
+        os.close(self._wakeup[0])
+        os.close(self._wakeup[1])
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class EventSubscriber(threading.Thread):
+    """
+    Receives the event stream from an EventPublisher in another process,
+    parsing only those events it has subscribed to.
+    """
+
+    def __init__(self, path, callback, subcodes=None, typed=False):
+        """
+        Initialises the class, connects and starts the thread
+
+        @param path: The filesystem path of the publisher's socket
+        @type path: string
+
+        @param callback: The method to call with each parsed packet
+        @type callback: <function>
+
+        @param subcodes: The HCI_LE_ExtEvent subcodes to deliver, such as
+            "0601". If not given, all events are delivered.
+        @type subcodes: list
+
+        @param typed: Whether typed fields should be decoded to native
+            values, as for BLEParser
+        @type typed: bool
+        """
+        super(EventSubscriber, self).__init__()
+        self.daemon = True
+        self._callback = callback
+        # compare against the raw subcode, as stored in the packet
+        self._subcodes = None
+        if subcodes is not None:
+            self._subcodes = set(
+                code.decode('hex')[::-1] for code in subcodes)
+        self._parser = BLEParser(typed=typed)
+        self._send_lock = threading.Lock()
+        self.builder = BLEBuilder(self)
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self.start()
+
+    def _wanted(self, packet):
+        """
+        Checks a raw packet against the subscription, without parsing.
+
+        @param packet: The raw event packet
+        @type packet: hex
+
+        @return: True if the packet should be delivered
+        """
+        if self._subcodes is None:
+            return True
+        return packet[1] == '\xff' and packet[3:5] in self._subcodes
+
+    def run(self):
+        """
+        Overrides threading.Thread.run(). Reads, filters and parses
+        events until the publisher goes away or 'stop' is called.
+        """
+        while True:
+            try:
+                data = self._sock.recv(65536)
+            except socket.error:
+                break
+            if not data:
+                break
+            self._parser._buffer += data
+            packet = self._parser._next_frame()
+            while packet:
+                if self._wanted(packet):
+                    response = self._parser._parse_frame(packet)
+                    if response is not None:
+                        self._callback(response)
+                packet = self._parser._next_frame()
+
+    def write(self, packet):
+        """
+        Sends a raw command packet to the publisher, to be written to
+        the device. This allows the subscriber to stand in for a serial
+        port in a BLEBuilder.
+
+        @param packet: The command packet
+        @type packet: hex
+        """
+        with self._send_lock:
+            self._sock.sendall(packet)
+
+    def send(self, cmd, **kwargs):
+        """
+        Constructs a HCI command and sends it to the publisher. Accepts
+        the same arguments as BLEBuilder.send.
+
+        @param cmd: The command to be written
+        @type cmd: hex
+
+        @return: A tuple containing the hex command string and a parsed
+            version of the string stored in a dictionary.
+        """
+        return self.builder.send(cmd, **kwargs)
+
+    def stop(self):
+        """
+        Disconnects from the publisher and stops the thread.
+        """
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        if threading.current_thread() is not self:
+            self.join()
+        self._sock.close()
@@ -0,0 +1,299 @@
+"""
+@fn ble_codecs.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Encoders and decoders for the typed fields found in the Texas
+    Instruments Bluetooth Low Energy Host-Controller-Interface (HCI)
+    packets. All multi-byte fields are transmitted little-endian.
+"""
+
+import numbers
+import struct
+import uuid
+
+# precompiled structs for the common integer widths
+_uint_structs = {
+    1: struct.Struct('<B'),
+    2: struct.Struct('<H'),
+    4: struct.Struct('<I'),
+    8: struct.Struct('<Q'),
+}
+
+_sint_structs = {
+    1: struct.Struct('<b'),
+    2: struct.Struct('<h'),
+    4: struct.Struct('<i'),
+    8: struct.Struct('<q'),
+}
+
+# the Bluetooth base UUID, used to expand 16-bit UUIDs
+BASE_UUID = uuid.UUID('00000000-0000-1000-8000-00805f9b34fb')
+
+
+def decode_uint(data):
+    """
+    Decodes a little-endian unsigned integer.
+
+    >>> decode_uint("\\x18\\x00")
+    24
+
+    @param data: The raw byte string
+    @type data: hex
+
+    @return: The decoded integer
+    """
+    try:
+        return _uint_structs[len(data)].unpack(data)[0]
+    except KeyError:
+        return int(data[::-1].encode('hex'), 16)
+
+
+def encode_uint(value, length):
+    """
+    Encodes an unsigned integer as a little-endian byte string.
+
+    >>> encode_uint(0x15, 1)
+    '\\x15'
+
+    @param value: The integer to encode
+    @type value: int
+
+    @param length: The number of bytes to produce
+    @type length: int
+
+    @return: The encoded byte string
+    """
+    if value < 0 or value >> (8 * length):
+        raise ValueError("The value %d does not fit in %d unsigned bytes"
+                         % (value, length))
+    try:
+        return _uint_structs[length].pack(value)
+    except KeyError:
+        return ('%x' % value).zfill(length * 2).decode('hex')[::-1]
+
+
+def decode_sint(data):
+    """
+    Decodes a little-endian two's complement signed integer.
+
+    >>> decode_sint("\\xc4")
+    -60
+
+    @param data: The raw byte string
+    @type data: hex
+
+    @return: The decoded integer
+    """
+    try:
+        return _sint_structs[len(data)].unpack(data)[0]
+    except KeyError:
+        value = decode_uint(data)
+        if value >> (8 * len(data) - 1):
+            value -= 1 << (8 * len(data))
+        return value
+
+
+def encode_sint(value, length):
+    """
+    Encodes a signed integer as a little-endian two's complement byte
+    string.
+
+    >>> encode_sint(-60, 1)
+    '\\xc4'
+
+    @param value: The integer to encode
+    @type value: int
+
+    @param length: The number of bytes to produce
+    @type length: int
+
+    @return: The encoded byte string
+    """
+    limit = 1 << (8 * length - 1)
+    if not -limit <= value < limit:
+        raise ValueError("The value %d does not fit in %d signed bytes"
+                         % (value, length))
+    try:
+        return _sint_structs[length].pack(value)
+    except KeyError:
+        return encode_uint(value % (limit << 1), length)
+
+
+def decode_addr(data):
+    """
+    Decodes a 48-bit device address into its canonical string form.
+
+    >>> decode_addr("\\x57\\x6a\\xe4\\x31\\x18\\x00")
+    '00:18:31:E4:6A:57'
+
+    @param data: The raw byte string
+    @type data: hex
+
+    @return: The address as a colon-separated string
+    """
+    return ':'.join('%02X' % ord(byte) for byte in data[::-1])
+
+
+def encode_addr(value, length=6):
+    """
+    Encodes a device address given either as an integer or in its
+    canonical string form.
+
+    >>> encode_addr("00:18:31:E4:6A:57")
+    '\\x57\\x6a\\xe4\\x31\\x18\\x00'
+    >>> encode_addr(0x001831E46A57)
+    '\\x57\\x6a\\xe4\\x31\\x18\\x00'
+
+    @param value: The address to encode
+    @type value: int or string
+
+    @param length: The number of bytes to produce
+    @type length: int
+
+    @return: The encoded byte string
+    """
+    if isinstance(value, numbers.Integral):
+        return encode_uint(value, length)
+    octets = value.replace('-', ':').split(':')
+    if len(octets) != length:
+        raise ValueError("'%s' is not a valid device address" % value)
+    return ''.join(octets).decode('hex')[::-1]
+
+
+def addr_to_int(value):
+    """
+    Converts a canonical address string to its 48-bit integer value.
+
+    >>> addr_to_int('00:18:31:E4:6A:57')
+    103916268119
+
+    @param value: The address as a colon-separated string
+    @type value: string
+
+    @return: The address as an integer
+    """
+    return int(value.replace(':', '').replace('-', ''), 16)
+
+
+def decode_uuid(data):
+    """
+    Decodes a UUID. 16-bit UUIDs are returned as integers while
+    128-bit UUIDs are returned as uuid.UUID instances.
+
+    >>> decode_uuid("\\x0a\\x18")
+    6154
+
+    @param data: The raw byte string
+    @type data: hex
+
+    @return: The decoded UUID
+    """
+    if len(data) == 16:
+        return uuid.UUID(bytes=data[::-1])
+    return decode_uint(data)
+
+
+def encode_uuid(value, length):
+    """
+    Encodes a UUID given as an integer, a uuid.UUID instance or its
+    string form. 128-bit UUIDs derived from the Bluetooth base UUID
+    are shortened when a 16-bit field is being encoded.
+
+    >>> encode_uuid(0x180a, 2)
+    '\\x0a\\x18'
+
+    @param value: The UUID to encode
+    @type value: int, uuid.UUID or string
+
+    @param length: The number of bytes to produce
+    @type length: int
+
+    @return: The encoded byte string
+    """
+    if isinstance(value, numbers.Integral):
+        if length == 16:
+            value = uuid.UUID(int=BASE_UUID.int | (value << 96))
+        else:
+            return encode_uint(value, length)
+    if not isinstance(value, uuid.UUID):
+        value = uuid.UUID(value)
+    if length == 16:
+        return value.bytes[::-1]
+    # only UUIDs built on the base UUID may be shortened
+    if value.int & ((1 << 96) - 1) != BASE_UUID.int:
+        raise ValueError("The UUID %s cannot be shortened to %d bytes"
+                         % (value, length))
+    return encode_uint(value.int >> 96, length)
+
+
+# field types understood by the builder and (optionally) the parser,
+# mapping the 'type' of a field definition to its (decoder, encoder)
+codecs = {
+    'uint': (decode_uint, encode_uint),
+    'sint': (decode_sint, encode_sint),
+    'addr': (decode_addr, encode_addr),
+    'uuid': (decode_uuid, encode_uuid),
+}
+
+
+def decode_field(field, data):
+    """
+    Decodes the raw data for a field according to its definition.
+    Fields without a type are returned as reversed hex strings, as the
+    parser has always done.
+
+    @param field: The field definition
+    @type field: dict
+
+    @param data: The raw byte string
+    @type data: hex
+
+    @return: The native value of the field
+    """
+    try:
+        decoder = codecs[field['type']][0]
+    except KeyError:
+        return data[::-1].encode('hex')
+    return decoder(data)
+
+
+def encode_field(field, value):
+    """
+    Encodes a native value for a field according to its definition.
+    Byte strings of the correct length are assumed to be raw data and
+    are returned unchanged.
+
+    @param field: The field definition
+    @type field: dict
+
+    @param value: The value to encode
+    @type value: int, string or uuid.UUID
+
+    @return: The raw byte string
+
+    @raise ValueError: If the value is None, or cannot be encoded
+    """
+    if value is None:
+        raise ValueError("No value was given for the field '%s'"
+                         % field['name'])
+
+    field_len = field['len']
+    if isinstance(value, str) and (
+            field_len is None or len(value) == field_len):
+        return value
+    if isinstance(value, str) and field.get('type') in ('uint', 'sint'):
+        # integers have no string form, hence this is raw data of the
+        # wrong length, reported by the caller
+        return value
+
+    try:
+        encoder = codecs[field['type']][1]
+    except KeyError:
+        # untyped fields only carry raw data, validated by the caller
+        return value
+    if field_len is None:
+        raise ValueError("The field '%s' is of variable length"
+                         % field['name'])
+    return encoder(value, field_len)
@@ -0,0 +1,470 @@
+"""
+@fn ble_init.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Device initialisation with a warm start. The state reported by
+    GAP_DeviceInitDone, and any GAP parameters configured, are cached for
+    each port. During a full initialisation a marker parameter is set to
+    a random value, which is lost if the device is reset. Later starts
+    read the marker back with a single GAP_GetParam and, if it still
+    matches, reuse the cached state rather than initialising again.
+"""
+
+import collections
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where the cache file is not locked
+    fcntl = None
+
+from pyblehci import ble_codecs
+from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_pending import PendingOperation
+
+
+class DeviceInit(PendingOperation):
+    """
+    The initialisation of a single device, awaiting completion.
+    """
+    # initialisation states
+    PENDING = 'pending'
+    COMPLETE = 'complete'
+    ERROR = 'error'
+    TIMEOUT = 'timeout'
+
+    def __init__(self, port, builder, parser, config, callback):
+        """
+        Initialises the class
+
+        @param port: The name of the device's port, used as the cache key
+        @type port: string
+
+        @param builder: The builder used to write commands
+        @type builder: BLEBuilder
+
+        @param parser: The parser providing events and timers
+        @type parser: BLEParser
+
+        @param config: The initialisation settings requested
+        @type config: dict
+
+        @param callback: The method to call once initialisation ends
+        @type callback: <function>
+        """
+        super(DeviceInit, self).__init__()
+        self.port = port
+        self.builder = builder
+        self.parser = parser
+        self.config = config
+        self.callback = callback
+        self.state = self.PENDING
+        # whether the cached state was reused
+        self.warm = False
+        # values reported by GAP_DeviceInitDone
+        self.device = None
+        # values of the parameters set or read
+        self.params = {}
+        self.response = None
+        # error raised while writing the cache file, if any
+        self.cache_error = None
+        self.timer = None
+        self._cached = None
+        self._checking = False
+        self._configuring = False
+        # commands awaiting a command status, in order sent
+        self._expected = collections.deque()
+
+
+class InitManager(object):
+    """
+    Initialises devices, skipping GAP_DeviceInit for devices whose cached
+    state is still current.
+    """
+    # GAP parameter used to detect a reset. This should be one that the
+    # device's role does not use, hence limited advertising for a
+    # central.
+    marker = 'TGAP_LIM_ADV_TIMEOUT'
+
+    def __init__(self, path, timeout=10.0, marker=None):
+        """
+        Initialises the class and loads the cache
+
+        @param path: The path of the JSON cache file
+        @type path: string
+
+        @param timeout: The time allowed for each initialisation
+        @type timeout: float
+
+        @param marker: The name of the GAP parameter used to detect a
+            reset, if not 'marker'
+        @type marker: string
+        """
+        self.path = path
+        self.timeout = timeout
+        if marker:
+            self.marker = marker
+        self._lock = threading.RLock()
+        self.cache = self._load()
+
+    def _load(self):
+        """
+        Reads the cache file.
+
+        @return: The cached state of each port
+        """
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, port):
+        """
+        Writes the cached state of a port to the cache file, replacing the
+        previous file atomically. Other processes may share the file,
+        hence it is read again under a lock and only this port's entry
+        replaced. The cache holds each device's IRK and CSRK, hence is
+        readable by its owner only. Must be called with the lock held.
+
+        @param port: The name of the port whose state changed
+        @type port: string
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        lock_fd = os.open(self.path + '.lock', os.O_WRONLY | os.O_CREAT,
+                          0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            cache = self._load()
+            if port in self.cache:
+                cache[port] = self.cache[port]
+            else:
+                cache.pop(port, None)
+
+            # created readable by its owner only
+            fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as cache_file:
+                    json.dump(cache, cache_file, indent=2, sort_keys=True)
+                os.rename(temp, self.path)
+            except Exception:
+                os.unlink(temp)
+                raise
+            self.cache = cache
+        finally:
+            # closing the file releases the lock
+            os.close(lock_fd)
+
+    def forget(self, port):
+        """
+        Removes a port from the cache, forcing a full initialisation the
+        next time.
+
+        @param port: The name of the port
+        @type port: string
+        """
+        with self._lock:
+            if self.cache.pop(port, None) is not None:
+                self._save(port)
+
+    def init(self, port, builder, parser, params=None, read=None,
+             callback=None, **kwargs):
+        """
+        Initialises a device, reusing its cached state if the device has
+        not been reset since that state was cached.
+
+        >>> init("/dev/ttyACM0", builder, parser,
+        ...      read=['TGAP_CONN_EST_INT_MIN'])
+        <pyblehci.ble_init.DeviceInit object at 0x...>
+
+        @param port: The name of the device's port, used as the cache key
+        @type port: string
+
+        @param builder: The builder used to write commands
+        @type builder: BLEBuilder
+
+        @param parser: The parser providing events and timers
+        @type parser: BLEParser
+
+        @param params: The GAP parameters to set, by name
+        @type params: dict
+
+        @param read: The names of GAP parameters to read
+        @type read: list
+
+        @param callback: The method to call, with the initialisation, once
+            it ends
+        @type callback: <function>
+
+        @param kwargs: The fields of GAP_DeviceInit
+
+        @return: The initialisation tracking the request
+        """
+        params = dict(params or {})
+        read = sorted(read or [])
+        for name in list(params) + read:
+            if name not in BLEBuilder.gap_params:
+                raise KeyError("Unrecognized GAP parameter '%s'" % name)
+        if self.marker in params or self.marker in read:
+            raise ValueError("The marker parameter %s may not be used" %
+                             self.marker)
+
+        fields = dict(
+            (field['name'], ble_codecs.encode_field(
+                field, kwargs.get(field['name'], field['default'])))
+            for field in BLEBuilder.hci_cmds["fe00"])
+        config = {
+            'init': dict((name, value.encode('hex'))
+                         for name, value in fields.items()),
+            'params': params,
+            'read': read,
+        }
+
+        request = DeviceInit(port, builder, parser, config, callback)
+        request._listener = lambda response: self.handle_event(
+            request, response)
+        parser.add_listener(request._listener)
+
+        with self._lock:
+            request.timer = parser.timers.schedule(
+                self.timeout, self._finish, request, DeviceInit.TIMEOUT)
+            cached = self.cache.get(port)
+            if cached and cached['config'] == config:
+                request._cached = cached
+                request._checking = True
+                self._send(request, "fe31", self.marker)
+            else:
+                self._full_init(request, fields)
+
+        return request
+
+    def init_all(self, devices, timeout=None, **kwargs):
+        """
+        Initialises several devices concurrently and waits for them all.
+
+        @param devices: The (builder, parser) tuple of each device, by
+            port name
+        @type devices: dict
+
+        @param timeout: The maximum time to wait for all of the devices,
+            in seconds
+        @type timeout: float
+
+        @param kwargs: Options for 'init', applied to every device
+
+        @return: The initialisation of each device, by port name
+        """
+        requests = dict(
+            (port, self.init(port, builder, parser, **kwargs))
+            for port, (builder, parser) in devices.items())
+        deadline = None if timeout is None else time.time() + timeout
+        for request in requests.values():
+            if deadline is None:
+                request.wait()
+            else:
+                request.wait(max(deadline - time.time(), 0))
+        return requests
+
+    def _send(self, request, cmd, param=None, **kwargs):
+        """
+        Writes a command for an initialisation. Must be called with the
+        lock held.
+
+        @param request: The initialisation
+        @type request: DeviceInit
+
+        @param cmd: The command to be written
+        @type cmd: hex
+
+        @param param: The name of the GAP parameter, if any
+        @type param: string
+
+        @param kwargs: The other fields of the command
+        """
+        request._expected.append((cmd, param))
+        if param is not None:
+            kwargs['param_id'] = BLEBuilder.gap_params[param]
+        request.builder.send(cmd, **kwargs)
+
+    def _full_init(self, request, fields=None):
+        """
+        Starts a full initialisation with GAP_DeviceInit. Must be called
+        with the lock held.
+
+        @param request: The initialisation
+        @type request: DeviceInit
+
+        @param fields: The raw fields of GAP_DeviceInit
+        @type fields: dict
+        """
+        if fields is None:
+            fields = dict((name, value.decode('hex')) for name, value in
+                          request.config['init'].items())
+        request._cached = None
+        request._checking = False
+        self._send(request, "fe00", **fields)
+
+    def _configure(self, request, packet):
+        """
+        Records the state reported by GAP_DeviceInitDone, then sets the
+        requested parameters and the marker and reads the others. Must
+        be called with the lock held.
+
+        @param request: The initialisation
+        @type request: DeviceInit
+
+        @param packet: The parsed GAP_DeviceInitDone event
+        @type packet: OrderedDict
+        """
+        request.device = {
+            'dev_addr': ble_codecs.decode_addr(packet['dev_addr'][0]),
+            'data_pkt_len': ble_codecs.decode_uint(
+                packet['data_pkt_len'][0]),
+            'num_data_pkts': ble_codecs.decode_uint(
+                packet['num_data_pkts'][0]),
+            'irk': packet['irk'][0].encode('hex'),
+            'csrk': packet['csrk'][0].encode('hex'),
+        }
+        request.params = dict(request.config['params'])
+        request.params[self.marker] = random.randint(1, 0xfffe)
+        request._configuring = True
+
+        for name, value in sorted(request.params.items()):
+            self._send(request, "fe30", name, param_value=value)
+        for name in request.config['read']:
+            self._send(request, "fe31", name)
+
+    def _complete(self, request):
+        """
+        Caches the state of a fully initialised device. This runs on the
+        parser's thread, hence a cache file that cannot be written is
+        recorded on the request rather than raised; the device is
+        initialised regardless, and only the next warm start is lost.
+        Must be called with the lock held.
+
+        @param request: The initialisation
+        @type request: DeviceInit
+        """
+        self.cache[request.port] = {
+            'config': request.config,
+            'device': request.device,
+            'params': request.params,
+        }
+        try:
+            self._save(request.port)
+        except (IOError, OSError) as e:
+            request.cache_error = e
+        request.params = dict(request.params)
+        del request.params[self.marker]
+
+    def _warm(self, request):
+        """
+        Reuses the cached state of a device. Must be called with the lock
+        held.
+
+        @param request: The initialisation
+        @type request: DeviceInit
+        """
+        # strings are loaded from the cache as unicode
+        request.warm = True
+        request.device = dict(
+            (str(name), str(value) if isinstance(value, basestring) else
+             value) for name, value in request._cached['device'].items())
+        request.params = dict(
+            (str(name), value) for name, value in
+            request._cached['params'].items() if name != self.marker)
+
+    def _finish(self, request, state, response=None):
+        """
+        Ends an initialisation and notifies the caller.
+
+        @param request: The initialisation to end
+        @type request: DeviceInit
+
+        @param state: The final state of the initialisation
+        @type state: string
+
+        @param response: The event that ended the initialisation, if any
+        @type response: OrderedDict
+        """
+        with self._lock:
+            if request.done():
+                return
+            request.state = state
+            request.response = response
+            request.timer.cancel()
+            request.parser.remove_listener(request._listener)
+            request._done.set()
+
+        if request.callback:
+            request.callback(request)
+
+    def handle_event(self, request, response):
+        """
+        Processes a parsed event, advancing an initialisation. A listener
+        calling this is registered on the device's parser for each
+        initialisation.
+
+        @param request: The initialisation
+        @type request: DeviceInit
+
+        @param response: The (data, parsed packet) tuple from the parser
+        @type response: tuple
+        """
+        codes = request.parser.event_codes(response)
+        if codes is None:
+            return
+        subcode, status, cmd = codes
+        success = status == '\x00'
+        packet = response[1]
+        state = None
+
+        with self._lock:
+            if request.done():
+                return
+
+            if subcode == "0600":
+                if request._configuring or request._checking:
+                    return
+                if not success:
+                    state = DeviceInit.ERROR
+                else:
+                    self._configure(request, packet)
+            elif subcode == "067f":
+                if not request._expected or request._expected[0][0] != cmd:
+                    return
+                cmd, param = request._expected.popleft()
+
+                if request._checking:
+                    value = None
+                    if success:
+                        value = ble_codecs.decode_uint(
+                            packet['param_value'][0])
+                    if value == request._cached['params'][self.marker]:
+                        self._warm(request)
+                        state = DeviceInit.COMPLETE
+                    else:
+                        # device was reset, hence initialise it again
+                        self._full_init(request)
+                elif not success:
+                    state = DeviceInit.ERROR
+                elif cmd == "fe31":
+                    request.params[param] = ble_codecs.decode_uint(
+                        packet['param_value'][0])
+
+                if request._configuring and not request._expected and \
+                        state is None:
+                    self._complete(request)
+                    state = DeviceInit.COMPLETE
+
+        if state is not None:
+            self._finish(request, state, packet)
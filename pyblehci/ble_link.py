@@ -0,0 +1,359 @@
+"""
+@fn ble_link.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Connection parameter negotiation. Tracks the parameters of each
+    link and moves links between named profiles using
+    GAP_UpdateLinkParamReq, confirming each change by the resulting
+    GAP_LinkParamUpdate event.
+"""
+
+import threading
+
+from pyblehci import ble_codecs
+from pyblehci.ble_pending import PendingOperation, StatusQueue
+
+# named connection parameter profiles. Intervals are in units of 1.25 ms,
+# latency in connection events and timeouts in units of 10 ms.
+link_profiles = {
+    'bulk throughput': {
+        'interval_min': 6, 'interval_max': 12,
+        'conn_latency': 0, 'conn_timeout': 200},
+    'low latency': {
+        'interval_min': 6, 'interval_max': 8,
+        'conn_latency': 0, 'conn_timeout': 100},
+    'low power': {
+        'interval_min': 80, 'interval_max': 160,
+        'conn_latency': 4, 'conn_timeout': 600},
+}
+
+
+def check_params(interval_min, interval_max, conn_latency, conn_timeout):
+    """
+    Validates a set of connection parameters against the limits of the
+    Bluetooth specification.
+
+    >>> check_params(6, 12, 0, 5)
+    Traceback (most recent call last):
+    ...
+    ValueError: The connection timeout must be between 10 and 3200
+
+    @param interval_min: The minimum connection interval
+    @type interval_min: int
+
+    @param interval_max: The maximum connection interval
+    @type interval_max: int
+
+    @param conn_latency: The slave latency
+    @type conn_latency: int
+
+    @param conn_timeout: The supervision timeout
+    @type conn_timeout: int
+    """
+    if not 6 <= interval_min <= interval_max <= 3200:
+        raise ValueError("The connection interval must satisfy "
+                         "6 <= interval_min <= interval_max <= 3200")
+    if not 0 <= conn_latency <= 499:
+        raise ValueError("The connection latency must be between 0 and 499")
+    if not 10 <= conn_timeout <= 3200:
+        raise ValueError("The connection timeout must be between 10 and 3200")
+    # the supervision timeout (10 ms units) must exceed the effective
+    # interval (1.25 ms units) twice over
+    if conn_timeout * 4 <= (1 + conn_latency) * interval_max:
+        raise ValueError("The connection timeout is too short for the "
+                         "interval and latency requested")
+
+
+class Link(object):
+    """
+    The current parameters of a single connection.
+    """
+
+    def __init__(self, conn_handle, dev_addr, conn_interval, conn_latency,
+                 conn_timeout):
+        """
+        Initialises the class
+
+        @param conn_handle: The connection handle
+        @type conn_handle: int
+
+        @param dev_addr: The address of the peer
+        @type dev_addr: string
+
+        @param conn_interval: The connection interval, in 1.25 ms units
+        @type conn_interval: int
+
+        @param conn_latency: The slave latency
+        @type conn_latency: int
+
+        @param conn_timeout: The supervision timeout, in 10 ms units
+        @type conn_timeout: int
+        """
+        self.conn_handle = conn_handle
+        self.dev_addr = dev_addr
+        self.conn_interval = conn_interval
+        self.conn_latency = conn_latency
+        self.conn_timeout = conn_timeout
+        self.profile = None
+        # parameters the link was established with, for 'restore'
+        self.initial = (conn_interval, conn_latency, conn_timeout)
+
+
+class LinkUpdate(PendingOperation):
+    """
+    A requested change of connection parameters, awaiting confirmation.
+    """
+    # update states
+    PENDING = 'pending'
+    COMPLETE = 'complete'
+    ERROR = 'error'
+    TIMEOUT = 'timeout'
+
+    def __init__(self, link, profile, params, callback):
+        """
+        Initialises the class
+
+        @param link: The link being updated
+        @type link: Link
+
+        @param profile: The name of the profile applied, if any
+        @type profile: string
+
+        @param params: The parameters requested
+        @type params: dict
+
+        @param callback: The method to call once the update ends
+        @type callback: <function>
+        """
+        super(LinkUpdate, self).__init__()
+        self.link = link
+        self.profile = profile
+        self.params = params
+        self.callback = callback
+        self.state = self.PENDING
+        self.response = None
+        self.timer = None
+
+
+class LinkManager(object):
+    """
+    Tracks established links and negotiates their parameters.
+    """
+
+    def __init__(self, builder, parser, timeout=10.0):
+        """
+        Initialises the class, registering with the parser for events
+
+        @param builder: The builder used to write commands
+        @type builder: BLEBuilder
+
+        @param parser: The parser providing events and timers
+        @type parser: BLEParser
+
+        @param timeout: The time to wait for an update to be confirmed
+        @type timeout: float
+        """
+        self.builder = builder
+        self.parser = parser
+        self.timeout = timeout
+        self.links = {}
+        self._lock = threading.RLock()
+        # outstanding update for each connection
+        self._pending = {}
+        # updates awaiting a command status, in order sent
+        self._unacked = StatusQueue()
+
+        parser.add_listener(self.handle_event)
+
+    def apply_profile(self, conn_handle, profile, callback=None):
+        """
+        Moves a link to one of the named profiles in 'link_profiles'.
+
+        >>> apply_profile(0, 'bulk throughput')
+        <pyblehci.ble_link.LinkUpdate object at 0x...>
+
+        @param conn_handle: The connection handle
+        @type conn_handle: int
+
+        @param profile: The name of the profile
+        @type profile: string
+
+        @param callback: The method to call, with the update, once the
+            update ends
+        @type callback: <function>
+
+        @return: The update tracking the request
+        """
+        try:
+            params = link_profiles[profile]
+        except KeyError:
+            raise KeyError("Unrecognized link profile '%s'" % profile)
+        return self.update(conn_handle, callback=callback, profile=profile,
+                           **params)
+
+    def restore(self, conn_handle, callback=None):
+        """
+        Returns a link to the parameters it was established with.
+
+        @param conn_handle: The connection handle
+        @type conn_handle: int
+
+        @param callback: The method to call, with the update, once the
+            update ends
+        @type callback: <function>
+
+        @return: The update tracking the request
+        """
+        interval, latency, timeout = self.links[conn_handle].initial
+        return self.update(conn_handle, interval, interval, latency,
+                           timeout, callback=callback)
+
+    def update(self, conn_handle, interval_min, interval_max, conn_latency,
+               conn_timeout, callback=None, profile=None):
+        """
+        Requests new parameters for a link. Only one update may be
+        outstanding on each link.
+
+        @param conn_handle: The connection handle
+        @type conn_handle: int
+
+        @param interval_min: The minimum connection interval
+        @type interval_min: int
+
+        @param interval_max: The maximum connection interval
+        @type interval_max: int
+
+        @param conn_latency: The slave latency
+        @type conn_latency: int
+
+        @param conn_timeout: The supervision timeout
+        @type conn_timeout: int
+
+        @param callback: The method to call, with the update, once the
+            update ends
+        @type callback: <function>
+
+        @param profile: The name of the profile being applied
+        @type profile: string
+
+        @return: The update tracking the request
+        """
+        check_params(interval_min, interval_max, conn_latency, conn_timeout)
+        params = {
+            'interval_min': interval_min, 'interval_max': interval_max,
+            'conn_latency': conn_latency, 'conn_timeout': conn_timeout}
+
+        with self._lock:
+            try:
+                link = self.links[conn_handle]
+            except KeyError:
+                raise KeyError("No link with handle %d" % conn_handle)
+            if conn_handle in self._pending:
+                raise RuntimeError(
+                    "An update is already pending for link %d" % conn_handle)
+
+            packet = self.builder._build_command(
+                "fe11", conn_handle=conn_handle, **params)[0]
+            update = LinkUpdate(link, profile, params, callback)
+            update.timer = self.parser.timers.schedule(
+                self.timeout, self._finish, update, LinkUpdate.TIMEOUT)
+            self._pending[conn_handle] = update
+            self._unacked.append(update)
+            try:
+                self.builder.send_packet(packet)
+            except Exception:
+                # never written, hence forget the update entirely
+                update.timer.cancel()
+                del self._pending[conn_handle]
+                self._unacked.discard(update)
+                raise
+
+        return update
+
+    def _finish(self, update, state, response=None):
+        """
+        Ends an update and notifies the caller.
+
+        @param update: The update to end
+        @type update: LinkUpdate
+
+        @param state: The final state of the update
+        @type state: string
+
+        @param response: The event that ended the update, if any
+        @type response: OrderedDict
+        """
+        with self._lock:
+            if update.done():
+                return
+            update.state = state
+            update.response = response
+            update.timer.cancel()
+            update._done.set()
+            if self._pending.get(update.link.conn_handle) is update:
+                del self._pending[update.link.conn_handle]
+            if state == LinkUpdate.COMPLETE:
+                update.link.profile = update.profile
+
+        if update.callback:
+            update.callback(update)
+
+    def handle_event(self, response):
+        """
+        Processes a parsed event, tracking links and confirming updates.
+        This is registered as a listener on the parser.
+
+        @param response: The (data, parsed packet) tuple from the parser
+        @type response: tuple
+        """
+        codes = self.parser.event_codes(response)
+        if codes is None:
+            return
+        subcode, status, cmd = codes
+        success = status == '\x00'
+        packet = response[1]
+
+        if subcode == "0605" and success:
+            conn_handle = ble_codecs.decode_uint(packet['conn_handle'][0])
+            with self._lock:
+                self.links[conn_handle] = Link(
+                    conn_handle,
+                    ble_codecs.decode_addr(packet['dev_addr'][0]),
+                    ble_codecs.decode_uint(packet['conn_interval'][0]),
+                    ble_codecs.decode_uint(packet['conn_latency'][0]),
+                    ble_codecs.decode_uint(packet['conn_timeout'][0]))
+        elif subcode == "0606" and success:
+            conn_handle = ble_codecs.decode_uint(packet['conn_handle'][0])
+            with self._lock:
+                self.links.pop(conn_handle, None)
+                update = self._pending.get(conn_handle)
+            if update:
+                self._finish(update, LinkUpdate.ERROR, packet)
+        elif subcode == "0607":
+            conn_handle = ble_codecs.decode_uint(packet['conn_handle'][0])
+            with self._lock:
+                link = self.links.get(conn_handle)
+                update = self._pending.get(conn_handle)
+                if link and success:
+                    link.conn_interval = ble_codecs.decode_uint(
+                        packet['conn_interval'][0])
+                    link.conn_latency = ble_codecs.decode_uint(
+                        packet['conn_latency'][0])
+                    link.conn_timeout = ble_codecs.decode_uint(
+                        packet['conn_timeout'][0])
+                    if not update:
+                        # changed by the peer, hence no longer our profile
+                        link.profile = None
+            if update:
+                self._finish(
+                    update, LinkUpdate.COMPLETE if success else
+                    LinkUpdate.ERROR, packet)
+        elif subcode == "067f":
+            if cmd != "fe11":
+                return
+            with self._lock:
+                update = self._unacked.pop()
+            if update is not None and not success:
+                self._finish(update, LinkUpdate.ERROR, packet)
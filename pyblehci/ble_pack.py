@@ -0,0 +1,241 @@
+"""
+@fn ble_pack.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about A compact binary serialisation of parsed packets, for shipping
+    them to other services.
+
+    A stream starts with a header listing the event subcodes known to
+    the writer, as given by BLEParser.ext_events. Each record is then the
+    index of the packet's subcode in that list, the status and the
+    packed fields, exactly as they appeared on the wire. Readers rebuild
+    the packet and parse it again, hence records round-trip exactly to
+    the structures returned by BLEParser.
+"""
+
+import struct
+
+from pyblehci.ble_parser import BLEParser
+
+MAGIC = 'BLEP'
+VERSION = 1
+
+# record id for packets stored whole, such as non-extension events
+RAW_RECORD = 0xff
+
+
+def _pack_fields(parsed_packet, structure):
+    """
+    Recovers the raw bytes of the fields of a parsed packet, in the
+    order given by the packet structure.
+
+    @param parsed_packet: The parsed packet
+    @type parsed_packet: OrderedDict
+
+    @param structure: The structure of the packet's event
+    @type structure: list
+
+    @return: The packed fields
+    """
+    payload = []
+    for field in structure:
+        try:
+            value = parsed_packet[field['name']]
+        except KeyError:
+            break
+        if isinstance(value, list):
+            # fields split by a parsing rule, such as a list of devices
+            for item in value:
+                payload.extend(raw for raw, _ in item.values())
+        else:
+            payload.append(value[0])
+    return ''.join(payload)
+
+
+class PacketWriter(object):
+    """
+    Writes parsed packets to a file like object as compact records.
+    """
+
+    def __init__(self, stream, ext_events=BLEParser.ext_events):
+        """
+        Initialises the class
+
+        @param stream: The file like object to write to
+        @type stream: file
+
+        @param ext_events: The schema of HCI_LE_ExtEvent packets
+        @type ext_events: dict
+        """
+        self.stream = stream
+        self.ext_events = ext_events
+        self._subcodes = sorted(ext_events)
+        if len(self._subcodes) >= RAW_RECORD:
+            raise ValueError("Too many event subcodes to pack")
+        # record ids, keyed by the raw subcode as stored in the packet
+        self._ids = dict(
+            (code.decode('hex'), index)
+            for index, code in enumerate(self._subcodes))
+        self._header_written = False
+
+    def _write_header(self):
+        self.stream.write(
+            MAGIC + struct.pack('<BB', VERSION, len(self._subcodes)) +
+            ''.join(code.decode('hex') for code in self._subcodes))
+        self._header_written = True
+
+    def pack(self, response):
+        """
+        Packs a single packet as a record.
+
+        >>> pack(("\\x04\\xff\\x08\\x7f\\x06\\x00\\x31\\xfe\\x02\\xd0\\x07",
+        ...       ...))
+        '\\x0c\\x00\\x05\\x31\\xfe\\x02\\xd0\\x07'
+
+        @param response: The (data, parsed packet) tuple from the parser.
+            The data may be None, in which case the record is packed from
+            the parsed packet.
+        @type response: tuple
+
+        @return: The packed record
+        """
+        data, parsed_packet = response
+
+        if data is not None:
+            if data[1] == '\xff' and data[3:5][::-1] in self._ids:
+                record_id = self._ids[data[3:5][::-1]]
+                return chr(record_id) + data[5] + \
+                    chr(len(data) - 6) + data[6:]
+            return chr(RAW_RECORD) + struct.pack('<H', len(data)) + data
+
+        subcode = parsed_packet['event'][0]
+        record_id = self._ids[subcode]
+        structure = self.ext_events[self._subcodes[record_id]]['structure']
+        payload = _pack_fields(parsed_packet, structure)
+        return chr(record_id) + parsed_packet['status'][0] + \
+            chr(len(payload)) + payload
+
+    def write(self, response):
+        """
+        Writes a single packet to the stream.
+
+        @param response: The (data, parsed packet) tuple from the parser
+        @type response: tuple
+        """
+        if not self._header_written:
+            self._write_header()
+        self.stream.write(self.pack(response))
+
+    def write_many(self, responses):
+        """
+        Writes a batch of packets to the stream in a single call.
+
+        @param responses: A list of (data, parsed packet) tuples
+        @type responses: list
+        """
+        if not self._header_written:
+            self._write_header()
+        self.stream.write(''.join(self.pack(r) for r in responses))
+
+
+class PacketReader(object):
+    """
+    Reads records written by a PacketWriter, returning the same
+    structures as BLEParser.
+    """
+
+    def __init__(self, stream, typed=False):
+        """
+        Initialises the class and reads the stream header. An empty
+        stream, as left by a writer that was given no packets, holds no
+        records.
+
+        @param stream: The file like object to read from
+        @type stream: file
+
+        @param typed: Whether typed fields should be decoded to native
+            values, as for BLEParser
+        @type typed: bool
+        """
+        self.stream = stream
+        self._parser = BLEParser(typed=typed)
+
+        header = self._read(len(MAGIC) + 2, start=True)
+        if not header:
+            self._subcodes = []
+            return
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a packed packet stream")
+        version, count = struct.unpack('<BB', header[len(MAGIC):])
+        if version != VERSION:
+            raise ValueError("Unsupported packed stream version %d" % version)
+        codes = self._read(count * 2)
+        # raw subcodes, in the byte order stored in the packet
+        self._subcodes = [codes[i:i + 2][::-1] for i in range(0, count * 2, 2)]
+
+    def _read(self, length, start=False):
+        """
+        Reads exactly 'length' bytes from the stream.
+
+        @param length: The number of bytes to read
+        @type length: int
+
+        @param start: Whether this is the start of the stream or of a
+            record, where the stream may end
+        @type start: bool
+
+        @return: The bytes read, or '' if the stream ended at the start
+        """
+        data = ''
+        while len(data) < length:
+            more = self.stream.read(length - len(data))
+            if not more:
+                break
+            data += more
+        if len(data) < length and (data or not start):
+            raise ValueError("Packed stream ended mid-record")
+        return data
+
+    def unpack(self, record_id, status, payload):
+        """
+        Rebuilds the packet for a record and parses it.
+
+        @return: A (data, parsed packet) tuple
+        """
+        if record_id == RAW_RECORD:
+            data = payload
+        elif record_id >= len(self._subcodes):
+            raise ValueError("Unknown packed record id %d" % record_id)
+        else:
+            data = '\x04\xff' + chr(len(payload) + 3) + \
+                self._subcodes[record_id] + status + payload
+        return self._parser._split_response(data)
+
+    def read(self):
+        """
+        Reads the next packet from the stream.
+
+        @return: A (data, parsed packet) tuple, or None at the end of the
+            stream
+        """
+        record_id = self._read(1, start=True)
+        if not record_id:
+            return None
+        record_id = ord(record_id)
+        if record_id == RAW_RECORD:
+            status = None
+            length = struct.unpack('<H', self._read(2))[0]
+        else:
+            status = self._read(1)
+            length = ord(self._read(1))
+        payload = self._read(length)
+        return self.unpack(record_id, status, payload)
+
+    def __iter__(self):
+        while True:
+            response = self.read()
+            if response is None:
+                break
+            yield response
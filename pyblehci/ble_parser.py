@@ -12,9 +12,14 @@
 from __future__ import print_function
 
 import collections
+import os
+import select
 import threading
 import time
 
+from pyblehci import ble_codecs
+from pyblehci import ble_timers
+
 
 class ThreadQuitException(Exception):
     """
@@ -46,6 +51,7 @@ class BLEParser(threading.Thread):
         "fe05": 'GATT_DeviceDiscoveryCancel',
         "fe09": 'GATT_EstablishLinkRequest',
         "fe0a": 'GATT_TerminateLinkRequest',
+        "fe11": 'GAP_UpdateLinkParamReq',
         "fe30": 'GAP_SetParam',
         "fe31": 'GAP_GetParam',
     }
@@ -62,17 +68,17 @@ class BLEParser(threading.Thread):
         "0501": {
             'name': 'ATT_ErrorRsp',
             'structure': [
-                {'name': 'conn_handle', 'len': 2},
-                {'name': 'pdu_len', 'len': 1},
-                {'name': 'req_op_code', 'len': 1},
-                {'name': 'handle', 'len': 2},
-                {'name': 'error_code', 'len': 1}]},
+                {'name': 'conn_handle', 'len': 2, 'type': 'uint'},
+                {'name': 'pdu_len', 'len': 1, 'type': 'uint'},
+                {'name': 'req_op_code', 'len': 1, 'type': 'uint'},
+                {'name': 'handle', 'len': 2, 'type': 'uint'},
+                {'name': 'error_code', 'len': 1, 'type': 'uint'}]},
         "0509": {
             'name': 'ATT_ReadByTypeRsp',
             'structure': [
-                {'name': 'conn_handle', 'len': 2},
-                {'name': 'pdu_len', 'len': 1},
-                {'name': 'length', 'len': 1},
+                {'name': 'conn_handle', 'len': 2, 'type': 'uint'},
+                {'name': 'pdu_len', 'len': 1, 'type': 'uint'},
+                {'name': 'length', 'len': 1, 'type': 'uint'},
                 {'name': 'results', 'len': None}],
             'parsing': [
                 ('results', lambda ble, original:
@@ -80,39 +86,39 @@ class BLEParser(threading.Thread):
         "050b": {
             'name': 'ATT_ReadRsp',
             'structure': [
-                {'name': 'conn_handle', 'len': 2},
-                {'name': 'pdu_len', 'len': 1},
+                {'name': 'conn_handle', 'len': 2, 'type': 'uint'},
+                {'name': 'pdu_len', 'len': 1, 'type': 'uint'},
                 {'name': 'value', 'len': None}]},
         "050f": {
             'name': 'ATT_ReadMultiRsp',
             'structure': [
-                {'name': 'conn_handle', 'len': 2},
-                {'name': 'pdu_len', 'len': 1},
+                {'name': 'conn_handle', 'len': 2, 'type': 'uint'},
+                {'name': 'pdu_len', 'len': 1, 'type': 'uint'},
                 {'name': 'results', 'len': None}]},
         "0513": {
             'name': 'ATT_WriteRsp',
             'structure': [
-                {'name': 'conn_handle', 'len': 2},
-                {'name': 'pdu_len', 'len': 1}]},
+                {'name': 'conn_handle', 'len': 2, 'type': 'uint'},
+                {'name': 'pdu_len', 'len': 1, 'type': 'uint'}]},
         "051b": {
             'name': 'ATT_HandleValueNotification',
             'structure': [
-                {'name': 'conn_handle', 'len': 2},
-                {'name': 'pdu_len', 'len': 1},
-                {'name': 'handle', 'len': 2},
+                {'name': 'conn_handle', 'len': 2, 'type': 'uint'},
+                {'name': 'pdu_len', 'len': 1, 'type': 'uint'},
+                {'name': 'handle', 'len': 2, 'type': 'uint'},
                 {'name': 'values', 'len': None}]},
         "0600": {
             'name': 'GAP_DeviceInitDone',
             'structure': [
-                {'name': 'dev_addr', 'len': 6},
-                {'name': 'data_pkt_len', 'len': 2},
-                {'name': 'num_data_pkts', 'len': 1},
+                {'name': 'dev_addr', 'len': 6, 'type': 'addr'},
+                {'name': 'data_pkt_len', 'len': 2, 'type': 'uint'},
+                {'name': 'num_data_pkts', 'len': 1, 'type': 'uint'},
                 {'name': 'irk', 'len': 16},
                 {'name': 'csrk', 'len': 16}]},
         "0601": {
             'name': 'GAP_DeviceDiscoveryDone',
             'structure': [
-                {'name': 'num_devs', 'len': 1},
+                {'name': 'num_devs', 'len': 1, 'type': 'uint'},
                 {'name': 'devices', 'len': None}],
             'parsing': [
                 ('devices', lambda ble, original:
@@ -120,39 +126,48 @@ class BLEParser(threading.Thread):
         "0605": {
             'name': 'GAP_EstablishLink',
             'structure': [
-                {'name': 'dev_addr_type', 'len': 1},
-                {'name': 'dev_addr', 'len': 6},
-                {'name': 'conn_handle', 'len': 2},
-                {'name': 'conn_interval', 'len': 2},
-                {'name': 'conn_latency', 'len': 2},
-                {'name': 'conn_timeout', 'len': 2},
-                {'name': 'clock_accuracy', 'len': 1}]},
+                {'name': 'dev_addr_type', 'len': 1, 'type': 'uint'},
+                {'name': 'dev_addr', 'len': 6, 'type': 'addr'},
+                {'name': 'conn_handle', 'len': 2, 'type': 'uint'},
+                {'name': 'conn_interval', 'len': 2, 'type': 'uint'},
+                {'name': 'conn_latency', 'len': 2, 'type': 'uint'},
+                {'name': 'conn_timeout', 'len': 2, 'type': 'uint'},
+                {'name': 'clock_accuracy', 'len': 1, 'type': 'uint'}]},
         "060d": {
             'name': 'GAP_DeviceInformation',
             'structure': [
-                {'name': 'event_type', 'len': 1},
-                {'name': 'addr_type', 'len': 1},
-                {'name': 'addr', 'len': 6},
-                {'name': 'rssi', 'len': 1},
-                {'name': 'data_len', 'len': 1},
+                {'name': 'event_type', 'len': 1, 'type': 'uint'},
+                {'name': 'addr_type', 'len': 1, 'type': 'uint'},
+                {'name': 'addr', 'len': 6, 'type': 'addr'},
+                {'name': 'rssi', 'len': 1, 'type': 'sint'},
+                {'name': 'data_len', 'len': 1, 'type': 'uint'},
                 {'name': 'data_field', 'len': None}]},
         "0606": {
             'name': 'GAP_LinkTerminated',
             'structure': [
-                {'name': 'conn_handle', 'len': 2},
-                {'name': 'reason', 'len': 1}]},
+                {'name': 'conn_handle', 'len': 2, 'type': 'uint'},
+                {'name': 'reason', 'len': 1, 'type': 'uint'}]},
+        "0607": {
+            'name': 'GAP_LinkParamUpdate',
+            'structure': [
+                {'name': 'conn_handle', 'len': 2, 'type': 'uint'},
+                {'name': 'conn_interval', 'len': 2, 'type': 'uint'},
+                {'name': 'conn_latency', 'len': 2, 'type': 'uint'},
+                {'name': 'conn_timeout', 'len': 2, 'type': 'uint'}]},
         "067f": {
             'name': 'GAP_HCI_ExtensionCommandStatus',
             'structure': [
                 {'name': 'op_code', 'len': 2},
-                {'name': 'data_len', 'len': 1},
+                {'name': 'data_len', 'len': 1, 'type': 'uint'},
                 {'name': 'param_value', 'len': None}],
             'parsing': [
                 ('op_code', lambda ble, original:
                  ble._parse_opcodes(original['op_code']))]},
     }
 
-    def __init__(self, ser=None, callback=None):
+    def __init__(self, ser=None, callback=None, typed=False, batch=False,
+                 batch_size=None, batch_window=None, unparsed=None,
+                 on_error=None):
         """
         Initialises the class
 
@@ -161,12 +176,72 @@ class BLEParser(threading.Thread):
 
         @param callback: The callback method
         @type callback: <function>
+
+        @param typed: Whether typed fields should be decoded to native
+            values (integers, address strings, UUIDs) rather than hex
+        @type typed: bool
+
+        @param batch: Whether the callback should be called once per read
+            with a list of parsed packets, rather than once per packet
+        @type batch: bool
+
+        @param batch_size: The maximum number of packets in a batch
+        @type batch_size: int
+
+        @param batch_window: The time, in seconds, to keep collecting
+            packets after the first packet of a batch arrives. If not
+            given, a batch holds the packets from a single read.
+        @type batch_window: float
+
+        @param unparsed: The method to call with the raw packet and the
+            error raised, for packets that are unknown or malformed. Such
+            packets are otherwise skipped.
+        @type unparsed: <function>
+
+        @param on_error: The method to call with the parsed packet, or None
+            for a timer, and the error raised by a listener, the callback
+            or a timer callback. Such errors are otherwise discarded.
+        @type on_error: <function>
         """
         super(BLEParser, self).__init__()
         self.serial_port = ser
+        self.typed = typed
+        self.batch = batch
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.timers = ble_timers.TimerWheel()
+        self.timers.on_error = self._timer_error
+        self._listeners = []
         self._callback = None
+        self._unparsed = unparsed
+        self._on_error = on_error
+        # counts of packets parsed, quarantined, bytes discarded while
+        # resynchronising and errors raised by listeners and timers
+        self.stats = {'parsed': 0, 'unknown': 0, 'malformed': 0,
+                      'dropped': 0, 'errors': 0}
+        # event codes and subcodes seen without a matching packet format
+        self.unknown_codes = collections.Counter()
         self._thread_continue = False
+        # set while a consumer is pulling batches with 'iter_batches'
+        self._pulling = False
         self._stop = threading.Event()
+        # bytes read from the serial port but not yet returned as a frame
+        self._buffer = ''
+        # ports that reconnect, such as socket transports, count their
+        # connections. A new connection starts a new stream of bytes.
+        self._generation = getattr(ser, 'reconnects', None)
+        # ports exposing a file descriptor are waited on with select, and
+        # the reader woken through a self-pipe. Others are polled.
+        self._fileno = None
+        self._wakeup = None
+        try:
+            self._fileno = ser.fileno()
+            self._wakeup = os.pipe()
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+        else:
+            # deadlines scheduled from other threads must interrupt a wait
+            self.timers.wakeup = self._wake
 
         if callback:
             self._callback = callback
@@ -180,17 +255,143 @@ class BLEParser(threading.Thread):
         """
         while True:
             try:
-                self._callback(self.wait_read())
+                if self.batch:
+                    responses = self.wait_read_batch()
+                    for listener in self._listeners:
+                        for response in responses:
+                            self._deliver(listener, response)
+                    self._deliver(self._callback, responses)
+                    continue
+                response = self.wait_read()
+                for listener in self._listeners:
+                    self._deliver(listener, response)
+                self._deliver(self._callback, response)
             except ThreadQuitException:
                 break
 
+    def _deliver(self, method, response):
+        """
+        Passes parsed packets to a listener or the callback. An error
+        raised is counted and passed to 'on_error', rather than ending
+        the reader.
+
+        @param method: The listener or callback
+        @type method: <function>
+
+        @param response: The parsed packet, or list of parsed packets
+        @type response: tuple or list
+        """
+        try:
+            method(response)
+        except ThreadQuitException:
+            raise
+        except Exception as e:
+            self._error(response, e)
+
+    def _timer_error(self, timer, error):
+        """
+        Handles an error raised by a timer callback fired by the reader.
+
+        @param timer: The timer that fired
+        @type timer: Timer
+
+        @param error: The error raised
+        @type error: Exception
+        """
+        self._error(None, error)
+
+    def _error(self, response, error):
+        """
+        Counts an error raised while handling packets or timers and passes
+        it to 'on_error'.
+
+        @param response: The parsed packet, or None for a timer
+        @type response: tuple
+
+        @param error: The error raised
+        @type error: Exception
+        """
+        self.stats['errors'] += 1
+        if self._on_error:
+            self._on_error(response, error)
+
+    def event_codes(self, response):
+        """
+        Extracts the codes of a parsed HCI_LE_ExtEvent, as needed by the
+        helpers that track the event stream.
+
+        >>> event_codes(response)
+        ("067f", "\\x00", "fe04")
+
+        @param response: The (data, parsed packet) tuple from the parser
+        @type response: tuple
+
+        @return: The event subcode, the raw status byte and, for a command
+            status, the command; or None if the packet is not an extended
+            event
+        """
+        packet = response[1]
+        if 'event' not in packet:
+            return None
+        # event subcode is stored as a raw, big-endian byte string
+        subcode = packet['event'][0].encode('hex')
+        cmd = None
+        if 'op_code' in packet:
+            # op_code is a raw, little-endian byte string
+            cmd = packet['op_code'][0][::-1].encode('hex')
+        return subcode, packet['status'][0], cmd
+
+    def add_listener(self, listener):
+        """
+        Registers a method to be called with each parsed packet, before
+        the callback. Used by helpers that track the event stream, such
+        as ATTTransactions.
+
+        @param listener: The method to call
+        @type listener: <function>
+        """
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        """
+        Unregisters a method previously passed to 'add_listener'.
+
+        @param listener: The method to remove
+        @type listener: <function>
+        """
+        self._listeners = [l for l in self._listeners if l != listener]
+
     def stop(self):
         """
-        Stops the thread and closes the serial port
+        Stops the thread and closes the serial port. If called from
+        another thread, this will wait for the reader to finish.
         """
         self._thread_continue = False
+        if self._wakeup:
+            os.write(self._wakeup[1], 'x')
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
         self.serial_port.close()
         self._stop.set()
+        # the reader is gone, hence the self-pipe may be released
+        if self._wakeup and not self.is_alive() and not self._pulling:
+            os.close(self._wakeup[0])
+            os.close(self._wakeup[1])
+            self._wakeup = None
+            self._fileno = None
+
+    def _wake(self):
+        """
+        Wakes the reader from a wait on the port, so that it recomputes
+        the time to wait until the next deadline.
+        """
+        wakeup = self._wakeup
+        if wakeup:
+            try:
+                os.write(wakeup[1], 'x')
+            except OSError:
+                # released by 'stop'
+                pass
 
     def stopped(self):
         """
@@ -211,25 +412,107 @@ class BLEParser(threading.Thread):
         # loop forever...
         while True:
             #...unless told not to by setting "_thread_continue" to false
-            if self._callback and not self._thread_continue:
-                raise ThreadQuitException
+            self._check_quit()
+
+            # fire any deadlines that have passed
+            self.timers.advance()
+
+            # return any frame already buffered by a previous read
+            packet = self._next_frame()
+            if packet:
+                return packet
 
-            # prevent blocking the port by waiting a given time
-            # TODO. Remove this? Asynchronous read-write possible
+            # block until the port is readable, the next deadline passes or
+            # we are woken by 'stop'
+            if self._wait_readable(self.timers.next_timeout()):
+                self._read_available()
+
+    def _check_quit(self):
+        """
+        Raises ThreadQuitException if a threaded or pulling reader has
+        been told to stop.
+        """
+        if (self._callback or self._pulling) and not self._thread_continue:
+            raise ThreadQuitException
+
+    def _read_available(self):
+        """
+        Reads everything available on the serial port, in a single call,
+        into the read buffer.
+        """
+        try:
+            waiting = self.serial_port.inWaiting()
+            data = self.serial_port.read(max(waiting, 1))
+        except (IOError, OSError, ValueError):
+            # port was closed underneath us, hence quit if stopping
+            self._check_quit()
+            raise
+
+        # the port reconnected, hence discard any partial packet left
+        # from the old connection rather than join it to the new stream
+        generation = getattr(self.serial_port, 'reconnects', None)
+        if generation != self._generation:
+            self._generation = generation
+            self.stats['dropped'] += len(self._buffer)
+            self._buffer = ''
+        self._buffer += data
+
+    def _wait_readable(self, timeout):
+        """
+        Waits for data to arrive on the serial port. Ports without a file
+        descriptor fall back to polling.
+
+        @param timeout: The maximum time to wait, in seconds, or None to
+            wait indefinitely
+        @type timeout: float
+
+        @return: True if the port is readable
+        """
+        # prevent blocking the port by waiting a given time
+        if self._fileno is None:
             if self.serial_port.inWaiting() == 0:
                 time.sleep(.01)
-                continue
-
-            # length byte is stored as the third byte in an event packet
-            packet = self.serial_port.read(3)
-            # convert this to decimal...
-            data_len = int(packet[2].encode('hex'), 16)
+                return False
+            return True
 
-            #...and retrieve that many bytes from the serial port
-            for _ in range(0, data_len):
-                packet += self.serial_port.read()
+        try:
+            readable = select.select(
+                [self._fileno, self._wakeup[0]], [], [], timeout)[0]
+        except (select.error, ValueError):
+            # port was closed underneath us, hence quit if stopping
+            self._check_quit()
+            raise
+
+        if self._wakeup[0] in readable:
+            os.read(self._wakeup[0], 512)
+        return self._fileno in readable
+
+    def _next_frame(self):
+        """
+        Removes a complete HCI packet from the read buffer.
 
-            return packet
+        @return: A byte string of the correct length, or None if no
+            complete packet has been buffered
+        """
+        # event packets start with their packet type, hence discard
+        # anything else to resynchronise with the stream
+        if self._buffer[:1] not in ('', '\x04'):
+            start = self._buffer.find('\x04')
+            if start < 0:
+                start = len(self._buffer)
+            self.stats['dropped'] += start
+            self._buffer = self._buffer[start:]
+
+        # length byte is stored as the third byte in an event packet
+        if len(self._buffer) < 3:
+            return None
+        length = 3 + ord(self._buffer[2])
+        if len(self._buffer) < length:
+            return None
+
+        packet = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        return packet
 
     def _split_response(self, data):
         """
@@ -291,9 +574,9 @@ class BLEParser(threading.Thread):
             except AttributeError:
                 raise NotImplementedError("Error with Attribute")
             except KeyError:
-                print(data.encode('hex'))
                 raise KeyError("Unrecognized response packet with event" +
-                               " type {0}".format(data[3:5][::-1]))
+                               " type {0}".format(
+                                   event_subcode.encode('hex')))
 
             event_subcode_parsed = subpacket['name']
             event_status_parsed = event_status.encode('hex')
@@ -313,7 +596,21 @@ class BLEParser(threading.Thread):
                 if field['len'] is not None:
                     # store the number of bytes specified in the dictionary
                     field_data = data[index:(index + field['len'])]
-                    field_data_parsed = field_data[::-1].encode('hex')
+                    # events reporting a failure, or the end of a
+                    # procedure, omit the fields that follow
+                    if not field_data and event_status != '\x00':
+                        break
+                    # a packet cut short would otherwise leave empty fields
+                    if len(field_data) != field['len']:
+                        raise ValueError(
+                            "Response packet was shorter than expected; " +
+                            "'%s' expected: %d, got: %d bytes" % (
+                                field_name, field['len'], len(field_data)))
+                    if self.typed:
+                        field_data_parsed = ble_codecs.decode_field(
+                            field, field_data)
+                    else:
+                        field_data_parsed = field_data[::-1].encode('hex')
                     # store result
                     parsed_packet[field_name] = (field_data, field_data_parsed)
                     # increment index for next field
@@ -402,9 +699,14 @@ class BLEParser(threading.Thread):
             addr_type = device[1]
             addr = device[2:9]
 
-            event_type_parsed = event_type.encode('hex')
-            addr_type_parsed = addr_type.encode('hex')
-            addr_parsed = addr[::-1].encode('hex')
+            if self.typed:
+                event_type_parsed = ble_codecs.decode_uint(event_type)
+                addr_type_parsed = ble_codecs.decode_uint(addr_type)
+                addr_parsed = ble_codecs.decode_addr(addr)
+            else:
+                event_type_parsed = event_type.encode('hex')
+                addr_type_parsed = addr_type.encode('hex')
+                addr_parsed = addr[::-1].encode('hex')
 
             # store the parsed device as an ordered dictionary (order once again
             # important)
@@ -444,7 +746,10 @@ class BLEParser(threading.Thread):
             handle = result[0:2]
             data = result[2:9]
 
-            handle_parsed = handle[::-1].encode('hex')
+            if self.typed:
+                handle_parsed = ble_codecs.decode_uint(handle)
+            else:
+                handle_parsed = handle[::-1].encode('hex')
             data_parsed = data[::-1].encode('hex')
 
             # store the parsed result as an ordered dictionary (order once again
@@ -466,5 +771,129 @@ class BLEParser(threading.Thread):
         @return: A parsed version of the packet received on the serial
             port
         """
-        packet = self._wait_for_frame()
-        return self._split_response(packet)
+        while True:
+            response = self._parse_frame(self._wait_for_frame())
+            if response is not None:
+                return response
+
+    def _unknown_code(self, packet):
+        """
+        Finds the event code, or subcode for HCI_LE_ExtEvent, of a packet
+        that has no matching packet format.
+
+        @param packet: The packet
+        @type packet: hex
+
+        @return: The hex encoded code, or None if the packet format is
+            known
+        """
+        event_code = packet[1:2].encode('hex')
+        if event_code not in self.hci_events:
+            return event_code
+        if event_code == "ff":
+            subcode = packet[3:5][::-1].encode('hex')
+            if subcode not in self.ext_events:
+                return subcode
+        return None
+
+    def _parse_frame(self, packet):
+        """
+        Parses a single packet, quarantining it if it is unknown or
+        malformed rather than raising. Quarantined packets are counted
+        and passed to the 'unparsed' handler.
+
+        @param packet: The packet
+        @type packet: hex
+
+        @return: A parsed version of the packet, or None
+        """
+        try:
+            response = self._split_response(packet)
+        except (KeyError, ValueError, IndexError, NotImplementedError) as e:
+            error = e
+        else:
+            self.stats['parsed'] += 1
+            return response
+
+        code = self._unknown_code(packet)
+        if code is not None:
+            self.stats['unknown'] += 1
+            self.unknown_codes[code] += 1
+        else:
+            self.stats['malformed'] += 1
+        if self._unparsed:
+            self._unparsed(packet, error)
+        return None
+
+    def wait_read_batch(self):
+        """
+        Waits for at least one packet and returns every packet that
+        arrived in the same read, or within 'batch_window' seconds of the
+        first, up to 'batch_size' packets.
+
+        @return: A list of parsed versions of the packets received on the
+            serial port
+        """
+        while True:
+            responses = [
+                response for response in map(self._parse_frame,
+                                              self._read_batch())
+                if response is not None]
+            if responses:
+                return responses
+
+    def _read_batch(self):
+        """
+        Waits for at least one packet and reads a batch, as described by
+        'wait_read_batch', without parsing.
+
+        @return: A list of packets
+        """
+        packets = [self._wait_for_frame()]
+        size = self.batch_size
+        deadline = None
+        if self.batch_window:
+            deadline = time.time() + self.batch_window
+
+        while size is None or len(packets) < size:
+            # take everything already buffered
+            packet = self._next_frame()
+            if packet:
+                packets.append(packet)
+                continue
+            if deadline is None:
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            self._check_quit()
+            next_timeout = self.timers.next_timeout()
+            if next_timeout is not None:
+                remaining = min(remaining, next_timeout)
+            if self._wait_readable(remaining):
+                self._read_available()
+            self.timers.advance()
+
+        return packets
+
+    def iter_batches(self):
+        """
+        Yields batches of parsed packets, as returned by
+        'wait_read_batch', for consumers that pull rather than use a
+        callback. Iteration ends once 'stop' is called.
+
+        >>> for batch in parser.iter_batches():
+        ...     db.insert_many(batch)
+
+        @return: A generator of lists of parsed packets
+        """
+        self._pulling = True
+        self._thread_continue = True
+        try:
+            while True:
+                yield self.wait_read_batch()
+        except ThreadQuitException:
+            return
+        finally:
+            self._pulling = False
@@ -0,0 +1,107 @@
+"""
+@fn ble_pending.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Building blocks shared by the helpers that track operations on a
+    device: an operation which callers may poll or wait on, and the queue
+    of operations whose command awaits its command status.
+"""
+
+import collections
+import threading
+
+
+class PendingOperation(object):
+    """
+    An operation that ends once the device has answered, or given up.
+    """
+
+    def __init__(self):
+        """
+        Initialises the class
+        """
+        self._done = threading.Event()
+
+    def done(self):
+        """
+        Getter method for the operation state
+
+        @return: True if the operation has ended
+        """
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the operation has ended.
+
+        @param timeout: The maximum time to wait, in seconds
+        @type timeout: float
+
+        @return: True if the operation has ended
+        """
+        self._done.wait(timeout)
+        return self.done()
+
+
+class StatusQueue(object):
+    """
+    Operations whose command awaits a GAP_HCI_ExtentionCommandStatus, in
+    the order sent. The device answers commands in order, hence each
+    status belongs to the oldest operation that sent the same command.
+    Callers hold their own lock around each use.
+    """
+
+    def __init__(self):
+        """
+        Initialises the class
+        """
+        self._queue = collections.deque()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def append(self, operation):
+        """
+        Adds an operation whose command is about to be written.
+
+        @param operation: The operation
+        @type operation: PendingOperation
+        """
+        # drop operations that ended without their status being seen
+        while self._queue and self._queue[0].done():
+            self._queue.popleft()
+        self._queue.append(operation)
+
+    def discard(self, operation):
+        """
+        Removes an operation whose command was never written.
+
+        @param operation: The operation
+        @type operation: PendingOperation
+        """
+        try:
+            self._queue.remove(operation)
+        except ValueError:
+            pass
+
+    def pop(self, match=None):
+        """
+        Removes and returns the operation a command status belongs to.
+
+        @param match: The method to call with each operation, oldest
+            first, returning True for an operation that sent the command.
+            If None, the oldest operation is returned.
+        @type match: <function>
+
+        @return: The operation, or None if there is none
+        """
+        for operation in self._queue:
+            if match is None or match(operation):
+                self._queue.remove(operation)
+                return operation
+        return None
@@ -0,0 +1,265 @@
+"""
+@fn ble_proxy.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about A transparent proxy for sniffing a live HostTestRelease session.
+    Bytes are forwarded unchanged between a host tool and the device as
+    soon as they are read, while a separate thread splits and decodes
+    the copied stream, keeping decoding off the forwarding path.
+"""
+
+import os
+import select
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_parser import BLEParser
+
+
+def _frame_length(data):
+    """
+    Calculates the total length of the HCI packet at the start of a
+    buffer, based on the packet type.
+
+    >>> _frame_length("\\x01\\x31\\xfe\\x01\\x15")
+    5
+
+    @param data: The buffered bytes
+    @type data: hex
+
+    @return: The length of the packet, None if not enough bytes have been
+        buffered to tell, or 0 if the packet type is not recognised
+    """
+    packet_type = data[0]
+    if packet_type == '\x01':
+        # command: type, 2 byte op code, 1 byte length
+        header, length = 4, data[3:4]
+    elif packet_type == '\x04':
+        # event: type, event code, 1 byte length
+        header, length = 3, data[2:3]
+    elif packet_type == '\x02':
+        # ACL data: type, 2 byte handle, 2 byte little-endian length
+        header, length = 5, data[3:5][::-1]
+    else:
+        return 0
+    if len(data) < header:
+        return None
+    return header + int(length.encode('hex'), 16)
+
+
+class BLEProxy(object):
+    """
+    Sits between a host tool and a BLE device, forwarding bytes in both
+    directions and delivering decoded packets to a callback.
+    """
+    # directions of traffic
+    FROM_HOST = 'host'
+    FROM_DEVICE = 'device'
+
+    def __init__(self, host, device, callback=None, typed=False,
+                 on_error=None):
+        """
+        Initialises the class and starts forwarding
+
+        @param host: The file like port connected to the host tool, such
+            as one end of a pty. Ports without a file descriptor must
+            have a read timeout set.
+        @type host: serial.Serial
+
+        @param device: The file like serial port of the BLE device
+        @type device: serial.Serial
+
+        @param callback: The method to call with the direction, the time
+            the bytes were forwarded and a (data, parsed packet) tuple.
+            Packets that cannot be decoded are delivered with a parsed
+            packet of None.
+        @type callback: <function>
+
+        @param typed: Whether typed event fields should be decoded to
+            native values, as for BLEParser
+        @type typed: bool
+
+        @param on_error: The method to call with the direction and the
+            error raised by the callback, or by a port. Errors raised by
+            the callback are otherwise discarded, while an error raised
+            by a port stops forwarding in both directions.
+        @type on_error: <function>
+        """
+        self.host = host
+        self.device = device
+        self._callback = callback
+        self._on_error = on_error
+        # error raised by a port, which stopped forwarding
+        self.error = None
+        self._builder = BLEBuilder()
+        self._parser = BLEParser(typed=typed)
+        self._queue = queue.Queue()
+        self._thread_continue = True
+        self._wakeup = os.pipe()
+        self.stats = {self.FROM_HOST: 0, self.FROM_DEVICE: 0, 'dropped': 0,
+                      'errors': 0}
+
+        self._threads = [
+            threading.Thread(target=self._forward,
+                             args=(host, device, self.FROM_HOST)),
+            threading.Thread(target=self._forward,
+                             args=(device, host, self.FROM_DEVICE)),
+            threading.Thread(target=self._decode),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _read(self, source):
+        """
+        Waits for and reads everything available from a port.
+
+        @param source: The port to read from
+        @type source: serial.Serial
+
+        @return: The bytes read, possibly none
+        """
+        try:
+            fileno = source.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            fileno = None
+
+        if fileno is not None:
+            readable = select.select([fileno, self._wakeup[0]], [], [])[0]
+            if fileno not in readable:
+                return ''
+        else:
+            # rely on the port's read timeout to notice 'stop'
+            data = source.read(1)
+            if not data:
+                return ''
+            return data + source.read(source.inWaiting())
+
+        return source.read(max(source.inWaiting(), 1))
+
+    def _forward(self, source, sink, direction):
+        """
+        Copies bytes from one port to the other, handing a copy to the
+        decoder once they have been written. A port that cannot be read
+        or written stops forwarding in both directions, as a session
+        missing the traffic of one direction would no longer work.
+
+        @param source: The port to read from
+        @type source: serial.Serial
+
+        @param sink: The port to write to
+        @type sink: serial.Serial
+
+        @param direction: The direction of the traffic
+        @type direction: string
+        """
+        while self._thread_continue:
+            try:
+                data = self._read(source)
+                if not data:
+                    continue
+                sink.write(data)
+            except (IOError, OSError, ValueError, select.error) as e:
+                if self._thread_continue:
+                    self._thread_continue = False
+                    self.error = e
+                    # wake the other direction, hence it stops too
+                    os.write(self._wakeup[1], 'x')
+                    self._error(direction, e)
+                break
+            self._queue.put((direction, time.time(), data))
+
+    def _decode(self):
+        """
+        Splits the copied streams into packets and decodes them.
+        """
+        buffers = {self.FROM_HOST: '', self.FROM_DEVICE: ''}
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            direction, timestamp, data = item
+            buffers[direction] += data
+
+            buf = buffers[direction]
+            while buf:
+                length = _frame_length(buf)
+                if length is None or len(buf) < length:
+                    break
+                if not length:
+                    # not a packet boundary, hence resynchronise
+                    self.stats['dropped'] += 1
+                    buf = buf[1:]
+                    continue
+                packet, buf = buf[:length], buf[length:]
+                self.stats[direction] += 1
+                if self._callback:
+                    try:
+                        self._callback(
+                            direction, timestamp, self._split(packet))
+                    except Exception as e:
+                        # keep decoding, else the queue would grow without
+                        # limit while forwarding carries on
+                        self._error(direction, e)
+            buffers[direction] = buf
+
+    def _error(self, direction, error):
+        """
+        Counts an error raised by the callback or a port and passes it to
+        'on_error'.
+
+        @param direction: The direction of the traffic
+        @type direction: string
+
+        @param error: The error raised
+        @type error: Exception
+        """
+        self.stats['errors'] += 1
+        if self._on_error:
+            self._on_error(direction, error)
+
+    def _split(self, packet):
+        """
+        Decodes a single packet, of either direction.
+
+        @param packet: The packet
+        @type packet: hex
+
+        @return: A (data, parsed packet) tuple, with the parsed packet
+            None if the packet could not be decoded
+        """
+        try:
+            if packet[0] == '\x01':
+                return self._builder._split_command(packet)
+            if packet[0] == '\x04':
+                return self._parser._split_response(packet)
+        except (KeyError, ValueError, IndexError, NotImplementedError):
+            pass
+        return (packet, None)
+
+    def stop(self):
+        """
+        Stops forwarding, waits for the decoder to finish and closes both
+        ports. This must also be called once forwarding has stopped on
+        an error.
+        """
+        self._thread_continue = False
+        os.write(self._wakeup[1], 'x')
+        for thread in self._threads[:2]:
+            thread.join(1.0)
+        self.host.close()
+        self.device.close()
+        for thread in self._threads[:2]:
+            thread.join()
+        self._queue.put(None)
+        self._threads[2].join()
+        os.close(self._wakeup[0])
+        os.close(self._wakeup[1])
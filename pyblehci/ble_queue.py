@@ -0,0 +1,280 @@
+"""
+@fn ble_queue.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about A prioritised send queue for command packets. Control traffic is
+    written ahead of everything else, while the remaining classes share
+    the port by weighted round robin. Each class may also be rate
+    limited.
+"""
+
+import collections
+import threading
+import time
+
+# priority classes, from most to least urgent
+PRIORITY_CONTROL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# default share of the port given to each class. Control traffic is
+# always written first, hence has no weight.
+default_weights = {
+    PRIORITY_NORMAL: 4,
+    PRIORITY_BULK: 1,
+}
+
+
+class _TokenBucket(object):
+    """
+    Limits a class to 'rate' packets per second, with bursts of up to
+    'burst' packets.
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """
+        @return: The time until a token is available, in seconds
+        """
+        return max(1 - self.tokens, 0) / self.rate
+
+
+class SendQueue(threading.Thread):
+    """
+    Queues packets by priority class and writes them from a dedicated
+    thread.
+    """
+
+    # most packets taken from the queue for a single write_many call
+    max_batch = 16
+
+    def __init__(self, write, weights=None, rates=None, clock=time.time,
+                 write_many=None, on_error=None):
+        """
+        Initialises the class and starts the writer thread
+
+        @param write: The method used to write a packet to the port
+        @type write: <function>
+
+        @param weights: The share of the port given to each class other
+            than PRIORITY_CONTROL
+        @type weights: dict
+
+        @param rates: The rate limit of each class, as a tuple of
+            (packets per second, burst size)
+        @type rates: dict
+
+        @param clock: The time source used for rate limiting
+        @type clock: <function>
+
+        @param write_many: The method used to write a list of packets to
+            the port at once, if any. Packets waiting together are then
+            taken in priority order and written with a single call.
+        @type write_many: <function>
+
+        @param on_error: The method to call with the packets and the error
+            raised when a write fails. If not given, the error is raised
+            by the next call to 'put' or 'flush'.
+        @type on_error: <function>
+        """
+        super(SendQueue, self).__init__()
+        self.daemon = True
+        self._write = write
+        self._write_many = write_many
+        self.on_error = on_error
+        # the last write error, awaiting a caller to raise it to
+        self._error = None
+        self._clock = clock
+        self.weights = dict(default_weights)
+        if weights:
+            self.weights.update(weights)
+
+        now = clock()
+        self._buckets = {}
+        for priority, (rate, burst) in (rates or {}).items():
+            self._buckets[priority] = _TokenBucket(rate, burst, now)
+
+        self._queues = {}
+        self._current = {}
+        self._condition = threading.Condition()
+        self._thread_continue = True
+        self._writing = False
+        self.start()
+
+    def __len__(self):
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def put(self, packet, priority=PRIORITY_NORMAL):
+        """
+        Queues a packet to be written.
+
+        @param packet: The packet to write
+        @type packet: hex
+
+        @param priority: The priority class of the packet
+        @type priority: int
+
+        @raise IOError: If an earlier write failed and there is no
+            'on_error' method, in which case the packet is not queued
+        """
+        with self._condition:
+            if not self._thread_continue:
+                raise RuntimeError("The send queue has been closed")
+            self._raise_error()
+            if priority not in self._queues:
+                self._queues[priority] = collections.deque()
+                self._current[priority] = 0
+            self._queues[priority].append(packet)
+            self._condition.notify_all()
+
+    def _raise_error(self):
+        """
+        Raises, once, the error of a failed write not passed to
+        'on_error'. Must be called with the lock held.
+        """
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _eligible(self, now):
+        """
+        Finds the classes with packets waiting and within their rate
+        limits. Must be called with the lock held.
+
+        @param now: The current time
+        @type now: float
+
+        @return: A tuple of the eligible classes, and the time until a
+            rate limited class becomes eligible (or None)
+        """
+        eligible = []
+        delay = None
+        for priority, queue in self._queues.items():
+            if not queue:
+                continue
+            bucket = self._buckets.get(priority)
+            if bucket:
+                bucket.refill(now)
+                if bucket.tokens < 1:
+                    wait = bucket.delay()
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+            eligible.append(priority)
+        return eligible, delay
+
+    def _pick(self, eligible):
+        """
+        Chooses the class to write from next, using strict priority for
+        control traffic and smooth weighted round robin otherwise. Must
+        be called with the lock held.
+
+        @param eligible: The classes with packets that may be written
+        @type eligible: list
+
+        @return: The chosen class
+        """
+        if PRIORITY_CONTROL in eligible:
+            return PRIORITY_CONTROL
+
+        total = 0
+        chosen = None
+        for priority in eligible:
+            weight = self.weights.get(priority, 1)
+            total += weight
+            self._current[priority] += weight
+            if chosen is None or \
+                    self._current[priority] > self._current[chosen]:
+                chosen = priority
+        self._current[chosen] -= total
+        return chosen
+
+    def run(self):
+        """
+        Overrides threading.Thread.run(). Writes packets until closed and
+        drained.
+        """
+        while True:
+            with self._condition:
+                self._writing = False
+                while True:
+                    eligible, delay = self._eligible(self._clock())
+                    if eligible:
+                        break
+                    if not self._thread_continue and delay is None:
+                        self._condition.notify_all()
+                        return
+                    if delay is None:
+                        self._condition.notify_all()
+                    self._condition.wait(delay)
+
+                packets = []
+                while eligible and len(packets) < self.max_batch:
+                    priority = self._pick(eligible)
+                    packets.append(self._queues[priority].popleft())
+                    bucket = self._buckets.get(priority)
+                    if bucket:
+                        bucket.tokens -= 1
+                    if self._write_many is None:
+                        break
+                    eligible = self._eligible(self._clock())[0]
+                self._writing = True
+
+            try:
+                if self._write_many is None:
+                    self._write(packets[0])
+                else:
+                    self._write_many(packets)
+            except (IOError, OSError, ValueError) as e:
+                # the packets are lost, but the queue carries on
+                if self.on_error:
+                    self.on_error(packets, e)
+                else:
+                    with self._condition:
+                        self._error = e
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every queued packet has been written, raising the
+        error of any write that failed.
+
+        @param timeout: The maximum time to wait, in seconds
+        @type timeout: float
+
+        @return: True if the queue was drained
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        with self._condition:
+            while self._writing or any(self._queues.values()):
+                if deadline is None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            self._raise_error()
+        return True
+
+    def close(self):
+        """
+        Stops accepting packets, writes any still queued and stops the
+        thread.
+        """
+        with self._condition:
+            self._thread_continue = False
+            self._condition.notify_all()
+        if threading.current_thread() is not self:
+            self.join()
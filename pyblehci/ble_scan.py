@@ -0,0 +1,314 @@
+"""
+@fn ble_scan.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Continuous, duty-cycled device discovery. The scheduler restarts
+    discovery as soon as each scan completes, and may be paused while
+    connections need airtime.
+"""
+
+import threading
+import time
+
+
+class ScanScheduler(object):
+    """
+    Keeps a device discovery procedure running for as much of the time
+    as possible, and reports how much of that time was spent scanning.
+    """
+    # discovery modes for GATT_DeviceDiscoveryRequest
+    MODE_NONDISCOVERABLE = 0
+    MODE_GENERAL = 1
+    MODE_LIMITED = 2
+    MODE_ALL = 3
+
+    # time to wait before retrying a rejected discovery request
+    retry_delay = 0.1
+
+    def __init__(self, builder, parser, mode=MODE_ALL, duration=10240,
+                 interval=16, window=16, active_scan=True, white_list=False,
+                 clock=time.time):
+        """
+        Initialises the class, registering with the parser for events
+
+        @param builder: The builder used to write commands
+        @type builder: BLEBuilder
+
+        @param parser: The parser providing events and timers
+        @type parser: BLEParser
+
+        @param mode: The discovery mode
+        @type mode: int
+
+        @param duration: The length of each scan, in milliseconds. Longer
+            scans mean fewer restarts.
+        @type duration: int
+
+        @param interval: The scan interval, in units of 0.625 ms
+        @type interval: int
+
+        @param window: The scan window, in units of 0.625 ms. A window
+            equal to the interval scans continuously.
+        @type window: int
+
+        @param active_scan: Whether to request scan responses
+        @type active_scan: bool
+
+        @param white_list: Whether to only report white listed devices
+        @type white_list: bool
+
+        @param clock: The time source used for statistics
+        @type clock: <function>
+        """
+        if window > interval:
+            raise ValueError("The scan window may not exceed the interval")
+
+        self.builder = builder
+        self.parser = parser
+        self.mode = mode
+        self.duration = duration
+        self.interval = interval
+        self.window = window
+        self.active_scan = active_scan
+        self.white_list = white_list
+        self._clock = clock
+        self._lock = threading.RLock()
+
+        self._running = False
+        self._paused = False
+        # set while a discovery cancel awaits its GAP_DeviceDiscoveryDone
+        self._cancelling = False
+        # time the current scan was requested and confirmed respectively
+        self._requested_at = None
+        self._scanning_since = None
+        self._started_at = None
+        self._paused_since = None
+
+        self._scans = 0
+        self._starts = 0
+        self._failures = 0
+        self._scan_time = 0.0
+        self._paused_time = 0.0
+        self._gap_time = 0.0
+        self._max_gap = 0.0
+        self._reports = 0
+        self._devices = set()
+
+        parser.add_listener(self.handle_event)
+
+    def configure(self):
+        """
+        Writes the scan duration, interval and window to the device using
+        GAP_SetParam. Limited discovery has its own set of parameters.
+        """
+        params = self.builder.gap_params
+        if self.mode == self.MODE_LIMITED:
+            prefix = 'TGAP_LIM_DISC_SCAN'
+        else:
+            prefix = 'TGAP_GEN_DISC_SCAN'
+
+        for param, value in ((prefix, self.duration),
+                             (prefix + '_INT', self.interval),
+                             (prefix + '_WIND', self.window)):
+            self.builder.send(
+                "fe30", param_id=params[param], param_value=value)
+
+    def start(self):
+        """
+        Configures the device and starts continuous discovery.
+        """
+        with self._lock:
+            if self._running:
+                return
+            self.configure()
+            self._running = True
+            self._paused = False
+            self._started_at = self._clock()
+            self._request_scan()
+
+    def stop(self):
+        """
+        Stops continuous discovery, cancelling any scan in progress.
+        """
+        with self._lock:
+            if not self._running:
+                return
+            self.pause()
+            self._running = False
+            self._paused = False
+            self._paused_time += self._clock() - self._paused_since
+            self._paused_since = None
+
+    def pause(self):
+        """
+        Cancels the scan in progress, freeing airtime for connections,
+        until 'resume' is called.
+        """
+        with self._lock:
+            if not self._running or self._paused:
+                return
+            self._paused = True
+            self._paused_since = self._clock()
+            self._end_scan(self._paused_since)
+            self._requested_at = None
+            self._cancelling = True
+            try:
+                self.builder.send("fe05")
+            except Exception:
+                # no discovery done event will follow
+                self._cancelling = False
+                raise
+
+    def resume(self):
+        """
+        Restarts discovery after a call to 'pause'. If the cancelled scan
+        has yet to end, discovery is restarted once it does.
+        """
+        with self._lock:
+            if not self._running or not self._paused:
+                return
+            self._paused = False
+            self._paused_time += self._clock() - self._paused_since
+            self._paused_since = None
+            if not self._cancelling:
+                self._request_scan()
+
+    def _request_scan(self):
+        """
+        Writes a discovery request. A request that cannot be written is
+        counted as a failure and retried, as this is mostly called on the
+        parser's thread. Must be called with the lock held.
+        """
+        packet = self.builder._build_command(
+            "fe04", mode=self.mode, active_scan=int(self.active_scan),
+            white_list=int(self.white_list))[0]
+        self._requested_at = self._clock()
+        try:
+            self.builder.send_packet(packet)
+        except (IOError, OSError, RuntimeError, ValueError):
+            self._requested_at = None
+            self._failures += 1
+            self.parser.timers.schedule(self.retry_delay, self._retry)
+
+    def _retry(self):
+        """
+        Retries a discovery request that was rejected by the device.
+        """
+        with self._lock:
+            if self._running and not self._paused and \
+                    self._requested_at is None:
+                self._request_scan()
+
+    def _restart(self):
+        """
+        Requests the next scan, unless stopped, paused or already
+        requested. Must be called with the lock held.
+        """
+        if self._running and not self._paused and \
+                self._requested_at is None:
+            self._request_scan()
+
+    def _end_scan(self, now):
+        """
+        Accounts for the end of a scan. Must be called with the lock
+        held.
+
+        @param now: The time the scan ended
+        @type now: float
+        """
+        if self._scanning_since is not None:
+            self._scan_time += now - self._scanning_since
+            self._scanning_since = None
+
+    def handle_event(self, response):
+        """
+        Processes a parsed event, restarting discovery as soon as a scan
+        completes. This is registered as a listener on the parser.
+
+        @param response: The (data, parsed packet) tuple from the parser
+        @type response: tuple
+        """
+        codes = self.parser.event_codes(response)
+        if codes is None:
+            return
+        subcode, status, cmd = codes
+
+        with self._lock:
+            if subcode == "060d":
+                self._reports += 1
+                self._devices.add(response[1]['addr'][0])
+            elif subcode == "067f":
+                if cmd == "fe05":
+                    if status != '\x00' and self._cancelling:
+                        # nothing to cancel, hence no discovery done event
+                        # will follow
+                        self._cancelling = False
+                        self._restart()
+                    return
+                if cmd != "fe04" or self._requested_at is None:
+                    return
+                now = self._clock()
+                if status == '\x00':
+                    gap = now - self._requested_at
+                    self._requested_at = None
+                    self._starts += 1
+                    self._gap_time += gap
+                    self._max_gap = max(self._max_gap, gap)
+                    self._scanning_since = now
+                else:
+                    # device busy, hence try again shortly
+                    self._failures += 1
+                    self._requested_at = None
+                    self.parser.timers.schedule(self.retry_delay, self._retry)
+            elif subcode == "0601":
+                if self._cancelling:
+                    # end of the scan cancelled by 'pause', rather than of
+                    # any scan requested since
+                    self._cancelling = False
+                    self._restart()
+                    return
+                now = self._clock()
+                self._end_scan(now)
+                self._scans += 1
+                self._restart()
+
+    def stats(self):
+        """
+        Reports coverage and duty-cycle statistics.
+
+        'coverage' is the fraction of unpaused time during which a scan
+        was running, while 'effective' accounts for the fraction of each
+        scan interval spent listening.
+
+        @return: A dictionary of statistics
+        """
+        with self._lock:
+            now = self._clock()
+            scan_time = self._scan_time
+            if self._scanning_since is not None:
+                scan_time += now - self._scanning_since
+            paused_time = self._paused_time
+            if self._paused_since is not None:
+                paused_time += now - self._paused_since
+            elapsed = now - self._started_at if self._started_at else 0.0
+            active = elapsed - paused_time
+
+            coverage = scan_time / active if active > 0 else 0.0
+            duty_cycle = float(self.window) / self.interval
+            mean_gap = self._gap_time / self._starts if self._starts else 0.0
+            return {
+                'elapsed': elapsed,
+                'paused': paused_time,
+                'scanning': scan_time,
+                'coverage': coverage,
+                'duty_cycle': duty_cycle,
+                'effective': coverage * duty_cycle,
+                'scans': self._scans,
+                'failures': self._failures,
+                'mean_gap': mean_gap,
+                'max_gap': self._max_gap,
+                'reports': self._reports,
+                'devices': len(self._devices),
+            }
@@ -0,0 +1,274 @@
+"""
+@fn ble_timers.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about A hierarchical timer wheel used to track deadlines for pending
+    operations. Timers are inserted and cancelled in constant time and
+    are fired from the thread that advances the wheel, typically the
+    BLEParser event loop.
+"""
+
+import threading
+import time
+
+
+class Timer(object):
+    """
+    A single deadline scheduled on a TimerWheel.
+    """
+
+    def __init__(self, wheel, expiry, callback, args):
+        """
+        Initialises the class
+
+        @param wheel: The wheel the timer is scheduled on
+        @type wheel: TimerWheel
+
+        @param expiry: The tick on which the timer expires
+        @type expiry: int
+
+        @param callback: The method to call on expiry
+        @type callback: <function>
+
+        @param args: Arguments passed to the callback
+        @type args: tuple
+        """
+        self.wheel = wheel
+        self.expiry = expiry
+        self.callback = callback
+        self.args = args
+        self.slot = None
+
+    def cancel(self):
+        """
+        Cancels the timer. Cancelling a timer that has already fired
+        has no effect.
+
+        @return: True if the timer was pending, else False
+        """
+        return self.wheel.cancel(self)
+
+    def active(self):
+        """
+        Getter method for the timer state
+
+        @return: True if the timer has not yet fired or been cancelled
+        """
+        return self.slot is not None
+
+
+class TimerWheel(object):
+    """
+    A hierarchical timer wheel. Each level holds 'slots' buckets, with
+    each bucket on a level spanning 'slots' times as many ticks as a
+    bucket on the level below. Timers are cascaded down a level as the
+    wheel turns, and fired once they reach the lowest level.
+    """
+
+    def __init__(self, tick=0.01, slots=256, levels=4, clock=time.time):
+        """
+        Initialises the class
+
+        @param tick: The resolution of the wheel, in seconds
+        @type tick: float
+
+        @param slots: The number of slots on each level of the wheel
+        @type slots: int
+
+        @param levels: The number of levels of the wheel
+        @type levels: int
+
+        @param clock: The time source used to advance the wheel
+        @type clock: <function>
+        """
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._clock = clock
+        self._start = clock()
+        self._current = 0
+        self._count = 0
+        self._lock = threading.RLock()
+        self._wheel = [[set() for _ in range(slots)] for _ in range(levels)]
+        # the time up to which the thread advancing the wheel may be
+        # blocked, as given by 'next_timeout'. None if it may block
+        # indefinitely.
+        self._waiting_until = None
+        # method called when a timer is scheduled to expire before then,
+        # used to wake the advancing thread
+        self.wakeup = None
+        # method called with the timer and the error raised by its
+        # callback. If None, the error is raised by 'advance'.
+        self.on_error = None
+
+    def __len__(self):
+        return self._count
+
+    def _now(self):
+        """
+        Converts the current time to a tick count.
+
+        @return: The number of ticks since the wheel was created
+        """
+        return int((self._clock() - self._start) / self.tick)
+
+    def _insert(self, timer):
+        """
+        Places a timer in the slot matching its expiry. Must be called
+        with the lock held.
+
+        @param timer: The timer to insert
+        @type timer: Timer
+        """
+        delta = max(timer.expiry - self._current, 0)
+        level = 0
+        span = self.slots
+        while delta >= span and level < self.levels - 1:
+            span *= self.slots
+            level += 1
+        # the number of ticks covered by a single slot on this level
+        unit = span // self.slots
+        if delta >= span:
+            # beyond the range of the wheel, hence park in the last slot
+            # reached and re-evaluate when it cascades
+            index = (self._current // unit - 1) % self.slots
+        else:
+            index = (timer.expiry // unit) % self.slots
+        timer.slot = self._wheel[level][index]
+        timer.slot.add(timer)
+
+    def schedule(self, delay, callback, *args):
+        """
+        Schedules a callback to be run after a given delay.
+
+        >>> schedule(5.0, on_timeout, conn_handle)
+        <pyblehci.ble_timers.Timer object at 0x...>
+
+        @param delay: The delay, in seconds
+        @type delay: float
+
+        @param callback: The method to call on expiry
+        @type callback: <function>
+
+        @param args: Arguments passed to the callback
+
+        @return: The scheduled timer, which may be used to cancel it
+        """
+        wake = False
+        with self._lock:
+            now = max(self._current, self._now())
+            if not self._count:
+                # nothing to cascade, hence the wheel may jump forward
+                self._current = now
+            ticks = max(int(-(-delay // self.tick)), 1)
+            timer = Timer(self, now + ticks, callback, args)
+            self._insert(timer)
+            self._count += 1
+
+            # a new earliest deadline, hence the advancing thread must
+            # stop waiting early
+            expires_at = self._start + timer.expiry * self.tick
+            if self.wakeup is not None and (
+                    self._waiting_until is None or
+                    expires_at < self._waiting_until):
+                self._waiting_until = expires_at
+                wake = True
+
+        if wake:
+            self.wakeup()
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancels a scheduled timer.
+
+        @param timer: The timer to cancel
+        @type timer: Timer
+
+        @return: True if the timer was pending, else False
+        """
+        with self._lock:
+            if timer.slot is None:
+                return False
+            timer.slot.discard(timer)
+            timer.slot = None
+            self._count -= 1
+        return True
+
+    def _cascade(self):
+        """
+        Moves the timers from the next slot of each upper level down the
+        wheel. Must be called with the lock held.
+        """
+        span = 1
+        for level in range(1, self.levels):
+            span *= self.slots
+            index = (self._current // span) % self.slots
+            slot = self._wheel[level][index]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._insert(timer)
+            if index:
+                break
+
+    def advance(self):
+        """
+        Turns the wheel up to the current time and fires any timers that
+        have expired. Callbacks are run on the calling thread, outside of
+        the wheel's lock. Errors raised by callbacks are passed to
+        'on_error', if set.
+
+        @return: The number of timers fired
+        """
+        expired = []
+        with self._lock:
+            target = self._now()
+            if not self._count:
+                self._current = max(self._current, target)
+            while self._current < target and self._count:
+                self._current += 1
+                if not self._current % self.slots:
+                    self._cascade()
+                slot = self._wheel[0][self._current % self.slots]
+                for timer in slot:
+                    timer.slot = None
+                expired.extend(slot)
+                self._count -= len(slot)
+                slot.clear()
+            if not self._count:
+                self._current = max(self._current, target)
+
+        for timer in expired:
+            if self.on_error is None:
+                timer.callback(*timer.args)
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self.on_error(timer, e)
+        return len(expired)
+
+    def next_timeout(self):
+        """
+        Calculates how long the caller may block before the wheel next
+        needs to be advanced. Timers scheduled later to expire sooner
+        call 'wakeup', if set.
+
+        @return: The delay in seconds, or None if no timers are pending
+        """
+        with self._lock:
+            if not self._count:
+                self._waiting_until = None
+                return None
+            # check the lowest level up until the next cascade
+            ticks = self.slots - self._current % self.slots
+            for offset in range(1, ticks + 1):
+                if self._wheel[0][(self._current + offset) % self.slots]:
+                    ticks = offset
+                    break
+            deadline = self._start + (self._current + ticks) * self.tick
+            self._waiting_until = deadline
+        return max(deadline - self._clock(), 0)
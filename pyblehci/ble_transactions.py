@@ -0,0 +1,551 @@
+"""
+@fn ble_transactions.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tracking of outstanding ATT transactions. Requests are written
+    through a BLEBuilder and matched against the ATT responses parsed by
+    a BLEParser, with deadlines held on the parser's timer wheel.
+"""
+
+import collections
+import threading
+
+from pyblehci import ble_codecs
+from pyblehci.ble_pending import PendingOperation, StatusQueue
+
+# GATT requests default to the first connection, as the builder does
+_conn_handle_field = {
+    'name': 'conn_handle', 'len': 2, 'type': 'uint', 'default': '\x00\x00'}
+
+
+class Transaction(PendingOperation):
+    """
+    A single GATT request awaiting its ATT response.
+    """
+    # transaction states
+    PENDING = 'pending'
+    COMPLETE = 'complete'
+    ERROR = 'error'
+    TIMEOUT = 'timeout'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, cmd, conn_handle, kwargs, packet, callback, timeout,
+                 retries, backoff):
+        """
+        Initialises the class
+
+        @param cmd: The command code of the request
+        @type cmd: hex
+
+        @param conn_handle: The raw connection handle of the request
+        @type conn_handle: hex
+
+        @param kwargs: The fields of the request
+        @type kwargs: dict
+
+        @param packet: The built command packet
+        @type packet: hex
+
+        @param callback: The method to call once the transaction ends
+        @type callback: <function>
+
+        @param timeout: The time to wait for a response, in seconds
+        @type timeout: float
+
+        @param retries: The number of times to resend the request
+        @type retries: int
+
+        @param backoff: The factor applied to the timeout on each retry
+        @type backoff: float
+        """
+        super(Transaction, self).__init__()
+        self.cmd = cmd
+        self.conn_handle = conn_handle
+        self.kwargs = kwargs
+        self.packet = packet
+        self.callback = callback
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.attempts = 0
+        self.state = self.PENDING
+        self.responses = []
+        self.timer = None
+
+    @property
+    def response(self):
+        """
+        Getter method for the most recent response
+
+        @return: The last parsed packet received, or None
+        """
+        if self.responses:
+            return self.responses[-1]
+        return None
+
+
+
+class Gather(PendingOperation):
+    """
+    A single GATT operation scattered across several connections, and
+    the results gathered from each.
+    """
+
+    def __init__(self, callback):
+        """
+        Initialises the class
+
+        @param callback: The method to call once every request has ended
+        @type callback: <function>
+        """
+        super(Gather, self).__init__()
+        self.callback = callback
+        # transaction for each connection handle, as given by the caller
+        self.results = collections.OrderedDict()
+        self.expired = False
+        self.timer = None
+        self._remaining = 0
+        self._lock = threading.Lock()
+
+    def succeeded(self):
+        """
+        Getter method for the connections whose request completed
+
+        @return: A dictionary of transactions, by connection handle
+        """
+        return collections.OrderedDict(
+            (conn_handle, transaction)
+            for conn_handle, transaction in self.results.items()
+            if transaction.state == Transaction.COMPLETE)
+
+    def failed(self):
+        """
+        Getter method for the connections whose request failed, timed out
+        or was cut short by the overall deadline
+
+        @return: A dictionary of transactions, by connection handle
+        """
+        return collections.OrderedDict(
+            (conn_handle, transaction)
+            for conn_handle, transaction in self.results.items()
+            if transaction.done() and
+            transaction.state != Transaction.COMPLETE)
+
+    def _collect(self, transaction):
+        """
+        Accounts for a single request ending, finishing the gather once
+        all have ended. This is the callback of each transaction.
+
+        @param transaction: The transaction that ended
+        @type transaction: Transaction
+        """
+        with self._lock:
+            self._remaining -= 1
+            if self._remaining:
+                return
+            if self.timer:
+                self.timer.cancel()
+            self._done.set()
+
+        if self.callback:
+            self.callback(self)
+
+
+class ATTTransactions(object):
+    """
+    Tracks outstanding GATT requests on each connection. The ATT
+    protocol allows only one outstanding request per connection, hence
+    requests on the same connection are queued and sent in turn, while
+    requests on different connections proceed in parallel.
+    """
+    # response events expected for each GATT request
+    responses = {
+        "fd8a": "050b",
+        "fd8e": "050f",
+        "fd92": "0513",
+        "fdb2": "0509",
+        "fdb4": "0509",
+    }
+
+    # requests that may return several responses, terminated by a
+    # "procedure complete" status
+    procedures = ("fdb2", "fdb4")
+
+    error_rsp = "0501"
+    status_event = "067f"
+
+    # status codes for HCI_LE_ExtEvent
+    SUCCESS = '\x00'
+    PROCEDURE_COMPLETE = '\x1a'
+
+    def __init__(self, builder, parser, timeout=5.0, retries=0, backoff=1.0):
+        """
+        Initialises the class, registering with the parser for events
+
+        @param builder: The builder used to write requests
+        @type builder: BLEBuilder
+
+        @param parser: The parser providing events and timers
+        @type parser: BLEParser
+
+        @param timeout: The default time to wait for a response
+        @type timeout: float
+
+        @param retries: The default number of times to resend a request
+        @type retries: int
+
+        @param backoff: The default factor applied to the timeout on each
+            retry
+        @type backoff: float
+        """
+        self.builder = builder
+        self.parser = parser
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._lock = threading.RLock()
+        # outstanding transactions for each connection, head first
+        self._pending = {}
+        # transactions awaiting a command status, in order sent
+        self._unacked = StatusQueue()
+
+        parser.add_listener(self.handle_event)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._pending.values())
+
+    def request(self, cmd, callback=None, timeout=None, retries=None,
+                backoff=None, **kwargs):
+        """
+        Queues a GATT request on its connection, sending it immediately
+        if no other request is outstanding on that connection.
+
+        >>> request("fd8a", callback=got_value, conn_handle=0, handle=0x27)
+        <pyblehci.ble_transactions.Transaction object at 0x...>
+
+        @param cmd: The command to be written
+        @type cmd: hex
+
+        @param callback: The method to call, with the transaction, once
+            the transaction ends
+        @type callback: <function>
+
+        @param timeout: The time to wait for each response
+        @type timeout: float
+
+        @param retries: The number of times to resend the request
+        @type retries: int
+
+        @param backoff: The factor applied to the timeout on each retry
+        @type backoff: float
+
+        @param kwargs: The fields of the request
+
+        @return: The transaction tracking the request
+        """
+        cmd = self.builder.opcode_names.get(cmd, cmd)
+        if cmd not in self.responses:
+            raise NotImplementedError(
+                "Command %s does not expect an ATT response" % cmd)
+
+        conn_handle = ble_codecs.encode_field(
+            _conn_handle_field,
+            kwargs.get('conn_handle', _conn_handle_field['default']))
+        # build now, hence a bad request fails here rather than when it
+        # reaches the head of its connection's queue
+        packet = self.builder._build_command(cmd, **kwargs)[0]
+
+        transaction = Transaction(
+            cmd, conn_handle, kwargs, packet, callback,
+            self.timeout if timeout is None else timeout,
+            self.retries if retries is None else retries,
+            self.backoff if backoff is None else backoff)
+
+        with self._lock:
+            queue = self._pending.setdefault(conn_handle, collections.deque())
+            queue.append(transaction)
+            if len(queue) == 1:
+                error = self._send(transaction)
+                if error is not None:
+                    # never written, hence forget the request entirely
+                    transaction.timer.cancel()
+                    queue.popleft()
+                    if not queue:
+                        del self._pending[conn_handle]
+                    raise error
+
+        return transaction
+
+    def scatter(self, cmd, conn_handles, callback=None, deadline=None,
+                **kwargs):
+        """
+        Sends the same GATT request on each of several connections and
+        gathers the responses. Requests on different connections are in
+        flight together, hence the whole operation takes as long as the
+        slowest connection rather than the sum of all of them.
+
+        >>> gather = scatter("fd8a", [0, 1, 2], deadline=2.0, handle=0x27)
+        >>> gather.wait()
+        True
+        >>> gather.failed()
+        OrderedDict([(2, <pyblehci.ble_transactions.Transaction ...>)])
+
+        @param cmd: The command to be written
+        @type cmd: hex
+
+        @param conn_handles: The connections to send the request on
+        @type conn_handles: list
+
+        @param callback: The method to call, with the gather, once every
+            request has ended
+        @type callback: <function>
+
+        @param deadline: The time allowed for the whole operation, in
+            seconds. Requests still outstanding when it passes are
+            cancelled and reported as failed.
+        @type deadline: float
+
+        @param kwargs: The fields of the request, other than the
+            connection handle. 'timeout', 'retries' and 'backoff' apply
+            to each request, as for 'request'.
+
+        @return: The gather tracking the requests
+
+        @raise KeyError: If the request cannot be built or written for a
+            connection, as for 'request'. Any requests already sent are
+            then cancelled.
+        """
+        gather = Gather(callback)
+        conn_handles = list(collections.OrderedDict.fromkeys(conn_handles))
+        gather._remaining = len(conn_handles)
+        if not conn_handles:
+            gather._done.set()
+            if callback:
+                callback(gather)
+            return gather
+
+        with self._lock:
+            # hold the lock so that no request ends before all are queued
+            try:
+                for conn_handle in conn_handles:
+                    gather.results[conn_handle] = self.request(
+                        cmd, callback=gather._collect,
+                        conn_handle=conn_handle, **kwargs)
+            except Exception:
+                # withdraw the requests already sent, without reporting a
+                # gather the caller never receives
+                gather.callback = None
+                for transaction in gather.results.values():
+                    self.cancel(transaction)
+                raise
+
+            if deadline is not None:
+                gather.timer = self.parser.timers.schedule(
+                    deadline, self._gather_expired, gather)
+
+        return gather
+
+    def _gather_expired(self, gather):
+        """
+        Handles the overall deadline of a gather passing, cancelling any
+        requests still outstanding.
+
+        @param gather: The gather that timed out
+        @type gather: Gather
+        """
+        with self._lock:
+            gather.expired = True
+            transactions = list(gather.results.values())
+        for transaction in transactions:
+            self.cancel(transaction)
+
+    def cancel(self, transaction):
+        """
+        Cancels a transaction. A response that later arrives for a
+        cancelled request that had already been sent is discarded.
+
+        @param transaction: The transaction to cancel
+        @type transaction: Transaction
+        """
+        self._finish(transaction, Transaction.CANCELLED)
+
+    def _send(self, transaction):
+        """
+        Writes a request and starts its deadline. Must be called with the
+        lock held.
+
+        A request that cannot be written is treated as lost, hence is
+        resent or timed out by its deadline as usual. This avoids raising
+        on the parser thread, where requests are sent as others end.
+
+        @param transaction: The transaction to send
+        @type transaction: Transaction
+
+        @return: The error raised while writing the request, if any
+        """
+        transaction.attempts += 1
+        timeout = transaction.timeout * (
+            transaction.backoff ** (transaction.attempts - 1))
+        transaction.timer = self.parser.timers.schedule(
+            timeout, self._expired, transaction)
+        self._unacked.append(transaction)
+        try:
+            self.builder.send_packet(transaction.packet)
+        except (IOError, OSError, RuntimeError) as e:
+            self._unacked.discard(transaction)
+            return e
+        return None
+
+    def _advance(self, conn_handle):
+        """
+        Removes the request at the head of a connection's queue and sends
+        the next one, if any. Must be called with the lock held.
+
+        @param conn_handle: The raw connection handle
+        @type conn_handle: hex
+        """
+        queue = self._pending[conn_handle]
+        queue.popleft()
+        if queue:
+            self._send(queue[0])
+        else:
+            del self._pending[conn_handle]
+
+    def _expired(self, transaction):
+        """
+        Handles the deadline of a transaction passing, resending the
+        request if any retries remain.
+
+        @param transaction: The transaction that timed out
+        @type transaction: Transaction
+        """
+        with self._lock:
+            if transaction.done():
+                queue = self._pending.get(transaction.conn_handle)
+                if queue and queue[0] is transaction:
+                    # a cancelled request was still in flight
+                    self._advance(transaction.conn_handle)
+                return
+            if transaction.attempts <= transaction.retries:
+                transaction.responses = []
+                self._send(transaction)
+                return
+        self._finish(transaction, Transaction.TIMEOUT)
+
+    def _finish(self, transaction, state):
+        """
+        Ends a transaction, sending the next request queued on its
+        connection and notifying the caller.
+
+        @param transaction: The transaction to end
+        @type transaction: Transaction
+
+        @param state: The final state of the transaction
+        @type state: string
+        """
+        with self._lock:
+            if transaction.done():
+                return
+            transaction.state = state
+            transaction._done.set()
+
+            queue = self._pending[transaction.conn_handle]
+            if queue[0] is not transaction:
+                # never sent, hence simply dequeue
+                queue.remove(transaction)
+            elif state != Transaction.CANCELLED:
+                transaction.timer.cancel()
+                self._advance(transaction.conn_handle)
+            # else a cancelled request is in flight, hence leave it at the
+            # head of the queue until its response or deadline arrives
+
+        if transaction.callback:
+            transaction.callback(transaction)
+
+    def _handle_status(self, packet, status, cmd):
+        """
+        Matches a command status to the oldest unacknowledged request,
+        failing the request if the command was rejected.
+
+        @param packet: The parsed command status event
+        @type packet: OrderedDict
+
+        @param status: The raw status byte
+        @type status: hex
+
+        @param cmd: The command the status is for
+        @type cmd: hex
+        """
+        if cmd not in self.responses:
+            return
+
+        with self._lock:
+            transaction = self._unacked.pop(
+                lambda transaction: transaction.cmd == cmd)
+        if transaction is None:
+            return
+
+        if status != self.SUCCESS:
+            transaction.responses.append(packet)
+            self._finish(transaction, Transaction.ERROR)
+
+    def handle_event(self, response):
+        """
+        Processes a parsed event, completing the matching transaction.
+        This is registered as a listener on the parser.
+
+        @param response: The (data, parsed packet) tuple from the parser
+        @type response: tuple
+        """
+        codes = self.parser.event_codes(response)
+        if codes is None:
+            return
+        subcode, status, cmd = codes
+        packet = response[1]
+
+        if subcode == self.status_event:
+            self._handle_status(packet, status, cmd)
+            return
+
+        if subcode != self.error_rsp and \
+                subcode not in self.responses.values():
+            return
+
+        with self._lock:
+            queue = self._pending.get(packet['conn_handle'][0])
+            if not queue:
+                return
+            transaction = queue[0]
+            if subcode != self.error_rsp and \
+                    self.responses[transaction.cmd] != subcode:
+                return
+
+            final = subcode == self.error_rsp or \
+                transaction.cmd not in self.procedures or \
+                status != self.SUCCESS
+
+            if transaction.done():
+                # response to a cancelled request, hence discard it
+                if final:
+                    transaction.timer.cancel()
+                    self._advance(transaction.conn_handle)
+                return
+
+            transaction.responses.append(packet)
+            if not final:
+                # further responses will follow, hence extend deadline
+                transaction.timer.cancel()
+                transaction.timer = self.parser.timers.schedule(
+                    transaction.timeout, self._expired, transaction)
+                return
+
+            if subcode == self.error_rsp or \
+                    status not in (self.SUCCESS, self.PROCEDURE_COMPLETE):
+                state = Transaction.ERROR
+            else:
+                state = Transaction.COMPLETE
+
+        self._finish(transaction, state)
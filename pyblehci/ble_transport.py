@@ -0,0 +1,367 @@
+"""
+@fn ble_transport.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Socket transports for devices attached to remote serial bridges.
+    Transports look like a serial port to BLEParser and BLEBuilder, and
+    reconnect to the bridge when the connection is lost, replaying any
+    commands that could not be written in the meantime.
+"""
+
+import collections
+import errno
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+    import termios
+except ImportError:
+    # not available on Windows, where the receive buffer is peeked instead
+    fcntl = termios = None
+
+# receive buffer requested for each connection, letting the bridge run
+# ahead of the parser during bursts of events
+DEFAULT_RCVBUF = 1 << 20
+
+# most buffers passed to a single vectored write
+_IOV_MAX = 512
+
+
+class SocketTransport(object):
+    """
+    A file like port backed by a stream socket. Subclasses provide the
+    addresses to connect to.
+
+    The file descriptor returned by 'fileno' is kept across reconnects,
+    hence a parser waiting on it need not be restarted. 'reconnects'
+    counts the connections made since the first, hence changes whenever
+    a new stream of bytes begins.
+    """
+
+    def __init__(self, address, reconnect=True, rcvbuf=DEFAULT_RCVBUF,
+                 connect_timeout=5.0, retry_delay=0.5, max_backlog=256):
+        """
+        Initialises the class and connects to the bridge
+
+        @param address: The address of the bridge
+        @type address: tuple
+
+        @param reconnect: Whether to reconnect when the connection is
+            lost, rather than raising IOError
+        @type reconnect: bool
+
+        @param rcvbuf: The size of the socket receive buffer, in bytes
+        @type rcvbuf: int
+
+        @param connect_timeout: The time allowed for each connection
+            attempt, in seconds
+        @type connect_timeout: float
+
+        @param retry_delay: The minimum time between connection attempts,
+            in seconds
+        @type retry_delay: float
+
+        @param max_backlog: The most commands held while disconnected
+        @type max_backlog: int
+        """
+        self.address = address
+        self.reconnect = reconnect
+        self.rcvbuf = rcvbuf
+        self.connect_timeout = connect_timeout
+        self.retry_delay = retry_delay
+        self.max_backlog = max_backlog
+        self.reconnects = 0
+        self._lock = threading.RLock()
+        # commands not yet written to the current connection
+        self._backlog = collections.deque()
+        self._connected = False
+        self._closed = False
+        self._next_attempt = 0.0
+
+        self._sock = self._connect()
+        self._fd = self._sock.fileno()
+        self._connected = True
+
+    def _addresses(self):
+        """
+        Lists the addresses the bridge may be reached at.
+
+        @return: A list of (address family, socket address) tuples
+        """
+        raise NotImplementedError
+
+    def _configure(self, sock):
+        """
+        Sets socket options before connecting.
+
+        @param sock: The unconnected socket
+        @type sock: socket.socket
+        """
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def _connect(self):
+        """
+        Opens a new connection to the bridge.
+
+        @return: The connected socket
+        """
+        error = None
+        for family, address in self._addresses():
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                self._configure(sock)
+                sock.settimeout(self.connect_timeout)
+                sock.connect(address)
+                sock.settimeout(None)
+                return sock
+            except socket.error as e:
+                error = e
+                sock.close()
+        raise error or socket.error("No address for %r" % (self.address,))
+
+    def _try_reconnect(self):
+        """
+        Makes a single attempt to reconnect, unless one was made within
+        'retry_delay'. The new connection takes over the existing file
+        descriptor. Must be called with the lock held.
+
+        @return: True if connected
+        """
+        if self._closed:
+            raise IOError("Transport is closed")
+        if self._connected:
+            return True
+        if not self.reconnect:
+            raise IOError("Connection to %r lost" % (self.address,))
+
+        now = time.time()
+        if now < self._next_attempt:
+            return False
+        self._next_attempt = now + self.retry_delay
+        try:
+            sock = self._connect()
+        except socket.error:
+            return False
+
+        os.dup2(sock.fileno(), self._fd)
+        sock.close()
+        self._connected = True
+        self.reconnects += 1
+        return True
+
+    def _lost(self):
+        """
+        Marks the connection as lost. Must be called with the lock held.
+        """
+        self._connected = False
+
+    def _sendv(self, buffers):
+        """
+        Writes several buffers to the connection, with a single vectored
+        write where supported.
+
+        @param buffers: The buffers to write
+        @type buffers: list
+        """
+        if hasattr(self._sock, 'sendmsg'):
+            sent = self._sock.sendmsg(buffers)
+            data = ''.join(buffers)
+            if sent < len(data):
+                self._sock.sendall(data[sent:])
+        else:
+            self._sock.sendall(''.join(buffers))
+
+    def _flush_backlog(self):
+        """
+        Writes any buffered commands, reconnecting if required. Must be
+        called with the lock held.
+        """
+        while self._backlog:
+            if not self._try_reconnect():
+                return
+            buffers = list(self._backlog)[:_IOV_MAX]
+            try:
+                self._sendv(buffers)
+            except socket.error:
+                # resend the lot on the next connection, as the bridge
+                # discards partially written commands with the connection
+                self._lost()
+                continue
+            for _ in buffers:
+                self._backlog.popleft()
+
+    def fileno(self):
+        """
+        Getter method for the file descriptor of the connection
+
+        @return: The file descriptor, kept across reconnects
+        """
+        return self._fd
+
+    def inWaiting(self):
+        """
+        Getter method for the number of bytes waiting to be read
+
+        @return: The number of bytes in the receive buffer
+        """
+        if fcntl is not None:
+            buf = fcntl.ioctl(self._fd, termios.FIONREAD, '\0\0\0\0')
+            return struct.unpack('i', buf)[0]
+        if not select.select([self._sock], [], [], 0)[0]:
+            return 0
+        try:
+            return len(self._sock.recv(self.rcvbuf, socket.MSG_PEEK))
+        except socket.error:
+            return 0
+
+    def read(self, size=1):
+        """
+        Reads up to 'size' bytes, blocking until they arrive. If the
+        connection is lost, it is re-established and nothing is returned,
+        as bytes already read belong to a packet that will never be
+        completed.
+
+        @param size: The number of bytes to read
+        @type size: int
+
+        @return: The bytes read
+        """
+        data = []
+        remaining = size
+        while remaining > 0:
+            # connection the bytes are read from, as a writer may replace
+            # it while the reader is blocked
+            generation = self.reconnects
+            try:
+                chunk = self._sock.recv(remaining)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                chunk = ''
+            if not chunk:
+                self._reconnect_reader(generation)
+                return ''
+            data.append(chunk)
+            remaining -= len(chunk)
+        return ''.join(data)
+
+    def _reconnect_reader(self, generation):
+        """
+        Re-establishes a lost connection on behalf of a reader, pausing
+        between failed attempts so that a reader waiting on a dead
+        connection does not spin.
+
+        @param generation: The value of 'reconnects' when the reader
+            found the connection lost. If a writer has since reconnected,
+            the new connection is kept.
+        @type generation: int
+        """
+        with self._lock:
+            if self.reconnects == generation:
+                self._lost()
+            if self._try_reconnect():
+                self._flush_backlog()
+                return
+            delay = self._next_attempt - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def write(self, data):
+        """
+        Writes a command to the bridge. Commands written while the
+        connection is down are held and replayed, in order, once it has
+        been re-established.
+
+        @param data: The bytes to write
+        @type data: hex
+        """
+        self.writev([data])
+
+    def writev(self, buffers):
+        """
+        Writes several commands to the bridge with a single vectored
+        write.
+
+        @param buffers: The commands to write
+        @type buffers: list
+        """
+        with self._lock:
+            if self._closed:
+                raise IOError("Transport is closed")
+            if len(self._backlog) + len(buffers) > self.max_backlog:
+                raise IOError("Too many commands buffered for %r" %
+                              (self.address,))
+            self._backlog.extend(buffers)
+            self._flush_backlog()
+
+    def close(self):
+        """
+        Closes the connection and discards any buffered commands.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._backlog.clear()
+            self._sock.close()
+
+
+class TCPTransport(SocketTransport):
+    """
+    A transport to a serial bridge reached over TCP.
+    """
+
+    def __init__(self, host, port, **kwargs):
+        """
+        Initialises the class and connects to the bridge
+
+        >>> ser = TCPTransport('10.0.0.5', 4001)
+        >>> parser = BLEParser(ser, callback=analyse_packet)
+
+        @param host: The host name or address of the bridge
+        @type host: string
+
+        @param port: The TCP port of the bridge
+        @type port: int
+
+        @param kwargs: Options for SocketTransport
+        """
+        super(TCPTransport, self).__init__((host, port), **kwargs)
+
+    def _addresses(self):
+        return [(family, address) for family, _, _, _, address in
+                socket.getaddrinfo(self.address[0], self.address[1], 0,
+                                   socket.SOCK_STREAM)]
+
+    def _configure(self, sock):
+        super(TCPTransport, self)._configure(sock)
+        # commands are small, hence never hold them back to coalesce
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+class UnixTransport(SocketTransport):
+    """
+    A transport to a serial bridge listening on a Unix domain socket.
+    """
+
+    def __init__(self, path, **kwargs):
+        """
+        Initialises the class and connects to the bridge
+
+        @param path: The path of the socket
+        @type path: string
+
+        @param kwargs: Options for SocketTransport
+        """
+        super(UnixTransport, self).__init__(path, **kwargs)
+
+    def _addresses(self):
+        return [(socket.AF_UNIX, self.address)]
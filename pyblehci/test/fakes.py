@@ -0,0 +1,161 @@
+"""
+@fn fakes.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Stand-ins for serial ports and devices, and builders for the
+    event packets they send, shared by the tests.
+"""
+
+import threading
+import time
+
+
+def ext_event(subcode, status='\x00', payload=''):
+    """
+    Builds an HCI_LE_ExtEvent packet.
+
+    >>> ext_event("0606", payload="\\x00\\x00\\x13")
+    '\\x04\\xff\\x06\\x06\\x06\\x00\\x00\\x00\\x13'
+
+    @param subcode: The event subcode
+    @type subcode: hex
+
+    @param status: The status byte
+    @type status: hex
+
+    @param payload: The raw fields of the event
+    @type payload: hex
+
+    @return: The event packet
+    """
+    data = subcode.decode('hex')[::-1] + status + payload
+    return '\x04\xff' + chr(len(data)) + data
+
+
+def command_status(cmd, status='\x00', value=None):
+    """
+    Builds the GAP_HCI_ExtentionCommandStatus event for a command.
+
+    @param cmd: The command
+    @type cmd: hex
+
+    @param status: The status byte
+    @type status: hex
+
+    @param value: The parameter value returned, if any
+    @type value: hex
+
+    @return: The event packet
+    """
+    payload = cmd.decode('hex')[::-1]
+    if value is None:
+        payload += '\x00'
+    else:
+        payload += chr(len(value)) + value
+    return ext_event("067f", status, payload)
+
+
+def opcode(packet):
+    """
+    Finds the command of a command packet.
+
+    @param packet: The command packet
+    @type packet: hex
+
+    @return: The command, as given to BLEBuilder
+    """
+    return packet[1:3][::-1].encode('hex')
+
+
+def wait_for(condition, timeout=1.0):
+    """
+    Polls a condition until it holds or the timeout passes.
+
+    @param condition: The method to poll
+    @type condition: <function>
+
+    @param timeout: The time to wait, in seconds
+    @type timeout: float
+
+    @return: The last value returned by the condition
+    """
+    deadline = time.time() + timeout
+    result = condition()
+    while not result and time.time() < deadline:
+        time.sleep(0.005)
+        result = condition()
+    return result
+
+
+class FakeClock(object):
+    """
+    A time source advanced by the test.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeSerial(object):
+    """
+    A serial port fed by the test, without a file descriptor. Written
+    packets are recorded and may be answered by a fake device.
+    """
+
+    def __init__(self, respond=None, timeout=None):
+        """
+        Initialises the class
+
+        @param respond: The method to call with each packet written,
+            standing in for a device
+        @type respond: <function>
+
+        @param timeout: The time reads wait for data, in seconds. Reads
+            return at once if None.
+        @type timeout: float
+        """
+        self.respond = respond
+        self.timeout = timeout
+        self.written = []
+        # error raised by writes, if set
+        self.fail = None
+        self._data = ''
+        self._lock = threading.Lock()
+
+    def feed(self, data):
+        with self._lock:
+            self._data += data
+
+    def inWaiting(self):
+        with self._lock:
+            return len(self._data)
+
+    def read(self, size=1):
+        if self.timeout is not None:
+            wait_for(self.inWaiting, self.timeout)
+        with self._lock:
+            data, self._data = self._data[:size], self._data[size:]
+        return data
+
+    def write(self, data):
+        if self.fail is not None:
+            raise self.fail
+        self.written.append(data)
+        if self.respond:
+            self.respond(data)
+
+    def commands(self):
+        """
+        Getter method for the commands written
+
+        @return: The command of each packet written, in order
+        """
+        return [opcode(packet) for packet in self.written]
+
+    def close(self):
+        pass
@@ -0,0 +1,151 @@
+"""
+@fn test_ble_bus.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for sharing a device's event stream over a Unix domain
+    socket.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_bus import EventPublisher, EventSubscriber
+from pyblehci.ble_parser import BLEParser
+from pyblehci.test.fakes import FakeSerial, ext_event, wait_for
+
+# GAP_HCI_ExtentionCommandStatus for GAP_GetParam
+COMMAND_STATUS = '\x04\xff\x08\x7f\x06\x00\x31\xfe\x02\xd0\x07'
+# GAP_DeviceDiscoveryDone, with one device
+DISCOVERY_DONE = ext_event(
+    "0601", payload='\x01\x00\x00\x57\x6a\xe4\x31\x18\x00')
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "Unix sockets required")
+class TestEventBus(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bus.sock')
+        self.port = FakeSerial()
+        self.parser = BLEParser(self.port, callback=lambda response: None)
+        self.errors = []
+        self.publisher = EventPublisher(
+            self.path, self.parser, BLEBuilder(self.port),
+            on_error=lambda command, error: self.errors.append(
+                (command, error)))
+        self.subscribers = []
+
+    def tearDown(self):
+        for subscriber in self.subscribers:
+            subscriber.stop()
+        self.publisher.close()
+        self.parser.stop()
+        shutil.rmtree(self.dir)
+
+    def _subscribe(self, **kwargs):
+        received = []
+        subscriber = EventSubscriber(self.path, received.append, **kwargs)
+        self.subscribers.append(subscriber)
+        self.assertTrue(wait_for(
+            lambda: len(self.publisher) == len(self.subscribers)))
+        return subscriber, received
+
+    def test_publish(self):
+        _, everything = self._subscribe()
+        _, discoveries = self._subscribe(subcodes=["0601"], typed=True)
+
+        self.port.feed(COMMAND_STATUS + DISCOVERY_DONE)
+        self.assertTrue(wait_for(
+            lambda: len(everything) == 2 and discoveries))
+        self.assertEqual([data for data, _ in everything],
+                         [COMMAND_STATUS, DISCOVERY_DONE])
+        # only subscribed events are delivered, parsed as requested
+        self.assertEqual(len(discoveries), 1)
+        self.assertEqual(discoveries[0][1]['devices'][0]['addr'][1],
+                         '00:18:31:E4:6A:57')
+
+    def test_commands(self):
+        first, _ = self._subscribe()
+        second, _ = self._subscribe()
+        first.send("GAP_GetParam", param_id=0x15)
+        second.send("fe04", mode=3)
+        self.assertTrue(wait_for(lambda: len(self.port.written) == 2))
+        self.assertEqual(sorted(self.port.written), [
+            '\x01\x04\xfe\x03\x03\x01\x00', '\x01\x31\xfe\x01\x15'])
+
+    def test_invalid_command_drops_subscriber(self):
+        self._subscribe()
+        bad = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        bad.connect(self.path)
+        self.assertTrue(wait_for(lambda: len(self.publisher) == 2))
+        bad.sendall('\x04\xff\x00\x00')
+        self.assertTrue(wait_for(lambda: len(self.publisher) == 1))
+        self.assertEqual(bad.recv(1), '')
+        bad.close()
+
+    def test_slow_subscriber_dropped(self):
+        self.publisher.max_backlog = 1024
+        # connected, but never reading
+        slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        slow.connect(self.path)
+        self.assertTrue(wait_for(lambda: len(self.publisher) == 1))
+
+        # once the socket's buffers fill, packets are queued until the
+        # backlog is exceeded
+        published = 0
+        while len(self.publisher) and published < 100000:
+            self.publisher.publish((COMMAND_STATUS, None))
+            published += 1
+        self.assertEqual(len(self.publisher), 0)
+
+        received = ''
+        data = slow.recv(65536)
+        while data:
+            received += data
+            data = slow.recv(65536)
+        # the packets sent before the subscriber was dropped, in order
+        self.assertTrue(len(received) < published * len(COMMAND_STATUS))
+        self.assertEqual(received, (COMMAND_STATUS * published)[
+            :len(received)])
+        slow.close()
+
+    def test_unsubscribe(self):
+        subscriber, _ = self._subscribe()
+        subscriber.stop()
+        self.subscribers.remove(subscriber)
+        self.assertTrue(wait_for(lambda: len(self.publisher) == 0))
+
+    def test_close(self):
+        self._subscribe()
+        self.publisher.close()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(self.publisher.is_alive())
+        self.assertTrue(self.publisher.publish not in self.parser._listeners)
+        # closing again from tearDown has no effect
+        self.publisher.close = lambda: None
+
+    def test_failed_write_is_dropped(self):
+        subscriber, _ = self._subscribe()
+        self.port.fail = IOError("Port write failed")
+        subscriber.send("fe31", param_id=0x15)
+        self.assertTrue(wait_for(lambda: self.errors))
+        self.assertEqual(self.errors[0][0], '\x01\x31\xfe\x01\x15')
+        self.assertTrue(isinstance(self.errors[0][1], IOError))
+
+        # the publisher carries on with later commands
+        self.port.fail = None
+        subscriber.send("fe31", param_id=0x16)
+        self.assertTrue(wait_for(lambda: self.port.written))
+        self.assertEqual(self.port.written, ['\x01\x31\xfe\x01\x16'])
+        self.assertTrue(self.publisher.is_alive())
+        self.assertEqual(len(self.publisher), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+@fn test_ble_codecs.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for the typed field codecs, and their use by the builder
+    and parser.
+"""
+
+import unittest
+import uuid
+
+from pyblehci import ble_codecs
+from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_parser import BLEParser
+
+# GAP_DeviceInformation from 00:18:31:E4:6A:57 at -60 dBm
+DEVICE_INFORMATION = ('\x04\xff\x0e\x0d\x06\x00\x00\x00\x57\x6a\xe4\x31'
+                      '\x18\x00\xc4\x01\x02')
+
+
+class TestCodecs(unittest.TestCase):
+
+    def test_uint_round_trip(self):
+        for length in (1, 2, 3, 4, 6, 8):
+            for value in (0, 1, 0x15, (1 << (8 * length)) - 1):
+                data = ble_codecs.encode_uint(value, length)
+                self.assertEqual(len(data), length)
+                self.assertEqual(ble_codecs.decode_uint(data), value)
+
+    def test_uint_little_endian(self):
+        self.assertEqual(ble_codecs.encode_uint(0x1234, 2), '\x34\x12')
+        self.assertEqual(ble_codecs.decode_uint('\x18\x00'), 24)
+        self.assertEqual(ble_codecs.encode_uint(0x010203, 3), '\x03\x02\x01')
+
+    def test_uint_out_of_range(self):
+        self.assertRaises(ValueError, ble_codecs.encode_uint, 256, 1)
+        self.assertRaises(ValueError, ble_codecs.encode_uint, -1, 2)
+        self.assertRaises(ValueError, ble_codecs.encode_uint, 1 << 24, 3)
+
+    def test_sint_round_trip(self):
+        for length in (1, 2, 3, 4, 8):
+            limit = 1 << (8 * length - 1)
+            for value in (-limit, -60, -1, 0, 1, limit - 1):
+                data = ble_codecs.encode_sint(value, length)
+                self.assertEqual(len(data), length)
+                self.assertEqual(ble_codecs.decode_sint(data), value)
+
+    def test_sint_out_of_range(self):
+        self.assertEqual(ble_codecs.encode_sint(-60, 1), '\xc4')
+        self.assertRaises(ValueError, ble_codecs.encode_sint, 128, 1)
+        self.assertRaises(ValueError, ble_codecs.encode_sint, -129, 1)
+
+    def test_addr_round_trip(self):
+        data = '\x57\x6a\xe4\x31\x18\x00'
+        self.assertEqual(ble_codecs.decode_addr(data), '00:18:31:E4:6A:57')
+        self.assertEqual(ble_codecs.encode_addr('00:18:31:E4:6A:57'), data)
+        self.assertEqual(ble_codecs.encode_addr('00-18-31-e4-6a-57'), data)
+        self.assertEqual(ble_codecs.encode_addr(0x001831e46a57), data)
+        self.assertEqual(ble_codecs.addr_to_int('00:18:31:E4:6A:57'),
+                         0x001831e46a57)
+
+    def test_addr_invalid(self):
+        self.assertRaises(ValueError, ble_codecs.encode_addr, '00:18:31')
+
+    def test_uuid_round_trip(self):
+        self.assertEqual(ble_codecs.encode_uuid(0x180a, 2), '\x0a\x18')
+        self.assertEqual(ble_codecs.decode_uuid('\x0a\x18'), 0x180a)
+
+        value = uuid.UUID('f000aa00-0451-4000-b000-000000000000')
+        data = ble_codecs.encode_uuid(value, 16)
+        self.assertEqual(data, value.bytes[::-1])
+        self.assertEqual(ble_codecs.decode_uuid(data), value)
+        self.assertEqual(ble_codecs.encode_uuid(str(value), 16), data)
+
+    def test_uuid_shortened(self):
+        value = '00002a00-0000-1000-8000-00805f9b34fb'
+        self.assertEqual(ble_codecs.encode_uuid(value, 2), '\x00\x2a')
+        self.assertEqual(ble_codecs.decode_uuid(
+            ble_codecs.encode_uuid(0x2a00, 16)), uuid.UUID(value))
+        # only UUIDs built on the base UUID may be shortened
+        self.assertRaises(ValueError, ble_codecs.encode_uuid,
+                          'f000aa00-0451-4000-b000-000000000000', 2)
+
+    def test_encode_field(self):
+        field = {'name': 'handle', 'len': 2, 'type': 'uint', 'default': None}
+        self.assertEqual(ble_codecs.encode_field(field, 0x25), '\x25\x00')
+        # byte strings of the field's length are raw data
+        self.assertEqual(ble_codecs.encode_field(field, '\x25\x00'),
+                         '\x25\x00')
+        self.assertRaises(ValueError, ble_codecs.encode_field, field, None)
+
+    def test_decode_field(self):
+        field = {'name': 'handle', 'len': 2, 'type': 'uint', 'default': None}
+        self.assertEqual(ble_codecs.decode_field(field, '\x25\x00'), 0x25)
+        # untyped fields are reversed hex strings
+        field = {'name': 'value', 'len': None, 'default': None}
+        self.assertEqual(ble_codecs.decode_field(field, '\x25\x00'), '0025')
+
+
+class TestTypedBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.builder = BLEBuilder()
+
+    def test_native_values(self):
+        raw = self.builder._build_command("fe31", param_id='\x15')[0]
+        self.assertEqual(raw, '\x01\x31\xfe\x01\x15')
+        self.assertEqual(
+            self.builder._build_command("fe31", param_id=0x15)[0], raw)
+        self.assertEqual(
+            self.builder._build_command("GAP_GetParam", param_id=0x15)[0],
+            raw)
+
+    def test_addr_and_uuid(self):
+        packet = self.builder._build_command(
+            "fe09", peer_addr="00:18:31:E4:6A:57")[0]
+        self.assertEqual(packet[-6:], '\x57\x6a\xe4\x31\x18\x00')
+        packet = self.builder._build_command(
+            "fdb4", read_type="00002a00-0000-1000-8000-00805f9b34fb")[0]
+        self.assertEqual(packet[-2:], '\x00\x2a')
+
+    def test_invalid_values(self):
+        self.assertRaises(ValueError, self.builder._build_command,
+                          "fe31", param_id=300)
+        self.assertRaises(ValueError, self.builder._build_command,
+                          "fe31", param_id=None)
+        # raw data of the wrong length for a typed field
+        self.assertRaises(ValueError, self.builder._build_command,
+                          "fe30", param_id='\x15', param_value='\x05')
+        self.assertRaises(KeyError, self.builder._build_command, "fe31")
+
+    def test_unknown_command(self):
+        for cmd in ("GAP_Unknown", "zzzz", None):
+            self.assertRaises(NotImplementedError,
+                              self.builder._build_command, cmd)
+
+
+class TestTypedParser(unittest.TestCase):
+
+    def test_untyped(self):
+        packet = BLEParser()._split_response(DEVICE_INFORMATION)[1]
+        self.assertEqual(packet['addr'][1], '001831e46a57')
+        self.assertEqual(packet['rssi'][1], 'c4')
+
+    def test_typed(self):
+        packet = BLEParser(typed=True)._split_response(DEVICE_INFORMATION)[1]
+        self.assertEqual(packet['addr'],
+                         ('\x57\x6a\xe4\x31\x18\x00', '00:18:31:E4:6A:57'))
+        self.assertEqual(packet['rssi'], ('\xc4', -60))
+
+
+if __name__ == '__main__':
+    unittest.main()
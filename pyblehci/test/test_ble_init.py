@@ -0,0 +1,246 @@
+"""
+@fn test_ble_init.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for the init manager's warm starts, its cache file and
+    waiting on several devices.
+"""
+
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import time
+import unittest
+
+from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_init import DeviceInit, InitManager
+from pyblehci.ble_parser import BLEParser
+from pyblehci.ble_timers import TimerWheel
+from pyblehci.test.fakes import FakeSerial, command_status, ext_event, opcode
+
+ADDR = '\x57\x6a\xe4\x31\x18\x00'
+
+
+class SilentBuilder(object):
+    """
+    A builder for a device that never responds.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, cmd, **kwargs):
+        self.sent.append(cmd)
+
+
+class SilentParser(object):
+    """
+    A parser whose timers are never advanced.
+    """
+
+    def __init__(self):
+        self.timers = TimerWheel()
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+
+class FakeDevice(object):
+    """
+    A device answering GAP_DeviceInit, GAP_SetParam and GAP_GetParam.
+    Events are fed to the port, hence read by the parser's thread some
+    time after each command is written.
+    """
+
+    def __init__(self):
+        self.port = FakeSerial(respond=self.respond)
+        # raw value of each GAP parameter set, by parameter id
+        self.params = {}
+
+    def reset(self):
+        self.params = {}
+
+    def respond(self, packet):
+        cmd = opcode(packet)
+        if cmd == "fe31":
+            # parameters that were never set read as zero
+            value = self.params.get(ord(packet[4]), '\x00\x00')
+            self.port.feed(command_status(cmd, value=value))
+            return
+        self.port.feed(command_status(cmd))
+        if cmd == "fe00":
+            self.port.feed(ext_event("0600", payload=(
+                ADDR + '\x1b\x00\x04' + '\x00' * 32)))
+        elif cmd == "fe30":
+            self.params[ord(packet[4])] = packet[5:7]
+
+
+class TestInitManager(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'init.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_init_all_shares_timeout(self):
+        manager = InitManager(self.path)
+        devices = dict(('/dev/ttyACM%d' % index,
+                        (SilentBuilder(), SilentParser()))
+                       for index in range(3))
+
+        start = time.time()
+        requests = manager.init_all(devices, timeout=0.2)
+        elapsed = time.time() - start
+
+        # a single timeout for all of the devices, not one for each
+        self.assertTrue(0.2 <= elapsed < 0.4, elapsed)
+        self.assertEqual(sorted(requests), sorted(devices))
+        for request in requests.values():
+            self.assertEqual(request.state, DeviceInit.PENDING)
+            self.assertEqual(request.builder.sent, ["fe00"])
+
+    @unittest.skipUnless(os.name == 'posix', "POSIX permissions required")
+    def test_cache_file_mode(self):
+        manager = InitManager(self.path)
+        manager.cache['/dev/ttyACM0'] = {'device': {'irk': '11' * 16}}
+        manager._save('/dev/ttyACM0')
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        # no temporary files are left behind
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         ['init.json', 'init.json.lock'])
+        self.assertEqual(InitManager(self.path).cache, manager.cache)
+
+        manager.forget('/dev/ttyACM0')
+        self.assertEqual(InitManager(self.path).cache, {})
+
+    def test_cache_shared(self):
+        first = InitManager(self.path)
+        second = InitManager(self.path)
+        first.cache['/dev/ttyACM0'] = {'device': {'irk': '11' * 16}}
+        first._save('/dev/ttyACM0')
+        # written without having seen the first entry, which is kept
+        second.cache['/dev/ttyACM1'] = {'device': {'irk': '22' * 16}}
+        second._save('/dev/ttyACM1')
+
+        cache = InitManager(self.path).cache
+        self.assertEqual(sorted(cache), ['/dev/ttyACM0', '/dev/ttyACM1'])
+        self.assertEqual(second.cache, cache)
+
+        first.forget('/dev/ttyACM0')
+        self.assertEqual(list(InitManager(self.path).cache),
+                         ['/dev/ttyACM1'])
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'init.json')
+        self.device = FakeDevice()
+        self.parser = BLEParser(self.device.port,
+                                callback=lambda response: None)
+        self.builder = BLEBuilder(self.device.port)
+
+    def tearDown(self):
+        self.parser.stop()
+        shutil.rmtree(self.dir)
+
+    def _init(self, manager=None, **kwargs):
+        self.device.port.written = []
+        manager = manager or InitManager(self.path, timeout=1.0)
+        request = manager.init('/dev/ttyACM0', self.builder, self.parser,
+                               **kwargs)
+        self.assertTrue(request.wait(1.0))
+        return request
+
+    def test_full_init(self):
+        request = self._init(params={'TGAP_CONN_EST_INT_MIN': 80},
+                             read=['TGAP_CONN_EST_INT_MAX'])
+        self.assertEqual(request.state, DeviceInit.COMPLETE)
+        self.assertFalse(request.warm)
+        # the requested parameter, then the marker, then those read
+        self.assertEqual(self.device.port.commands(),
+                         ["fe00", "fe30", "fe30", "fe31"])
+        self.assertEqual(request.device['dev_addr'], '00:18:31:E4:6A:57')
+        self.assertEqual(request.device['data_pkt_len'], 27)
+        self.assertEqual(request.params, {
+            'TGAP_CONN_EST_INT_MIN': 80, 'TGAP_CONN_EST_INT_MAX': 0})
+
+        marker = BLEBuilder.gap_params[InitManager.marker]
+        cached = InitManager(self.path).cache['/dev/ttyACM0']
+        self.assertEqual(cached['params'][InitManager.marker],
+                         struct.unpack('<H', self.device.params[marker])[0])
+
+    def test_warm_start(self):
+        first = self._init(read=['TGAP_CONN_EST_INT_MAX'])
+        request = self._init(read=['TGAP_CONN_EST_INT_MAX'])
+        self.assertEqual(request.state, DeviceInit.COMPLETE)
+        self.assertTrue(request.warm)
+        # only the marker is read back, and GAP_DeviceInit is skipped
+        self.assertEqual(self.device.port.commands(), ["fe31"])
+        self.assertEqual(self.device.port.written[0][-1],
+                         chr(BLEBuilder.gap_params[InitManager.marker]))
+        self.assertEqual(request.device, first.device)
+        self.assertEqual(request.params, first.params)
+
+    def test_reset(self):
+        first = self._init()
+        marker = InitManager(self.path).cache['/dev/ttyACM0']['params'][
+            InitManager.marker]
+        self.device.reset()
+
+        request = self._init()
+        self.assertEqual(request.state, DeviceInit.COMPLETE)
+        self.assertFalse(request.warm)
+        # the marker did not match, hence the device is initialised again
+        self.assertEqual(self.device.port.commands(),
+                         ["fe31", "fe00", "fe30"])
+        self.assertEqual(request.device, first.device)
+        self.assertNotEqual(InitManager(self.path).cache['/dev/ttyACM0'][
+            'params'][InitManager.marker], marker)
+
+        # and starts warm afterwards
+        self.assertTrue(self._init().warm)
+
+    def test_config_changed(self):
+        self._init(params={'TGAP_CONN_EST_INT_MIN': 80})
+        for kwargs in ({'params': {'TGAP_CONN_EST_INT_MIN': 40}},
+                       {'params': {'TGAP_CONN_EST_INT_MIN': 40},
+                        'max_scan_rsps': 10}):
+            request = self._init(**kwargs)
+            # the cached state is not checked, as it no longer applies
+            self.assertFalse(request.warm)
+            self.assertEqual(self.device.port.commands(),
+                             ["fe00", "fe30", "fe30"])
+            self.assertTrue(self._init(**kwargs).warm)
+
+    def test_forget(self):
+        manager = InitManager(self.path, timeout=1.0)
+        self._init(manager)
+        manager.forget('/dev/ttyACM0')
+        self.assertFalse(self._init(manager).warm)
+        self.assertEqual(self.device.port.commands()[0], "fe00")
+
+    def test_cache_not_writable(self):
+        manager = InitManager(os.path.join(self.dir, 'missing', 'init.json'))
+        request = self._init(manager)
+        # the device is initialised, but will not start warm next time
+        self.assertEqual(request.state, DeviceInit.COMPLETE)
+        self.assertTrue(isinstance(request.cache_error, (IOError, OSError)))
+        self.assertTrue(self.parser.is_alive())
+        self.assertEqual(self.parser.stats['errors'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+"""
+@fn test_ble_link.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for connection parameter negotiation, driven by a fake clock
+    and events passed to the link manager.
+"""
+
+import struct
+import unittest
+
+from pyblehci import ble_link
+from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_link import LinkManager, LinkUpdate
+from pyblehci.ble_parser import BLEParser
+from pyblehci.ble_timers import TimerWheel
+from pyblehci.test.fakes import (FakeClock, FakeSerial, command_status,
+                                 ext_event)
+
+ADDR = '\x57\x6a\xe4\x31\x18\x00'
+
+
+def establish_link(conn_handle, interval=40, latency=0, timeout=400):
+    """
+    Builds a GAP_EstablishLink event.
+    """
+    return ext_event("0605", payload='\x00' + ADDR + struct.pack(
+        '<HHHHB', conn_handle, interval, latency, timeout, 0))
+
+
+def link_terminated(conn_handle):
+    """
+    Builds a GAP_LinkTerminated event.
+    """
+    return ext_event("0606", payload=struct.pack('<HB', conn_handle, 0x13))
+
+
+def param_update(conn_handle, interval, latency, timeout, status='\x00'):
+    """
+    Builds a GAP_LinkParamUpdate event.
+    """
+    return ext_event("0607", status, struct.pack(
+        '<HHHH', conn_handle, interval, latency, timeout))
+
+
+class TestCheckParams(unittest.TestCase):
+
+    def test_valid(self):
+        for params in ble_link.link_profiles.values():
+            ble_link.check_params(**params)
+
+    def test_invalid(self):
+        for params in ((5, 12, 0, 200), (12, 6, 0, 200), (6, 12, 500, 200),
+                       (6, 12, 0, 5), (80, 160, 4, 100)):
+            self.assertRaises(ValueError, ble_link.check_params, *params)
+
+
+class TestLinkManager(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.port = FakeSerial()
+        self.parser = BLEParser()
+        self.parser.timers = TimerWheel(tick=0.01, clock=self.clock)
+        self.manager = LinkManager(BLEBuilder(self.port), self.parser,
+                                   timeout=1.0)
+        self.ended = []
+        self._event(establish_link(0))
+
+    def _event(self, packet):
+        response = self.parser._split_response(packet)
+        for listener in self.parser._listeners:
+            listener(response)
+
+    def _wait(self, seconds):
+        self.clock.now += seconds
+        self.parser.timers.advance()
+
+    def test_links(self):
+        self._event(establish_link(1, 80, 4, 600))
+        link = self.manager.links[1]
+        self.assertEqual(link.dev_addr, '00:18:31:E4:6A:57')
+        self.assertEqual((link.conn_interval, link.conn_latency,
+                          link.conn_timeout), (80, 4, 600))
+        self._event(link_terminated(1))
+        self.assertEqual(list(self.manager.links), [0])
+
+    def test_apply_profile(self):
+        update = self.manager.apply_profile(0, 'low power',
+                                            callback=self.ended.append)
+        self.assertEqual(self.port.written, [
+            '\x01\x11\xfe\x0a\x00\x00\x50\x00\xa0\x00\x04\x00\x58\x02'])
+        self._event(command_status("fe11"))
+        self.assertFalse(update.done())
+
+        self._event(param_update(0, 120, 4, 600))
+        self.assertTrue(update.wait(0))
+        self.assertEqual(update.state, LinkUpdate.COMPLETE)
+        self.assertEqual(self.ended, [update])
+        link = self.manager.links[0]
+        self.assertEqual(link.profile, 'low power')
+        self.assertEqual((link.conn_interval, link.conn_latency,
+                          link.conn_timeout), (120, 4, 600))
+        self.assertEqual(len(self.parser.timers), 0)
+
+    def test_unknown(self):
+        self.assertRaises(KeyError, self.manager.apply_profile, 0, 'fast')
+        self.assertRaises(KeyError, self.manager.apply_profile, 1,
+                          'low power')
+        self.assertEqual(self.port.written, [])
+
+    def test_one_update_per_link(self):
+        self.manager.apply_profile(0, 'low power')
+        self.assertRaises(RuntimeError, self.manager.apply_profile, 0,
+                          'low latency')
+        # other links are unaffected
+        self._event(establish_link(1))
+        self.manager.apply_profile(1, 'low latency')
+        self.assertEqual(len(self.port.written), 2)
+
+    def test_rejected(self):
+        self._event(establish_link(1))
+        first = self.manager.apply_profile(0, 'low power')
+        second = self.manager.apply_profile(1, 'low power')
+        # command statuses are matched to updates in the order sent
+        self._event(command_status("fe11"))
+        self._event(command_status("fe11", status='\x12'))
+        self.assertFalse(first.done())
+        self.assertEqual(second.state, LinkUpdate.ERROR)
+        # a status for another command is ignored
+        self._event(command_status("fe31", value='\xd0\x07'))
+        self.assertFalse(first.done())
+
+    def test_refused_by_peer(self):
+        update = self.manager.apply_profile(0, 'low power')
+        self._event(command_status("fe11"))
+        self._event(param_update(0, 40, 0, 400, status='\x3b'))
+        self.assertEqual(update.state, LinkUpdate.ERROR)
+        self.assertEqual(self.manager.links[0].conn_interval, 40)
+        self.assertEqual(self.manager.links[0].profile, None)
+
+    def test_timeout(self):
+        update = self.manager.apply_profile(0, 'low power',
+                                            callback=self.ended.append)
+        self._event(command_status("fe11"))
+        self._wait(0.5)
+        self.assertFalse(update.done())
+        self._wait(0.6)
+        self.assertEqual(update.state, LinkUpdate.TIMEOUT)
+        self.assertEqual(self.ended, [update])
+        # a late confirmation is taken as a change by the peer
+        self._event(param_update(0, 120, 4, 600))
+        self.assertEqual(self.manager.links[0].conn_interval, 120)
+        self.assertEqual(self.manager.links[0].profile, None)
+
+    def test_link_terminated(self):
+        update = self.manager.apply_profile(0, 'low power')
+        self._event(link_terminated(0))
+        self.assertEqual(update.state, LinkUpdate.ERROR)
+        self.assertEqual(self.manager.links, {})
+        self.assertEqual(len(self.parser.timers), 0)
+
+    def test_changed_by_peer(self):
+        update = self.manager.apply_profile(0, 'low latency')
+        self._event(command_status("fe11"))
+        self._event(param_update(0, 8, 0, 100))
+        self.assertEqual(update.state, LinkUpdate.COMPLETE)
+        self._event(param_update(0, 24, 0, 100))
+        self.assertEqual(self.manager.links[0].conn_interval, 24)
+        self.assertEqual(self.manager.links[0].profile, None)
+
+    def test_restore(self):
+        self.manager.apply_profile(0, 'low power')
+        self._event(command_status("fe11"))
+        self._event(param_update(0, 120, 4, 600))
+
+        update = self.manager.restore(0)
+        self.assertEqual(update.params, {
+            'interval_min': 40, 'interval_max': 40, 'conn_latency': 0,
+            'conn_timeout': 400})
+        self._event(command_status("fe11"))
+        self._event(param_update(0, 40, 0, 400))
+        self.assertEqual(update.state, LinkUpdate.COMPLETE)
+        self.assertEqual(self.manager.links[0].profile, None)
+
+    def test_write_error(self):
+        self.port.fail = IOError("Port write failed")
+        self.assertRaises(IOError, self.manager.apply_profile, 0,
+                          'low power')
+        # the update was never sent, hence is forgotten entirely
+        self.assertEqual(len(self.parser.timers), 0)
+
+        self.port.fail = None
+        self._event(establish_link(1))
+        first = self.manager.apply_profile(0, 'low power')
+        second = self.manager.apply_profile(1, 'low power')
+        self._event(command_status("fe11", status='\x12'))
+        self.assertEqual(first.state, LinkUpdate.ERROR)
+        self.assertFalse(second.done())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""
+@fn test_ble_pack.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for the compact binary serialisation of parsed packets.
+"""
+
+import StringIO
+import unittest
+
+from pyblehci.ble_pack import MAGIC, RAW_RECORD, PacketReader, PacketWriter
+from pyblehci.ble_parser import BLEParser
+
+FRAMES = [
+    # GAP_DeviceInitDone
+    '\x04\xff\x2c\x00\x06\x00\x06\x30\x85\x31\x18\x00\x1b\x00\x04\x00\x00'
+    '\x00\x00\x00\x00\x00\x00\x09\x09\x09\x09\x00\x00\x00\x00\x00\x00\x00'
+    '\x00\x00\x00\x00\x00\x00\x00\x09\x09\x09\x09\x00\x00',
+    # GAP_HCI_ExtentionCommandStatus
+    '\x04\xff\x08\x7f\x06\x00\x31\xfe\x02\xd0\x07',
+    # GAP_DeviceDiscoveryDone, with a list of devices
+    '\x04\xff\x14\x01\x06\x00\x01\x00\x00\x57\x6a\xe4\x31\x18\x00\x11\x11'
+    '\x11\x11\x11\x11\x11\x11',
+    # GAP_DeviceDiscoveryDone, without any devices
+    '\x04\xff\x04\x01\x06\x00\x00',
+    # GAP_DeviceInformation
+    '\x04\xff\x0e\x0d\x06\x00\x00\x00\x57\x6a\xe4\x31\x18\x00\xc4\x01\x02',
+    # ATT_HandleValueNotification
+    '\x04\xff\x0b\x1b\x05\x00\x00\x00\x05\x25\x00\x01\x02\x03',
+]
+
+
+class TestPack(unittest.TestCase):
+
+    def _responses(self, typed=False):
+        parser = BLEParser(typed=typed)
+        return [parser._split_response(frame) for frame in FRAMES]
+
+    def _round_trip(self, responses, typed=False, **kwargs):
+        stream = StringIO.StringIO()
+        writer = PacketWriter(stream, **kwargs)
+        for response in responses:
+            writer.write(response)
+        stream.seek(0)
+        return list(PacketReader(stream, typed=typed)), stream.getvalue()
+
+    def test_round_trip(self):
+        responses = self._responses()
+        unpacked, packed = self._round_trip(responses)
+        self.assertEqual(unpacked, responses)
+        self.assertTrue(packed.startswith(MAGIC))
+
+        writer = PacketWriter(StringIO.StringIO())
+        for response in responses:
+            # the packet type, event code and data length are implied
+            self.assertEqual(len(writer.pack(response)),
+                             len(response[0]) - 3)
+
+    def test_round_trip_typed(self):
+        responses = self._responses(typed=True)
+        unpacked, _ = self._round_trip(responses, typed=True)
+        self.assertEqual(unpacked, responses)
+
+    def test_round_trip_parsed_only(self):
+        # packets given without their data are packed from their fields
+        responses = self._responses()
+        unpacked, _ = self._round_trip(
+            [(None, parsed_packet) for _, parsed_packet in responses])
+        self.assertEqual(unpacked, responses)
+
+    def test_record(self):
+        writer = PacketWriter(StringIO.StringIO())
+        record = writer.pack(self._responses()[1])
+        self.assertEqual(record[1:], '\x00\x05\x31\xfe\x02\xd0\x07')
+        self.assertEqual(writer._subcodes[ord(record[0])], '067f')
+
+    def test_raw_record(self):
+        # subcodes unknown to the writer are stored whole
+        ext_events = {'067f': BLEParser.ext_events['067f']}
+        responses = self._responses()
+        unpacked, packed = self._round_trip(responses, ext_events=ext_events)
+        self.assertEqual(unpacked, responses)
+
+        record = PacketWriter(StringIO.StringIO(), ext_events).pack(
+            responses[0])
+        self.assertEqual(ord(record[0]), RAW_RECORD)
+        self.assertEqual(record[3:], FRAMES[0])
+
+    def test_write_many(self):
+        responses = self._responses()
+        stream = StringIO.StringIO()
+        PacketWriter(stream).write_many(responses)
+        _, packed = self._round_trip(responses)
+        self.assertEqual(stream.getvalue(), packed)
+
+    def test_empty_stream(self):
+        stream = StringIO.StringIO()
+        PacketWriter(stream).write_many([])
+        stream.seek(0)
+        self.assertEqual(list(PacketReader(stream)), [])
+
+    def test_invalid_stream(self):
+        self.assertRaises(ValueError, PacketReader,
+                          StringIO.StringIO('JUNK\x01\x00'))
+        self.assertRaises(ValueError, PacketReader,
+                          StringIO.StringIO(MAGIC + '\x02\x00'))
+
+    def test_unwritten_stream(self):
+        # a writer given no packets writes nothing, not even a header
+        self.assertEqual(list(PacketReader(StringIO.StringIO())), [])
+
+    def test_truncated_stream(self):
+        responses = self._responses()
+        _, packed = self._round_trip(responses)
+        writer = PacketWriter(StringIO.StringIO())
+        # offsets at which each record ends
+        ends = [len(packed) - sum(len(writer.pack(r)) for r in responses)]
+        for response in responses:
+            ends.append(ends[-1] + len(writer.pack(response)))
+
+        for offset in range(1, len(packed)):
+            stream = StringIO.StringIO(packed[:offset])
+            if offset in ends:
+                # cut between records, hence simply fewer of them
+                self.assertEqual(list(PacketReader(stream)),
+                                 responses[:ends.index(offset)])
+                continue
+            try:
+                list(PacketReader(stream))
+            except ValueError:
+                pass
+            else:
+                self.fail("No error for a stream cut at %d" % offset)
+
+    def test_unknown_record(self):
+        _, packed = self._round_trip(self._responses()[:1])
+        header = len(packed) - len(
+            PacketWriter(StringIO.StringIO()).pack(self._responses()[0]))
+        stream = StringIO.StringIO(packed[:header] + '\xf0\x00\x00')
+        self.assertRaises(ValueError, list, PacketReader(stream))
+
+
+if __name__ == '__main__':
+    unittest.main()
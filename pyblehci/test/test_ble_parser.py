@@ -0,0 +1,246 @@
+"""
+@fn test_ble_parser.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for the parser's handling of unknown and malformed packets,
+    and its delivery of packets in batches.
+"""
+
+import threading
+import time
+import unittest
+
+from pyblehci.ble_parser import BLEParser
+from pyblehci.test.fakes import FakeSerial, wait_for
+
+# GAP_HCI_ExtentionCommandStatus for GAP_GetParam
+COMMAND_STATUS = '\x04\xff\x08\x7f\x06\x00\x31\xfe\x02\xd0\x07'
+# HCI_LE_ExtEvent with a subcode that has no packet format
+UNKNOWN_SUBCODE = '\x04\xff\x05\x10\x06\x00\x01\x02'
+# HCI_Command_Complete, an event code that has no packet format
+UNKNOWN_EVENT = '\x04\x0e\x04\x01\x03\x0c\x00'
+# GAP_HCI_ExtentionCommandStatus cut short
+TRUNCATED = '\x04\xff\x02\x7f\x06'
+# GAP_EstablishLink cut to 5 data bytes
+SHORT_LINK = '\x04\xff\x08\x05\x06\x00\x00\x57\x6a\xe4\x31'
+# ATT_ReadByTypeRsp ending a procedure, without a PDU
+PROCEDURE_COMPLETE = '\x04\xff\x06\x09\x05\x1a\x00\x00\x00'
+# GAP_HCI_ExtentionCommandStatus for an unknown command
+UNKNOWN_OPCODE = '\x04\xff\x08\x7f\x06\x00\x99\x99\x02\xd0\x07'
+
+
+class TestQuarantine(unittest.TestCase):
+
+    def setUp(self):
+        self.unparsed = []
+        self.parser = BLEParser(
+            unparsed=lambda packet, error: self.unparsed.append(
+                (packet, error)))
+
+    def test_parsed(self):
+        response = self.parser._parse_frame(COMMAND_STATUS)
+        self.assertEqual(response[0], COMMAND_STATUS)
+        self.assertEqual(self.parser.stats['parsed'], 1)
+        self.assertEqual(self.unparsed, [])
+
+    def test_unknown(self):
+        self.assertEqual(self.parser._parse_frame(UNKNOWN_SUBCODE), None)
+        self.assertEqual(self.parser._parse_frame(UNKNOWN_EVENT), None)
+        self.assertEqual(self.parser._parse_frame(UNKNOWN_SUBCODE), None)
+        self.assertEqual(self.parser.stats['unknown'], 3)
+        self.assertEqual(self.parser.stats['malformed'], 0)
+        self.assertEqual(dict(self.parser.unknown_codes),
+                         {'0610': 2, '0e': 1})
+        self.assertEqual([packet for packet, _ in self.unparsed],
+                         [UNKNOWN_SUBCODE, UNKNOWN_EVENT, UNKNOWN_SUBCODE])
+        self.assertTrue(isinstance(self.unparsed[0][1], KeyError))
+
+    def test_malformed(self):
+        self.assertEqual(self.parser._parse_frame(TRUNCATED), None)
+        self.assertEqual(self.parser._parse_frame(UNKNOWN_OPCODE), None)
+        self.assertEqual(self.parser.stats['malformed'], 2)
+        self.assertEqual(self.parser.stats['unknown'], 0)
+        self.assertEqual(len(self.parser.unknown_codes), 0)
+        self.assertTrue(isinstance(self.unparsed[0][1], IndexError))
+
+    def test_short_packet(self):
+        # fixed length fields must not be left empty
+        for typed in (False, True):
+            parser = BLEParser(typed=typed)
+            self.assertEqual(parser._parse_frame(SHORT_LINK), None)
+            self.assertEqual(parser.stats['malformed'], 1)
+            self.assertEqual(parser.stats['parsed'], 0)
+        self.assertRaises(ValueError, BLEParser()._split_response,
+                          SHORT_LINK)
+
+    def test_fields_omitted_on_failure(self):
+        for typed in (False, True):
+            parser = BLEParser(typed=typed)
+            packet = parser._parse_frame(PROCEDURE_COMPLETE)[1]
+            self.assertEqual(packet['status'][0], '\x1a')
+            self.assertEqual(packet['conn_handle'][0], '\x00\x00')
+            self.assertEqual(packet['pdu_len'][0], '\x00')
+            self.assertFalse('length' in packet)
+            self.assertEqual(parser.stats['malformed'], 0)
+
+    def test_without_handler(self):
+        parser = BLEParser()
+        self.assertEqual(parser._parse_frame(TRUNCATED), None)
+        self.assertEqual(parser.stats['malformed'], 1)
+
+
+class TestReader(unittest.TestCase):
+
+    def setUp(self):
+        self.port = FakeSerial()
+        self.events = []
+        self.unparsed = []
+
+    def _start(self, **kwargs):
+        self.errors = []
+        self.parser = BLEParser(
+            self.port, callback=self.events.append,
+            unparsed=lambda packet, error: self.unparsed.append(packet),
+            on_error=lambda response, error: self.errors.append(
+                (response, error)),
+            **kwargs)
+        self.addCleanup(self.parser.stop)
+
+    def _wait_for(self, count):
+        deadline = time.time() + 1.0
+        while len(self.events) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_reader_survives_bad_packets(self):
+        self._start()
+        # bytes that cannot start a packet are skipped
+        self.port.feed('\x99\x01\x02' + COMMAND_STATUS)
+        for packet in (UNKNOWN_SUBCODE, UNKNOWN_EVENT, UNKNOWN_OPCODE,
+                       COMMAND_STATUS):
+            self.port.feed(packet)
+        self._wait_for(2)
+
+        self.assertTrue(self.parser.is_alive())
+        self.assertEqual([data for data, _ in self.events],
+                         [COMMAND_STATUS, COMMAND_STATUS])
+        self.assertEqual(self.unparsed,
+                         [UNKNOWN_SUBCODE, UNKNOWN_EVENT, UNKNOWN_OPCODE])
+        self.assertEqual(self.parser.stats, {
+            'parsed': 2, 'unknown': 2, 'malformed': 1, 'dropped': 3,
+            'errors': 0})
+
+    def test_batch_skips_bad_packets(self):
+        self._start(batch=True)
+        self.port.feed(UNKNOWN_SUBCODE + COMMAND_STATUS * 2)
+        self._wait_for(1)
+
+        self.assertEqual(len(self.events), 1)
+        self.assertEqual([data for data, _ in self.events[0]],
+                         [COMMAND_STATUS, COMMAND_STATUS])
+        self.assertEqual(self.unparsed, [UNKNOWN_SUBCODE])
+
+    def test_reader_survives_listener_errors(self):
+        self._start()
+        calls = []
+
+        def fail(response):
+            calls.append(response)
+            raise IOError("Port write failed")
+        self.parser.add_listener(fail)
+        self.port.feed(COMMAND_STATUS * 2)
+        self._wait_for(2)
+
+        self.assertTrue(self.parser.is_alive())
+        # the callback still sees every packet
+        self.assertEqual(len(self.events), 2)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.parser.stats['errors'], 2)
+        self.assertEqual(self.errors[0][0][0], COMMAND_STATUS)
+        self.assertTrue(isinstance(self.errors[0][1], IOError))
+
+    def test_reader_survives_timer_errors(self):
+        self._start()
+
+        def fail():
+            raise OSError("Port write failed")
+        self.parser.timers.schedule(0.01, fail)
+        self.parser.timers.schedule(0.02, self.events.append, 'fired')
+        self._wait_for(1)
+
+        self.assertTrue(self.parser.is_alive())
+        self.assertEqual(self.events, ['fired'])
+        self.assertEqual(self.parser.stats['errors'], 1)
+        self.assertEqual(self.errors[0][0], None)
+        self.assertTrue(isinstance(self.errors[0][1], OSError))
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.port = FakeSerial()
+        self.batches = []
+        self.seen = []
+
+    def _start(self, **kwargs):
+        self.parser = BLEParser(self.port, callback=self.batches.append,
+                                batch=True, **kwargs)
+        self.parser.add_listener(self.seen.append)
+        self.addCleanup(self.parser.stop)
+
+    def _sizes(self):
+        return [len(batch) for batch in self.batches]
+
+    def test_batch_per_read(self):
+        self._start()
+        self.port.feed(COMMAND_STATUS * 3)
+        self.assertTrue(wait_for(lambda: self.batches))
+        self.assertEqual(self._sizes(), [3])
+        # listeners still see each packet
+        self.assertEqual([data for data, _ in self.seen],
+                         [COMMAND_STATUS] * 3)
+
+        self.port.feed(COMMAND_STATUS)
+        self.assertTrue(wait_for(lambda: len(self.batches) == 2))
+        self.assertEqual(self._sizes(), [3, 1])
+
+    def test_batch_size(self):
+        self._start(batch_size=2)
+        self.port.feed(COMMAND_STATUS * 5)
+        self.assertTrue(wait_for(lambda: sum(self._sizes()) == 5))
+        self.assertEqual(self._sizes(), [2, 2, 1])
+
+    def test_batch_window(self):
+        self._start(batch_window=0.3)
+        self.port.feed(COMMAND_STATUS)
+        time.sleep(0.1)
+        self.port.feed(COMMAND_STATUS * 2)
+        self.assertTrue(wait_for(lambda: self.batches))
+        # packets arriving within the window share the first's batch
+        self.assertEqual(self._sizes(), [3])
+
+    def test_iter_batches(self):
+        parser = BLEParser(self.port, batch_size=2)
+        batches = []
+
+        def consume():
+            for batch in parser.iter_batches():
+                batches.append(batch)
+
+        consumer = threading.Thread(target=consume)
+        consumer.daemon = True
+        consumer.start()
+        self.port.feed(COMMAND_STATUS * 3 + UNKNOWN_SUBCODE)
+        self.assertTrue(wait_for(lambda: len(batches) == 2))
+        self.assertEqual([len(batch) for batch in batches], [2, 1])
+        self.assertEqual(batches[0][0][0], COMMAND_STATUS)
+
+        # stopping ends the iteration
+        parser.stop()
+        consumer.join(1.0)
+        self.assertFalse(consumer.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+@fn test_ble_proxy.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for the transparent proxy, run between two fake ports
+    standing in for a host tool and a device.
+"""
+
+import unittest
+
+from pyblehci.ble_proxy import BLEProxy
+from pyblehci.test.fakes import FakeSerial, wait_for
+
+# GAP_GetParam for TGAP_CONN_EST_INT_MIN
+GET_PARAM = '\x01\x31\xfe\x01\x15'
+# GAP_HCI_ExtentionCommandStatus for GAP_GetParam
+COMMAND_STATUS = '\x04\xff\x08\x7f\x06\x00\x31\xfe\x02\xd0\x07'
+
+
+class TestProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.host = FakeSerial(timeout=0.01)
+        self.device = FakeSerial(timeout=0.01)
+        self.packets = []
+        self.errors = []
+        self.proxy = None
+
+    def tearDown(self):
+        if self.proxy:
+            self.proxy.stop()
+
+    def _start(self, callback=None):
+        self.proxy = BLEProxy(
+            self.host, self.device, callback or self._record,
+            on_error=lambda direction, error: self.errors.append(
+                (direction, error)))
+
+    def _record(self, direction, timestamp, response):
+        self.packets.append((direction, response))
+
+    def test_forward(self):
+        self._start()
+        self.host.feed(GET_PARAM)
+        self.assertTrue(wait_for(lambda: self.device.written))
+        self.device.feed(COMMAND_STATUS)
+        self.assertTrue(wait_for(lambda: len(self.packets) == 2))
+
+        # bytes are forwarded unchanged
+        self.assertEqual(''.join(self.device.written), GET_PARAM)
+        self.assertEqual(''.join(self.host.written), COMMAND_STATUS)
+        (command_from, command), (event_from, event) = self.packets
+        self.assertEqual(command_from, BLEProxy.FROM_HOST)
+        self.assertEqual(command[0], GET_PARAM)
+        self.assertEqual(command[1]['param_id'][0], '\x15')
+        self.assertEqual(event_from, BLEProxy.FROM_DEVICE)
+        self.assertEqual(event[1]['param_value'][0], '\xd0\x07')
+        self.assertEqual(self.proxy.stats['host'], 1)
+        self.assertEqual(self.proxy.stats['device'], 1)
+
+    def test_split_reads(self):
+        self._start()
+        # a packet split across reads, then several in one read
+        self.device.feed(COMMAND_STATUS[:4])
+        self.assertTrue(wait_for(lambda: self.host.written))
+        self.device.feed(COMMAND_STATUS[4:] + COMMAND_STATUS * 2)
+        self.assertTrue(wait_for(lambda: len(self.packets) == 3))
+        self.assertEqual([response[0] for _, response in self.packets],
+                         [COMMAND_STATUS] * 3)
+
+    def test_resynchronise(self):
+        self._start()
+        self.device.feed('\x00\x99' + COMMAND_STATUS)
+        self.assertTrue(wait_for(lambda: self.packets))
+        self.assertEqual(self.packets[0][1][0], COMMAND_STATUS)
+        self.assertEqual(self.proxy.stats['dropped'], 2)
+        # the junk is still forwarded
+        self.assertEqual(''.join(self.host.written),
+                         '\x00\x99' + COMMAND_STATUS)
+
+    def test_undecodable_packet(self):
+        self._start()
+        unknown = '\x04\xff\x03\x99\x99\x00'
+        self.device.feed(unknown)
+        self.assertTrue(wait_for(lambda: self.packets))
+        self.assertEqual(self.packets[0][1], (unknown, None))
+
+    def test_callback_errors(self):
+        def callback(direction, timestamp, response):
+            if not self.packets:
+                self.packets.append(None)
+                raise RuntimeError("Callback failed")
+            self._record(direction, timestamp, response)
+
+        self._start(callback)
+        self.device.feed(COMMAND_STATUS)
+        self.assertTrue(wait_for(lambda: self.errors))
+        # decoding carries on after the error
+        self.device.feed(COMMAND_STATUS)
+        self.assertTrue(wait_for(lambda: len(self.packets) == 2))
+        self.assertEqual(self.packets[1][1][0], COMMAND_STATUS)
+        self.assertEqual(self.errors[0][0], BLEProxy.FROM_DEVICE)
+        self.assertTrue(isinstance(self.errors[0][1], RuntimeError))
+        self.assertEqual(self.proxy.stats['errors'], 1)
+        self.assertEqual(self.proxy.error, None)
+
+    def test_port_error(self):
+        self._start()
+        self.device.fail = IOError("Device disconnected")
+        self.host.feed(GET_PARAM)
+        self.assertTrue(wait_for(lambda: self.errors))
+        self.assertEqual(self.errors[0][0], BLEProxy.FROM_HOST)
+        self.assertTrue(self.proxy.error is self.device.fail)
+
+        # both directions stop, rather than one carrying on alone
+        self.assertTrue(wait_for(lambda: not any(
+            thread.is_alive() for thread in self.proxy._threads[:2])))
+        self.device.feed(COMMAND_STATUS)
+        self.assertFalse(wait_for(lambda: self.host.written, 0.05))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+"""
+@fn test_ble_queue.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for the prioritised send queue. Writes are held back by a
+    gate while packets are queued, so that the order they are taken in
+    can be checked.
+"""
+
+import threading
+import time
+import unittest
+
+from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_queue import (PRIORITY_BULK, PRIORITY_CONTROL,
+                                PRIORITY_NORMAL, SendQueue)
+from pyblehci.test.fakes import FakeClock, FakeSerial, wait_for
+
+
+class Port(object):
+    """
+    Records written packets, blocking the first write until opened.
+    """
+
+    def __init__(self):
+        self.written = []
+        self.batches = []
+        # error raised by writes, if set
+        self.fail = None
+        self.gate = threading.Event()
+
+    def write(self, packet):
+        self.gate.wait(1.0)
+        if self.fail is not None:
+            raise self.fail
+        self.written.append(packet)
+
+    def write_many(self, packets):
+        self.gate.wait(1.0)
+        self.batches.append(list(packets))
+        self.written.extend(packets)
+
+
+class TestSendQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.port = Port()
+        self.clock = FakeClock()
+        self.errors = []
+        self.queue = None
+
+    def tearDown(self):
+        self.port.gate.set()
+        # let rate limited packets drain, as closing writes them first
+        self.clock.now += 3600
+        self.queue.close()
+
+    def _start(self, **kwargs):
+        self.queue = SendQueue(self.port.write, clock=self.clock, **kwargs)
+        # held by the gate, hence later packets are queued together
+        self.queue.put('gate', PRIORITY_CONTROL)
+        self.assertTrue(wait_for(lambda: not len(self.queue)))
+
+    def _open(self):
+        self.port.gate.set()
+        self.assertTrue(self.queue.flush(1.0))
+
+    def _release(self):
+        self._open()
+        return self.port.written[1:]
+
+    def test_priority(self):
+        self._start()
+        for index in range(2):
+            self.queue.put('bulk%d' % index, PRIORITY_BULK)
+            self.queue.put('normal%d' % index)
+            self.queue.put('control%d' % index, PRIORITY_CONTROL)
+        written = self._release()
+        # control traffic first, in the order queued
+        self.assertEqual(written[:2], ['control0', 'control1'])
+        self.assertEqual(sorted(written[2:]),
+                         ['bulk0', 'bulk1', 'normal0', 'normal1'])
+
+    def test_weighted_round_robin(self):
+        self._start()
+        for index in range(10):
+            self.queue.put('normal', PRIORITY_NORMAL)
+            self.queue.put('bulk', PRIORITY_BULK)
+        written = self._release()
+        # a 4:1 share while both classes have packets waiting, with the
+        # bulk packet spread out rather than sent in a run
+        self.assertEqual(written[:10], ['normal', 'normal', 'bulk',
+                                        'normal', 'normal'] * 2)
+        self.assertEqual(written[10:], ['normal'] * 2 + ['bulk'] * 8)
+
+    def test_weights(self):
+        self._start(weights={PRIORITY_NORMAL: 1, PRIORITY_BULK: 1})
+        for index in range(3):
+            self.queue.put('normal', PRIORITY_NORMAL)
+            self.queue.put('bulk', PRIORITY_BULK)
+        written = self._release()
+        self.assertEqual(sorted(written[:2]), ['bulk', 'normal'])
+        self.assertEqual(sorted(written[2:4]), ['bulk', 'normal'])
+
+    def test_rate_limit(self):
+        self._start(rates={PRIORITY_BULK: (10, 2)})
+        self.port.gate.set()
+        for index in range(4):
+            self.queue.put('bulk%d' % index, PRIORITY_BULK)
+        self.queue.put('normal')
+        # a burst of two, and other classes are not held up
+        self.assertTrue(wait_for(lambda: len(self.port.written) == 4))
+        time.sleep(0.15)
+        self.assertEqual(sorted(self.port.written[1:]),
+                         ['bulk0', 'bulk1', 'normal'])
+
+        # then one packet for each tenth of a second
+        self.clock.now += 0.1
+        self.assertTrue(wait_for(lambda: len(self.port.written) == 5))
+        time.sleep(0.15)
+        self.assertEqual(len(self.port.written), 5)
+        self.clock.now += 0.1
+        self.assertTrue(wait_for(lambda: len(self.port.written) == 6))
+        self.assertEqual(self.port.written[-1], 'bulk3')
+
+    def test_write_many(self):
+        self.queue = SendQueue(self.port.write, clock=self.clock,
+                               write_many=self.port.write_many)
+        self.queue.put('gate', PRIORITY_CONTROL)
+        self.assertTrue(wait_for(lambda: not len(self.queue)))
+        self.queue.max_batch = 4
+        self.queue.put('bulk', PRIORITY_BULK)
+        for index in range(4):
+            self.queue.put('normal%d' % index)
+        self.queue.put('control', PRIORITY_CONTROL)
+        self._release()
+        # packets waiting together are written at once, in the order the
+        # queue takes them
+        self.assertEqual(self.port.batches[1:], [
+            ['control', 'normal0', 'normal1', 'bulk'],
+            ['normal2', 'normal3']])
+
+    def test_write_error(self):
+        self._start()
+        self._open()
+        self.port.fail = IOError("Port write failed")
+        self.queue.put('lost')
+        self.assertRaises(IOError, self.queue.flush, 1.0)
+
+        # raised once, and the queue carries on
+        self.port.fail = None
+        self.queue.put('next')
+        self.assertTrue(self.queue.flush(1.0))
+        self.assertEqual(self.port.written, ['gate', 'next'])
+
+    def test_write_error_raised_by_put(self):
+        self._start()
+        self._open()
+        self.port.fail = OSError("Port write failed")
+        self.queue.put('lost')
+        self.assertTrue(wait_for(lambda: self.queue._error is not None))
+        self.assertRaises(OSError, self.queue.put, 'dropped')
+        self.assertEqual(len(self.queue), 0)
+
+    def test_write_error_handler(self):
+        self._start(on_error=lambda packets, error: self.errors.append(
+            (packets, error)))
+        self._open()
+        self.port.fail = IOError("Port write failed")
+        self.queue.put('lost')
+        self.assertTrue(wait_for(lambda: self.errors))
+        self.assertEqual(self.errors[0][0], ['lost'])
+        self.assertTrue(isinstance(self.errors[0][1], IOError))
+
+        self.port.fail = None
+        self.queue.put('next')
+        self.assertTrue(self.queue.flush(1.0))
+        self.assertEqual(self.port.written, ['gate', 'next'])
+
+    def test_close(self):
+        self._start()
+        self.queue.put('queued')
+        self.port.gate.set()
+        # packets still queued are written before the thread stops
+        self.queue.close()
+        self.assertEqual(self.port.written, ['gate', 'queued'])
+        self.assertFalse(self.queue.is_alive())
+        self.assertRaises(RuntimeError, self.queue.put, 'late')
+
+
+class TestQueuedBuilder(unittest.TestCase):
+
+    def test_priorities(self):
+        port = FakeSerial()
+        builder = BLEBuilder(port, queued=True)
+        self.addCleanup(builder.send_queue.close)
+        builder.send_queue.max_batch = 1
+        with builder.send_queue._condition:
+            # queued together, as the writer cannot take the lock
+            builder.send("fd92", handle=0x27, value='\x01')
+            builder.send("fd8a", handle=0x27)
+            builder.send("fe31", param_id=0x15)
+        self.assertTrue(builder.send_queue.flush(1.0))
+        self.assertEqual(port.commands(), ["fe31", "fd8a", "fd92"])
+
+
+if __name__ == '__main__':
+    unittest.main()
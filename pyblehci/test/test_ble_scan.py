@@ -0,0 +1,194 @@
+"""
+@fn test_ble_scan.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for continuous, duty-cycled device discovery, driven by a
+    fake clock and events passed to the scheduler.
+"""
+
+import unittest
+
+from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_parser import BLEParser
+from pyblehci.ble_scan import ScanScheduler
+from pyblehci.ble_timers import TimerWheel
+from pyblehci.test.fakes import (FakeClock, FakeSerial, command_status,
+                                 ext_event)
+
+# GAP_DeviceDiscoveryDone, without any devices
+DISCOVERY_DONE = ext_event("0601", payload='\x00')
+# GAP_DeviceInformation from 00:18:31:E4:6A:57 at -60 dBm
+DEVICE_INFORMATION = ext_event(
+    "060d", payload='\x00\x00\x57\x6a\xe4\x31\x18\x00\xc4\x01\x02')
+# status returned when there is no discovery to cancel
+INCORRECT_MODE = '\x12'
+
+
+class TestScanScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.port = FakeSerial()
+        self.parser = BLEParser()
+        self.parser.timers = TimerWheel(tick=0.01, clock=self.clock)
+        self.scanner = ScanScheduler(BLEBuilder(self.port), self.parser,
+                                     clock=self.clock)
+
+    def _event(self, packet):
+        response = self.parser._split_response(packet)
+        for listener in self.parser._listeners:
+            listener(response)
+
+    def _wait(self, seconds):
+        # a tick over, as timers round up to whole ticks
+        self.clock.now += seconds + 0.01
+        self.parser.timers.advance()
+
+    def _requests(self):
+        return self.port.commands().count("fe04")
+
+    def test_start(self):
+        self.scanner.start()
+        # the scan parameters are written before discovery is requested
+        self.assertEqual(self.port.commands(),
+                         ["fe30", "fe30", "fe30", "fe04"])
+        self.assertEqual(self.port.written[-1],
+                         '\x01\x04\xfe\x03\x03\x01\x00')
+        # starting again has no effect
+        self.scanner.start()
+        self.assertEqual(self._requests(), 1)
+
+    def test_restart_on_completion(self):
+        self.scanner.start()
+        self.clock.now += 0.01
+        self._event(command_status("fe04"))
+        self.clock.now += 10.24
+        self._event(DEVICE_INFORMATION)
+        self._event(DISCOVERY_DONE)
+        self.assertEqual(self._requests(), 2)
+
+        stats = self.scanner.stats()
+        self.assertEqual(stats['scans'], 1)
+        self.assertEqual(stats['reports'], 1)
+        self.assertEqual(stats['devices'], 1)
+        self.assertAlmostEqual(stats['scanning'], 10.24)
+        self.assertAlmostEqual(stats['mean_gap'], 0.01)
+        self.assertAlmostEqual(stats['coverage'], 10.24 / 10.25)
+
+    def test_busy_retry(self):
+        self.scanner.start()
+        self._event(command_status("fe04", status='\x11'))
+        self.assertEqual(self.scanner.stats()['failures'], 1)
+        self.assertEqual(self._requests(), 1)
+
+        self._wait(ScanScheduler.retry_delay)
+        self.assertEqual(self._requests(), 2)
+        self._event(command_status("fe04"))
+        self.assertEqual(self.scanner.stats()['failures'], 1)
+
+    def test_unrelated_events(self):
+        self.scanner.start()
+        # the status of another command, and a failed scan before any
+        # request, are ignored
+        self._event(command_status("fe31", value='\xd0\x07'))
+        self._event(command_status("fe04"))
+        self._event(command_status("fe04", status='\x11'))
+        self.assertEqual(self.scanner.stats()['failures'], 0)
+        self.assertEqual(len(self.parser.timers), 0)
+
+    def test_pause_and_resume(self):
+        self.scanner.start()
+        self._event(command_status("fe04"))
+        self.clock.now += 1.0
+        self.scanner.pause()
+        self.assertEqual(self.port.commands()[-1], "fe05")
+        self._event(command_status("fe05"))
+        self._event(DISCOVERY_DONE)
+        # the cancelled scan is not restarted while paused
+        self.assertEqual(self._requests(), 1)
+
+        self.clock.now += 2.0
+        self.scanner.resume()
+        self.assertEqual(self._requests(), 2)
+        stats = self.scanner.stats()
+        self.assertEqual(stats['scans'], 0)
+        self.assertAlmostEqual(stats['paused'], 2.0)
+        self.assertAlmostEqual(stats['scanning'], 1.0)
+
+    def test_resume_before_cancel_ends(self):
+        self.scanner.start()
+        self._event(command_status("fe04"))
+        self.scanner.pause()
+        self.scanner.resume()
+        # the cancelled scan has yet to end, hence the device would
+        # reject another request
+        self.assertEqual(self._requests(), 1)
+
+        # the end of the cancelled scan restarts discovery, and is not
+        # counted as the end of the new scan
+        self._event(DISCOVERY_DONE)
+        self.assertEqual(self._requests(), 2)
+        self._event(command_status("fe04"))
+        self._event(DISCOVERY_DONE)
+        self.assertEqual(self._requests(), 3)
+        self.assertEqual(self.scanner.stats()['scans'], 1)
+
+    def test_cancel_rejected(self):
+        self.scanner.start()
+        self.scanner.pause()
+        self.scanner.resume()
+        # the request was yet to start, hence there was nothing to cancel
+        # and no discovery done event follows
+        self._event(command_status("fe05", status=INCORRECT_MODE))
+        self.assertEqual(self._requests(), 2)
+
+    def test_stop(self):
+        self.scanner.start()
+        self._event(command_status("fe04"))
+        self.scanner.stop()
+        self.assertEqual(self.port.commands()[-1], "fe05")
+        self._event(DISCOVERY_DONE)
+        self.assertEqual(self._requests(), 1)
+        # retries of earlier failures are not requested once stopped
+        self._wait(ScanScheduler.retry_delay)
+        self.assertEqual(self._requests(), 1)
+        self.scanner.resume()
+        self.assertEqual(self._requests(), 1)
+
+    def test_request_write_error(self):
+        self.scanner.start()
+        self._event(command_status("fe04"))
+
+        # the scan ends, and the next request cannot be written
+        self.port.fail = IOError("Port write failed")
+        self._event(DISCOVERY_DONE)
+        self.assertEqual(self._requests(), 1)
+        self.assertEqual(self.scanner.stats()['failures'], 1)
+
+        # hence it is retried
+        self._wait(ScanScheduler.retry_delay)
+        self.assertEqual(self.scanner.stats()['failures'], 2)
+        self.port.fail = None
+        self._wait(ScanScheduler.retry_delay)
+        self.assertEqual(self._requests(), 2)
+        self._event(command_status("fe04"))
+        self.assertEqual(self.scanner.stats()['scans'], 1)
+
+    def test_cancel_write_error(self):
+        self.scanner.start()
+        self._event(command_status("fe04"))
+
+        self.port.fail = IOError("Port write failed")
+        self.assertRaises(IOError, self.scanner.pause)
+        self.port.fail = None
+
+        # no discovery done event will follow the failed cancel, hence
+        # resuming must not wait for one
+        self.scanner.resume()
+        self.assertEqual(self._requests(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
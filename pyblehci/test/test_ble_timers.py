@@ -0,0 +1,147 @@
+"""
+@fn test_ble_timers.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for the timer wheel, driven by a fake clock.
+"""
+
+import random
+import unittest
+
+from pyblehci.ble_timers import TimerWheel
+from pyblehci.test.fakes import FakeClock
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.fired = []
+        # a small wheel, so that timers are cascaded between levels
+        self.wheel = TimerWheel(tick=1.0, slots=4, levels=3,
+                                clock=self.clock)
+
+    def _fire(self, name):
+        self.fired.append((name, self.clock.now - 1000.0))
+
+    def _run(self, until):
+        while self.clock.now - 1000.0 < until:
+            self.clock.now += 1.0
+            self.wheel.advance()
+
+    def test_fires_on_expiry(self):
+        timer = self.wheel.schedule(5.0, self._fire, 'a')
+        self.assertTrue(timer.active())
+        self.assertEqual(len(self.wheel), 1)
+
+        self.clock.now += 4.5
+        self.assertEqual(self.wheel.advance(), 0)
+        self.clock.now += 0.5
+        self.assertEqual(self.wheel.advance(), 1)
+        self.assertEqual(self.fired, [('a', 5.0)])
+        self.assertFalse(timer.active())
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_rounds_up_to_a_tick(self):
+        self.wheel.schedule(0, self._fire, 'a')
+        self.wheel.schedule(1.5, self._fire, 'b')
+        self._run(3)
+        self.assertEqual(self.fired, [('a', 1.0), ('b', 2.0)])
+
+    def test_cancel(self):
+        timer = self.wheel.schedule(3.0, self._fire, 'a')
+        self.assertTrue(timer.cancel())
+        self.assertFalse(timer.cancel())
+        self.assertEqual(len(self.wheel), 0)
+        self._run(5)
+        self.assertEqual(self.fired, [])
+
+    def test_cancel_after_firing(self):
+        timer = self.wheel.schedule(1.0, self._fire, 'a')
+        self._run(1)
+        self.assertFalse(timer.cancel())
+
+    def test_cascade(self):
+        # spanning every level of the wheel, and beyond its range
+        delays = [1, 3, 4, 5, 15, 16, 17, 40, 63, 64, 65, 100, 250]
+        for delay in delays:
+            self.wheel.schedule(delay, self._fire, delay)
+        self._run(300)
+        self.assertEqual(self.fired, [(delay, float(delay))
+                                      for delay in delays])
+
+    def test_random_deadlines(self):
+        generator = random.Random(1)
+        expected = []
+        for step in range(200):
+            delay = generator.randint(1, 80)
+            expected.append((step, self.clock.now - 1000.0 + delay))
+            self.wheel.schedule(delay, self._fire, step)
+            # advanced on every tick, so that each timer is seen to fire
+            # on the tick it expires
+            self.clock.now += generator.choice([0, 0, 1])
+            self.wheel.advance()
+        self._run(400)
+        self.assertEqual(sorted(self.fired, key=lambda fired: fired[0]),
+                         expected)
+
+    def test_callback_errors(self):
+        def fail(name):
+            raise IOError(name)
+        errors = []
+        self.wheel.on_error = lambda timer, error: errors.append(
+            (timer.args, str(error)))
+        self.wheel.schedule(1.0, fail, 'a')
+        self.wheel.schedule(1.0, self._fire, 'b')
+        self._run(1)
+        # later timers still fire
+        self.assertEqual(errors, [(('a',), 'a')])
+        self.assertEqual(self.fired, [('b', 1.0)])
+
+        # without a handler, the error is raised
+        self.wheel.on_error = None
+        self.wheel.schedule(1.0, fail, 'c')
+        self.clock.now += 1.0
+        self.assertRaises(IOError, self.wheel.advance)
+
+    def test_idle_wheel_jumps_forward(self):
+        self.clock.now += 1000.0
+        self.wheel.advance()
+        self.wheel.schedule(2.0, self._fire, 'a')
+        self.clock.now += 2.0
+        self.assertEqual(self.wheel.advance(), 1)
+
+    def test_next_timeout(self):
+        self.assertEqual(self.wheel.next_timeout(), None)
+        self.wheel.schedule(3.0, self._fire, 'a')
+        self.assertEqual(self.wheel.next_timeout(), 3.0)
+        self.clock.now += 1.5
+        self.assertEqual(self.wheel.next_timeout(), 1.5)
+
+        # beyond the lowest level, the wheel must be advanced to cascade
+        wheel = TimerWheel(tick=1.0, slots=4, levels=3, clock=self.clock)
+        wheel.schedule(40.0, self._fire, 'b')
+        self.assertTrue(0 < wheel.next_timeout() <= 4.0)
+
+    def test_wakeup(self):
+        wakeups = []
+        self.wheel.wakeup = lambda: wakeups.append(self.clock.now)
+
+        self.wheel.schedule(10.0, self._fire, 'a')
+        self.assertEqual(len(wakeups), 1)
+        timeout = self.wheel.next_timeout()
+
+        # later deadlines need not interrupt the wait
+        self.wheel.schedule(20.0, self._fire, 'b')
+        self.assertEqual(len(wakeups), 1)
+
+        # earlier ones must
+        self.wheel.schedule(1.0, self._fire, 'c')
+        self.assertEqual(len(wakeups), 2)
+        self.assertTrue(self.wheel.next_timeout() < timeout)
+
+
+if __name__ == '__main__':
+    unittest.main()
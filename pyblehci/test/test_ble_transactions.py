@@ -0,0 +1,350 @@
+"""
+@fn test_ble_transactions.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for ATT transaction tracking, driven by a fake clock and
+    events passed to the tracker.
+"""
+
+import struct
+import unittest
+
+from pyblehci.ble_builder import BLEBuilder
+from pyblehci.ble_parser import BLEParser
+from pyblehci.ble_timers import TimerWheel
+from pyblehci.ble_transactions import ATTTransactions, Transaction
+from pyblehci.test.fakes import (FakeClock, FakeSerial, command_status,
+                                 ext_event)
+
+
+def read_rsp(conn_handle, value):
+    """
+    Builds an ATT_ReadRsp event.
+    """
+    return ext_event("050b", payload=struct.pack(
+        '<HB', conn_handle, len(value)) + value)
+
+
+def write_rsp(conn_handle):
+    """
+    Builds an ATT_WriteRsp event.
+    """
+    return ext_event("0513", payload=struct.pack('<HB', conn_handle, 0))
+
+
+def error_rsp(conn_handle, handle, error_code=0x0a):
+    """
+    Builds an ATT_ErrorRsp event for a read request.
+    """
+    return ext_event("0501", payload=struct.pack(
+        '<HBBHB', conn_handle, 4, 0x0a, handle, error_code))
+
+
+def read_by_type_rsp(conn_handle, handle, value, status='\x00'):
+    """
+    Builds an ATT_ReadByTypeRsp event, or with a value of None, the event
+    ending the procedure with the given status.
+    """
+    if value is None:
+        return ext_event("0509", status,
+                         struct.pack('<HB', conn_handle, 0))
+    result = struct.pack('<H', handle) + value
+    return ext_event("0509", status, struct.pack(
+        '<HBB', conn_handle, len(result) + 1, len(result)) + result)
+
+
+class TransactionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.port = FakeSerial()
+        self.parser = BLEParser()
+        self.parser.timers = TimerWheel(tick=0.01, clock=self.clock)
+        self.att = ATTTransactions(BLEBuilder(self.port), self.parser,
+                                   timeout=1.0)
+        self.ended = []
+
+    def _event(self, packet):
+        response = self.parser._split_response(packet)
+        for listener in self.parser._listeners:
+            listener(response)
+
+    def _wait(self, seconds):
+        # a tick over, as timers round up to whole ticks
+        self.clock.now += seconds + 0.01
+        self.parser.timers.advance()
+
+    def _read(self, conn_handle, handle=0x27, **kwargs):
+        return self.att.request("fd8a", callback=self.ended.append,
+                                conn_handle=conn_handle, handle=handle,
+                                **kwargs)
+
+
+class TestATTTransactions(TransactionTestCase):
+
+    def test_request(self):
+        transaction = self._read(0)
+        self.assertEqual(self.port.written,
+                         ['\x01\x8a\xfd\x04\x00\x00\x27\x00'])
+        self._event(command_status("fd8a"))
+        self.assertFalse(transaction.done())
+
+        self._event(read_rsp(0, '\x01\x02'))
+        self.assertTrue(transaction.wait(0))
+        self.assertEqual(transaction.state, Transaction.COMPLETE)
+        self.assertEqual(transaction.response['value'][0], '\x01\x02')
+        self.assertEqual(self.ended, [transaction])
+        self.assertEqual(len(self.att), 0)
+        self.assertEqual(len(self.parser.timers), 0)
+
+    def test_unknown_command(self):
+        self.assertRaises(NotImplementedError, self.att.request, "fe31",
+                          param_id=0x15)
+        self.assertRaises(ValueError, self.att.request, "fd8a", handle=None)
+        self.assertEqual(self.port.written, [])
+        self.assertEqual(len(self.att), 0)
+
+    def test_one_request_per_connection(self):
+        first = self._read(0, 0x27)
+        second = self._read(0, 0x28)
+        other = self._read(1, 0x27)
+        # the second request on a connection waits for the first
+        self.assertEqual(len(self.port.written), 2)
+        self.assertEqual(len(self.att), 3)
+
+        # responses are matched by connection
+        self._event(read_rsp(1, '\x03'))
+        self.assertEqual(other.state, Transaction.COMPLETE)
+        self.assertFalse(first.done())
+
+        self._event(read_rsp(0, '\x01'))
+        self.assertEqual(first.state, Transaction.COMPLETE)
+        self.assertEqual(self.port.written[-1][-2:], '\x28\x00')
+        self._event(read_rsp(0, '\x02'))
+        self.assertEqual(second.response['value'][0], '\x02')
+        self.assertEqual(self.ended, [other, first, second])
+
+    def test_unrelated_responses(self):
+        transaction = self._read(0)
+        # a response of another kind, or for an idle connection
+        self._event(write_rsp(0))
+        self._event(read_rsp(1, '\x01'))
+        self.assertFalse(transaction.done())
+
+    def test_error_rsp(self):
+        transaction = self._read(0)
+        queued = self._read(0, 0x28)
+        self._event(error_rsp(0, 0x27))
+        self.assertEqual(transaction.state, Transaction.ERROR)
+        self.assertEqual(transaction.response['error_code'][0], '\x0a')
+        # the next request on the connection is sent
+        self.assertEqual(len(self.port.written), 2)
+        self.assertFalse(queued.done())
+
+    def test_command_rejected(self):
+        first = self._read(0)
+        other = self._read(1)
+        self._event(command_status("fd8a"))
+        # statuses are matched to requests in the order sent
+        self._event(command_status("fd8a", status='\x14'))
+        self.assertFalse(first.done())
+        self.assertEqual(other.state, Transaction.ERROR)
+        self.assertEqual(other.response['status'][0], '\x14')
+
+    def test_timeout(self):
+        transaction = self._read(0)
+        self._wait(0.5)
+        self.assertFalse(transaction.done())
+        self._wait(0.5)
+        self.assertEqual(transaction.state, Transaction.TIMEOUT)
+        self.assertEqual(self.ended, [transaction])
+        # a late response is not taken for another request
+        queued = self._read(0, 0x28)
+        self.assertEqual(len(self.port.written), 2)
+        self._event(read_rsp(0, '\x02'))
+        self.assertEqual(queued.state, Transaction.COMPLETE)
+
+    def test_retries_with_backoff(self):
+        transaction = self._read(0, retries=2, backoff=2.0)
+        # resent after 1, 2 and then 4 seconds without a response
+        for delay, sent in ((1.0, 2), (2.0, 3)):
+            self._wait(delay - 0.05)
+            self.assertEqual(len(self.port.written), sent - 1)
+            self._wait(0.05)
+            self.assertEqual(len(self.port.written), sent)
+            self.assertEqual(self.port.written[-1], self.port.written[0])
+        self._wait(3.9)
+        self.assertFalse(transaction.done())
+        self._wait(0.1)
+        self.assertEqual(transaction.state, Transaction.TIMEOUT)
+        self.assertEqual(transaction.attempts, 3)
+
+    def test_retry_answered(self):
+        transaction = self._read(0, retries=1)
+        self._wait(1.0)
+        self.assertEqual(len(self.port.written), 2)
+        self._event(read_rsp(0, '\x01'))
+        self.assertEqual(transaction.state, Transaction.COMPLETE)
+        self.assertEqual(len(self.parser.timers), 0)
+
+    def test_procedure(self):
+        transaction = self.att.request(
+            "fdb4", callback=self.ended.append, conn_handle=0,
+            read_type=0x2a00)
+        self._event(read_by_type_rsp(0, 0x03, 'ab'))
+        # further responses extend the deadline
+        self._wait(0.6)
+        self._event(read_by_type_rsp(0, 0x05, 'cd'))
+        self._wait(0.6)
+        self.assertFalse(transaction.done())
+
+        self._event(read_by_type_rsp(0, 0, None, status='\x1a'))
+        self.assertEqual(transaction.state, Transaction.COMPLETE)
+        self.assertEqual(len(transaction.responses), 3)
+        self.assertEqual(self.ended, [transaction])
+        self.assertEqual(len(self.parser.timers), 0)
+
+    def test_procedure_error(self):
+        transaction = self.att.request("fdb4", conn_handle=0,
+                                       read_type=0x2a00)
+        self._event(read_by_type_rsp(0, 0x03, 'ab'))
+        self._event(read_by_type_rsp(0, 0, None, status='\x16'))
+        self.assertEqual(transaction.state, Transaction.ERROR)
+        self.assertEqual(len(transaction.responses), 2)
+
+    def test_cancel_queued(self):
+        self._read(0)
+        queued = self._read(0, 0x28)
+        self.att.cancel(queued)
+        self.assertEqual(queued.state, Transaction.CANCELLED)
+        self.assertEqual(self.ended, [queued])
+        # never sent, hence nothing follows the first request
+        self._event(read_rsp(0, '\x01'))
+        self.assertEqual(len(self.port.written), 1)
+        self.assertEqual(len(self.att), 0)
+
+    def test_cancel_in_flight(self):
+        transaction = self._read(0)
+        queued = self._read(0, 0x28)
+        self.att.cancel(transaction)
+        self.assertEqual(transaction.state, Transaction.CANCELLED)
+        # the device may still answer, hence the next request waits
+        self.assertEqual(len(self.port.written), 1)
+
+        self._event(read_rsp(0, '\x01'))
+        self.assertEqual(transaction.responses, [])
+        self.assertEqual(len(self.port.written), 2)
+        self._event(read_rsp(0, '\x02'))
+        self.assertEqual(queued.state, Transaction.COMPLETE)
+        self.assertEqual(self.ended, [transaction, queued])
+
+    def test_cancel_unanswered(self):
+        transaction = self._read(0)
+        queued = self._read(0, 0x28)
+        self.att.cancel(transaction)
+        # without a response, the next request is sent at the deadline
+        self._wait(1.0)
+        self.assertEqual(len(self.port.written), 2)
+        self.assertEqual(transaction.state, Transaction.CANCELLED)
+        self.assertFalse(queued.done())
+
+    def test_write_error(self):
+        self.port.fail = IOError("Port write failed")
+        self.assertRaises(IOError, self._read, 0)
+        self.assertEqual(len(self.att), 0)
+        self.assertEqual(len(self.parser.timers), 0)
+        self.assertEqual(self.ended, [])
+
+        self.port.fail = None
+        transaction = self._read(0)
+        self._event(command_status("fd8a", status='\x14'))
+        self.assertEqual(transaction.state, Transaction.ERROR)
+
+
+class TestScatter(TransactionTestCase):
+
+    def _scatter(self, conn_handles, **kwargs):
+        return self.att.scatter("fd8a", conn_handles,
+                                callback=self.ended.append, handle=0x27,
+                                **kwargs)
+
+    def test_gather(self):
+        gather = self._scatter([0, 1, 2])
+        # sent on every connection at once
+        self.assertEqual(len(self.port.written), 3)
+        self.assertEqual(list(gather.results), [0, 1, 2])
+
+        self._event(read_rsp(2, '\x02'))
+        self._event(error_rsp(0, 0x27))
+        self.assertFalse(gather.done())
+        self._event(read_rsp(1, '\x01'))
+        self.assertTrue(gather.wait(0))
+        self.assertEqual(self.ended, [gather])
+        self.assertEqual(list(gather.succeeded()), [1, 2])
+        self.assertEqual(list(gather.failed()), [0])
+        self.assertFalse(gather.expired)
+        self.assertEqual(gather.results[2].response['value'][0], '\x02')
+
+    def test_duplicates(self):
+        gather = self._scatter([1, 0, 1])
+        self.assertEqual(list(gather.results), [1, 0])
+        self.assertEqual(len(self.port.written), 2)
+
+    def test_no_connections(self):
+        gather = self._scatter([])
+        self.assertTrue(gather.done())
+        self.assertEqual(self.ended, [gather])
+        self.assertEqual(self.port.written, [])
+
+    def test_queued_behind_other_requests(self):
+        earlier = self._read(1)
+        gather = self._scatter([0, 1])
+        self.assertEqual(len(self.port.written), 2)
+        self._event(read_rsp(0, '\x00'))
+        self._event(read_rsp(1, '\x01'))
+        self.assertEqual(earlier.state, Transaction.COMPLETE)
+        self.assertFalse(gather.done())
+        self._event(read_rsp(1, '\x01'))
+        self.assertEqual(list(gather.succeeded()), [0, 1])
+
+    def test_deadline(self):
+        gather = self._scatter([0, 1, 2], deadline=0.5)
+        self._event(read_rsp(1, '\x01'))
+        self._wait(0.5)
+        # cut short, rather than waiting for each request's own timeout
+        self.assertTrue(gather.done())
+        self.assertTrue(gather.expired)
+        self.assertEqual(list(gather.succeeded()), [1])
+        self.assertEqual(list(gather.failed()), [0, 2])
+        self.assertEqual(gather.results[0].state, Transaction.CANCELLED)
+        self.assertEqual(self.ended, [gather])
+
+    def test_deadline_not_reached(self):
+        gather = self._scatter([0, 1], deadline=0.5)
+        self._event(read_rsp(0, '\x00'))
+        self._event(read_rsp(1, '\x01'))
+        self.assertTrue(gather.done())
+        # the deadline is cancelled with the last response
+        self.assertEqual(len(self.parser.timers), 0)
+        self.assertFalse(gather.expired)
+
+    def test_write_error(self):
+        def respond(packet):
+            # the connection fails after the first request
+            self.port.fail = IOError("Port write failed")
+
+        self.port.respond = respond
+        self.assertRaises(IOError, self._scatter, [0, 1, 2])
+        # the request already sent is withdrawn, and the gather that was
+        # never returned is not reported
+        self.assertEqual(len(self.port.written), 1)
+        self.assertEqual(self.ended, [])
+        self.port.fail = None
+        self._event(read_rsp(0, '\x00'))
+        self.assertEqual(len(self.att), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
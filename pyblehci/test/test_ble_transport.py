@@ -0,0 +1,218 @@
+"""
+@fn test_ble_transport.py
+
+@author Stephen Finucane, 2013-2014
+@email  stephenfinucane@hotmail.com
+
+@about Tests for the socket transports, run against a local Unix domain
+    socket standing in for a serial bridge.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from pyblehci import ble_transport
+from pyblehci.ble_parser import BLEParser
+from pyblehci.ble_transport import UnixTransport
+
+# GAP_HCI_ExtentionCommandStatus for GAP_GetParam
+COMMAND_STATUS = '\x04\xff\x08\x7f\x06\x00\x31\xfe\x02\xd0\x07'
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "Unix sockets required")
+class TestUnixTransport(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bridge.sock')
+        self.server = None
+        self.conn = None
+        self._listen()
+        self.transport = UnixTransport(self.path, retry_delay=0.05)
+        self._accept()
+
+    def tearDown(self):
+        self.transport.close()
+        self._drop()
+        shutil.rmtree(self.dir)
+
+    def _listen(self):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen(1)
+
+    def _accept(self):
+        self.server.settimeout(1.0)
+        self.conn = self.server.accept()[0]
+        self.conn.settimeout(1.0)
+
+    def _drop(self):
+        """
+        Drops the connection and stops listening, so that reconnects
+        fail until '_listen' is called again.
+        """
+        if self.conn:
+            self.conn.shutdown(socket.SHUT_RDWR)
+            self.conn.close()
+            self.conn = None
+        if self.server:
+            self.server.close()
+            self.server = None
+            os.unlink(self.path)
+
+    def _recv(self, length):
+        data = ''
+        while len(data) < length:
+            chunk = self.conn.recv(length - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def _lose_connection(self):
+        self._drop()
+        # the transport notices the loss on its next read
+        self.assertEqual(self.transport.read(1), '')
+        self.assertFalse(self.transport._connected)
+
+    def test_write(self):
+        self.transport.write('\x01\x31\xfe\x01\x15')
+        self.assertEqual(self._recv(5), '\x01\x31\xfe\x01\x15')
+
+    def test_writev(self):
+        buffers = ['\x01\x31\xfe\x01\x00', '\x01\x31\xfe\x01\x01',
+                   '\x01\x31\xfe\x01\x02']
+        self.transport.writev(buffers)
+        self.assertEqual(self._recv(15), ''.join(buffers))
+        self.assertEqual(len(self.transport._backlog), 0)
+
+    def test_read(self):
+        self.conn.sendall('\x04\xff\x02\x7f\x06')
+        deadline = time.time() + 1.0
+        while self.transport.inWaiting() < 5 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.transport.inWaiting(), 5)
+        self.assertEqual(self.transport.read(5), '\x04\xff\x02\x7f\x06')
+        self.assertEqual(self.transport.inWaiting(), 0)
+
+    def test_in_waiting_without_fcntl(self):
+        fcntl = ble_transport.fcntl
+        ble_transport.fcntl = None
+        try:
+            self.assertEqual(self.transport.inWaiting(), 0)
+            self.conn.sendall('\x04\xff\x00')
+            time.sleep(0.05)
+            self.assertEqual(self.transport.inWaiting(), 3)
+        finally:
+            ble_transport.fcntl = fcntl
+
+    def test_reconnect_replays_backlog(self):
+        fileno = self.transport.fileno()
+        self._lose_connection()
+
+        # written while disconnected, hence held
+        self.transport.writev(['\x01\x31\xfe\x01\x00',
+                               '\x01\x31\xfe\x01\x01'])
+        self.assertEqual(len(self.transport._backlog), 2)
+
+        self._listen()
+        time.sleep(0.1)
+        self.transport.write('\x01\x31\xfe\x01\x02')
+        self._accept()
+        self.assertEqual(self._recv(15), '\x01\x31\xfe\x01\x00'
+                         '\x01\x31\xfe\x01\x01\x01\x31\xfe\x01\x02')
+        self.assertEqual(len(self.transport._backlog), 0)
+        self.assertEqual(self.transport.reconnects, 1)
+        # the parser may keep waiting on the same descriptor
+        self.assertEqual(self.transport.fileno(), fileno)
+
+    def test_reconnect_from_reader(self):
+        self._lose_connection()
+        self.transport.write('\x01\x31\xfe\x01\x15')
+
+        self._listen()
+        time.sleep(0.1)
+        self.assertEqual(self.transport.read(1), '')
+        self._accept()
+        self.assertEqual(self._recv(5), '\x01\x31\xfe\x01\x15')
+        self.assertEqual(self.transport.reconnects, 1)
+
+        self.conn.sendall('\x04')
+        self.assertEqual(self.transport.read(1), '\x04')
+
+    def test_reader_after_writer_reconnected(self):
+        self._drop()
+        self._listen()
+        time.sleep(0.1)
+        recv = self.transport._sock.recv
+
+        def lost(size):
+            # a writer notices the loss and reconnects while the reader
+            # is still returning from the old connection
+            with self.transport._lock:
+                self.transport._lost()
+                self.assertTrue(self.transport._try_reconnect())
+            return ''
+
+        self.transport._sock.recv = lost
+        try:
+            self.assertEqual(self.transport.read(1), '')
+        finally:
+            self.transport._sock.recv = recv
+        self._accept()
+        # the writer's connection is kept, not dropped by the reader
+        self.assertTrue(self.transport._connected)
+        self.assertEqual(self.transport.reconnects, 1)
+        self.conn.sendall('\x04')
+        self.assertEqual(self.transport.read(1), '\x04')
+
+    def test_max_backlog(self):
+        self.transport.max_backlog = 2
+        self._lose_connection()
+        self.transport.write('\x01\x31\xfe\x01\x00')
+        self.assertRaises(IOError, self.transport.writev,
+                          ['\x01\x31\xfe\x01\x01', '\x01\x31\xfe\x01\x02'])
+        self.assertEqual(len(self.transport._backlog), 1)
+
+    def test_reconnect_disabled(self):
+        self.transport.reconnect = False
+        self._drop()
+        self.assertRaises(IOError, self.transport.read, 1)
+        self.assertRaises(IOError, self.transport.write, '\x01')
+
+    def test_close(self):
+        self.transport.close()
+        self.assertRaises(IOError, self.transport.write, '\x01')
+        # closing again has no effect
+        self.transport.close()
+
+    def test_parser_drops_partial_packet(self):
+        events = []
+        parser = BLEParser(self.transport, callback=events.append)
+        try:
+            self.conn.sendall(COMMAND_STATUS[:5])
+            time.sleep(0.1)
+            self.conn.shutdown(socket.SHUT_RDWR)
+            self.conn.close()
+            self._accept()
+
+            # the first bytes on the new connection must not complete the
+            # packet left from the old one
+            self.conn.sendall(COMMAND_STATUS)
+            deadline = time.time() + 1.0
+            while not events and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            parser.stop()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0][0], COMMAND_STATUS)
+        self.assertEqual(parser.stats['dropped'], 5)
+        self.assertEqual(self.transport.reconnects, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()